@@ -61,6 +61,7 @@ SERIAL = config.get('ID', 'SERIAL', '<NO_SERIAL_NUMBER>')
 
 MASTER_IP = config.get('MAILING', 'master_ip', 'localhost')
 MASTER_PORT = config.getint('MAILING', 'master_port', 33620)
+MASTER_REPORTS_WORKERS = config.getint('MAILING', 'master_reports_workers', 4)  # count of threads storing satellites reports. Reports of a same mailing are always stored by the same thread.
 
 ## Satellite specific
 
@@ -71,6 +72,31 @@ USE_LOCAL_DNS_CACHE = config.getboolean('MAILING', 'use_local_dns_cache', False)
 LOCAL_DNS_CACHE_FILE = config.get('MAILING', 'local_dns_cache_filename', os.path.join(PROJECT_ROOT, 'local_dns_cache.ini'))  # mainly used for mailing tests. DNS always returns determined ips for some domains.
 MAIL_TEMP = config.get('MAILING', 'MAIL_TEMP', os.path.join(PROJECT_ROOT, 'temp'))
 CUSTOMIZED_CONTENT_FOLDER = config.get('MAILING', 'CUSTOMIZED_CONTENT_FOLDER', os.path.join(PROJECT_ROOT, 'cust_ml'))
+CUSTOMIZATION_PROCESSES = config.getint('MAILING', 'customization_processes', 0)  # if > 0, emails are customized by this number of worker processes instead of threads.
+CUSTOMIZATION_LOOKAHEAD = config.getint('MAILING', 'customization_lookahead', 2)  # number of emails customized in advance while sending. If 0, all emails of a queue are customized before connecting.
+WRITE_BEHIND_DELAY = config.getint('MAILING', 'write_behind_delay', 2)  # max delay (in seconds) before writing recipients updates to the db. If 0, updates are written immediately, i.e. synchronously in the reactor thread when deliveries end.
+WRITE_BEHIND_JOURNAL = config.get('MAILING', 'write_behind_journal', os.path.join(MAIL_TEMP, 'write_behind.journal'))
+STATS_FLUSH_DELAY = config.getint('MAILING', 'stats_flush_delay', 10)  # delay (in seconds) between writes of aggregated hourly and domain statistics. If 0, statistics are written immediately, i.e. synchronously in the reactor thread when deliveries end.
+LIVE_STATS = config.getboolean('MAILING', 'live_stats', True)  # if False, tries are not logged into 'live_stats' collection.
+LIVE_STATS_SAMPLING = config.getfloat('MAILING', 'live_stats_sampling', 1.0)  # ratio (between 0 and 1) of tries logged into 'live_stats' collection.
+LIVE_STATS_BATCH_SIZE = config.getint('MAILING', 'live_stats_batch_size', 500)  # live stats are buffered and written every 'live_stats_flush_delay' seconds, by batches of this size. If 0, they are written immediately.
+LIVE_STATS_FLUSH_DELAY = config.getint('MAILING', 'live_stats_flush_delay', 10)  # delay (in seconds) between writes of buffered live stats.
+LIVE_STATS_TTL = config.getint('MAILING', 'live_stats_ttl', 7 * 86400)  # live stats lifetime (in seconds).
+LIVE_STATS_CAPPED_SIZE = config.getint('MAILING', 'live_stats_capped_size', 0)  # if > 0, 'live_stats' is created as a capped collection of this size (in bytes) instead of using a TTL index.
+CUSTOMIZATION_MEMORY_BUDGET = config.getint('MAILING', 'customization_memory_budget', 0)  # if > 0, max size (in bytes) of customized emails kept in memory per queue instead of temp files.
+DNS_CACHE = config.getboolean('MAILING', 'dns_cache', True)  # if True, MX and A lookups are cached according to their TTL.
+DNS_CACHE_FILE = config.get('MAILING', 'dns_cache_file', os.path.join(MAIL_TEMP, 'dns_cache.json'))  # file where the DNS cache is saved, to be reloaded at startup.
+DNS_CACHE_MAX_ENTRIES = config.getint('MAILING', 'dns_cache_max_entries', 100000)  # max count of MX and A entries kept by the DNS cache.
+DNS_PREFETCH_CONCURRENCY = config.getint('MAILING', 'dns_prefetch_concurrency', 20)  # max count of domains resolved at the same time when new recipients are received, to warm the DNS cache. If 0, no prefetch.
+RATE_CONTROL = config.getboolean('MAILING', 'rate_control', True)  # if True, concurrent connections per domain and per MX adapt to throttling replies (AIMD).
+RATE_CONTROL_MAX_RELAYERS = config.getint('MAILING', 'rate_control_max_relayers', 20)  # max concurrent connections a domain (or MX) can reach when its max_relayers isn't configured.
+RATE_CONTROL_MIN_BACKOFF = config.getint('MAILING', 'rate_control_min_backoff', 60)  # seconds without new connection to a destination after a throttling reply. Doubled on consecutive ones.
+RATE_CONTROL_MAX_BACKOFF = config.getint('MAILING', 'rate_control_max_backoff', 3600)  # max seconds without new connection to a throttling destination.
+SMTP_POOL_IDLE_TIMEOUT = config.getint('MAILING', 'smtp_pool_idle_timeout', 10)  # delay (in seconds) during which an SMTP connection is kept open to be reused by the next queue for the same server. If 0, connections are closed after each queue.
+SMTP_POOL_MAX_IDLE = config.getint('MAILING', 'smtp_pool_max_idle', 4)  # maximum count of idle connections kept per server.
+SMTP_PIPELINING = config.getboolean('MAILING', 'smtp_pipelining', True)  # if True, SMTP commands are pipelined (RFC 2920) when the server supports it.
+SMTP_CHUNKING_THRESHOLD = config.getint('MAILING', 'smtp_chunking_threshold', 100 * 1024)  # emails of this size (in bytes) or bigger are sent by BDAT chunks (RFC 3030) when the server supports it. If 0, DATA is always used.
+SMTP_MAX_RECIPIENTS_PER_MAIL = config.getint('MAILING', 'smtp_max_recipients_per_mail', 1)  # if > 1, recipients of a same mailing without personalisation nor tracking are sent in a single SMTP transaction, up to this count of recipients.
 
 # Create missing folders
 for dir_name in (CUSTOMIZED_CONTENT_FOLDER, MAIL_TEMP):
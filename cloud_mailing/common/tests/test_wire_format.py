@@ -0,0 +1,100 @@
+# Copyright 2015-2019 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime
+
+from bson import ObjectId
+from twisted.trial.unittest import TestCase
+
+from ..wire_format import encode_records, decode_records, RecordsDecoder, RecordsPager, RecordsPageCollector, \
+    WireFormatError, MAGIC
+
+__author__ = 'ricard'
+
+
+class FakeBroker(object):
+    def __init__(self):
+        self.producers = []
+
+    def registerPageProducer(self, pager):
+        self.producers.append(pager)
+
+
+class LocalCollector(object):
+    """Forwards pages to a local collector, as the PB broker would do."""
+    def __init__(self, collector):
+        self.broker = FakeBroker()
+        self.collector = collector
+
+    def callRemote(self, name, *args, **kwargs):
+        kwargs.pop('pbanswer', None)
+        return getattr(self.collector, 'remote_' + name)(*args, **kwargs)
+
+    def run(self):
+        pager = self.broker.producers[0]
+        while pager.stillPaging():
+            pager.sendNextPage()
+
+
+def make_records(count):
+    return [{'_id': ObjectId(), 'email': 'rcpt%d@example.org' % i, 'mailing': 1, 'contact': {'firstname': 'Jean%d' % i},
+             'next_try': datetime(2019, 1, 1, 12, 30), 'body': b'\x00\x01', 'try_count': None}
+            for i in range(count)]
+
+
+class TestWireFormat(TestCase):
+    def test_round_trip(self):
+        records = make_records(10)
+        for compress in (True, False):
+            self.assertEqual(records, decode_records(encode_records(records, compress=compress)))
+        self.assertEqual([], decode_records(encode_records([])))
+
+    def test_incremental_decoding(self):
+        records = make_records(10)
+        data = encode_records(records)
+        decoder = RecordsDecoder()
+        decoded = []
+        for i in range(len(data)):
+            decoded.extend(decoder.feed(data[i:i + 1]))
+        decoder.close()
+        self.assertEqual(records, decoded)
+
+    def test_invalid_data(self):
+        data = encode_records(make_records(2))
+        self.assertRaises(WireFormatError, decode_records, data[:-3])
+        self.assertRaises(WireFormatError, decode_records, b'not a records stream')
+        self.assertRaises(WireFormatError, decode_records, MAGIC + b'\x02\x00')
+
+    def test_pager_and_collector(self):
+        records = make_records(1000)
+        pages = []
+
+        collector = RecordsPageCollector(pages.append)
+        remote = LocalCollector(collector)
+        pager = RecordsPager(remote, records, chunkSize=4096)
+        remote.run()
+        self.assertEqual(1000, pager.count)
+        self.assertTrue(len(pages) > 1)
+        self.assertEqual(records, [r for page in pages for r in page])
+        self.assertEqual(1000, self.successResultOf(collector.deferred))
+
+    def test_collector_decoding_error(self):
+        collector = RecordsPageCollector(lambda records: None)
+        collector.remote_gotPage(b'garbage data')
+        collector.remote_gotPage(encode_records(make_records(1)))
+        collector.remote_endedPaging()
+        self.failureResultOf(collector.deferred, WireFormatError)
@@ -0,0 +1,191 @@
+# Copyright 2015-2019 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Records stream exchanged between master and satellites.
+
+A stream starts with a header (magic string, format version, flags), followed by BSON documents (each one is prefixed
+by its own length), optionally compressed as a single zlib stream. So records can be encoded while sending pages and
+decoded as soon as a page is received.
+"""
+
+import struct
+import zlib
+
+import bson
+from twisted.internet import defer
+from twisted.spread import pb, util
+
+__author__ = 'Cedric RICARD'
+
+MAGIC = b'CMR'
+VERSION = 1
+FLAG_ZLIB = 0x01
+HEADER_SIZE = len(MAGIC) + 2
+
+
+class WireFormatError(Exception):
+    pass
+
+
+class RecordsEncoder(object):
+    def __init__(self, compress=True):
+        self.compressor = compress and zlib.compressobj(1) or None
+
+    def header(self):
+        return MAGIC + bytes((VERSION, self.compressor and FLAG_ZLIB or 0))
+
+    def encode(self, record):
+        data = bson.BSON.encode(record)
+        if self.compressor:
+            return self.compressor.compress(data)
+        return data
+
+    def flush(self):
+        if self.compressor:
+            return self.compressor.flush()
+        return b''
+
+
+class RecordsDecoder(object):
+    def __init__(self):
+        self.header_read = False
+        self.decompressor = None
+        self.buffer = b''
+
+    def feed(self, data):
+        """
+        Decodes a chunk of the stream.
+
+        @return: the list of records completed by this chunk
+        """
+        if not self.header_read:
+            data = self.buffer + data
+            if len(data) < HEADER_SIZE:
+                self.buffer = data
+                return []
+            magic, version, flags = data[:len(MAGIC)], data[len(MAGIC)], data[len(MAGIC) + 1]
+            if magic != MAGIC:
+                raise WireFormatError("Unknown data format")
+            if version > VERSION:
+                raise WireFormatError("Unsupported data format version %d" % version)
+            if flags & FLAG_ZLIB:
+                self.decompressor = zlib.decompressobj()
+            self.header_read = True
+            self.buffer = b''
+            data = data[HEADER_SIZE:]
+        if self.decompressor:
+            data = self.decompressor.decompress(data)
+        data = self.buffer + data
+        records = []
+        offset = 0
+        while len(data) - offset >= 4:
+            length = struct.unpack_from('<i', data, offset)[0]
+            if length < 5:
+                raise WireFormatError("Invalid record length")
+            if len(data) - offset < length:
+                break
+            records.append(bson.BSON(data[offset:offset + length]).decode())
+            offset += length
+        self.buffer = data[offset:]
+        return records
+
+    def close(self):
+        """Checks that the stream is complete."""
+        if not self.header_read or self.buffer or (self.decompressor and not self.decompressor.eof):
+            raise WireFormatError("Truncated data")
+
+
+def encode_records(records, compress=True):
+    encoder = RecordsEncoder(compress)
+    return encoder.header() + b''.join(encoder.encode(record) for record in records) + encoder.flush()
+
+
+def decode_records(data):
+    decoder = RecordsDecoder()
+    records = decoder.feed(data)
+    decoder.close()
+    return records
+
+
+class RecordsPager(util.Pager):
+    """
+    Pager encoding records while sending them, so the whole stream is never in memory.
+    """
+    def __init__(self, collector, records, chunkSize=262144, compress=True, callback=None, *args, **kw):
+        self.records = iter(records)
+        self.encoder = RecordsEncoder(compress)
+        self.chunkSize = chunkSize
+        self.buffer = self.encoder.header()
+        self.ended = False
+        self.count = 0  # records sent
+        self.size = 0  # bytes sent
+        util.Pager.__init__(self, collector, callback, *args, **kw)
+
+    def nextPage(self):
+        chunks = [self.buffer]
+        size = len(self.buffer)
+        while not self.ended and size < self.chunkSize:
+            record = next(self.records, None)
+            if record is None:
+                chunks.append(self.encoder.flush())
+                self.ended = True
+            else:
+                chunks.append(self.encoder.encode(record))
+                self.count += 1
+            size += len(chunks[-1])
+        data = b''.join(chunks)
+        page, self.buffer = data[:self.chunkSize], data[self.chunkSize:]
+        self.size += len(page)
+        if self.ended and not self.buffer:
+            self.stopPaging()
+        return page
+
+
+class RecordsPageCollector(pb.Referenceable):
+    """
+    Page collector decoding records as soon as their page is received.
+
+    `page_callback` is called with the list of records of each page. Then `deferred` is fired with the count of received
+    records, or errbacked on decoding error (following pages are ignored).
+    """
+    def __init__(self, page_callback):
+        self.page_callback = page_callback
+        self.decoder = RecordsDecoder()
+        self.deferred = defer.Deferred()
+        self.count = 0
+
+    def remote_gotPage(self, page):
+        if self.deferred.called:
+            return
+        try:
+            records = self.decoder.feed(page)
+            self.count += len(records)
+            if records:
+                self.page_callback(records)
+        except Exception:
+            self.deferred.errback()
+
+    def remote_endedPaging(self):
+        if self.deferred.called:
+            return
+        try:
+            self.decoder.close()
+        except WireFormatError:
+            self.deferred.errback()
+        else:
+            self.deferred.callback(self.count)
@@ -15,7 +15,6 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
 
-import pickle as pickle
 import logging
 import os
 import time
@@ -25,19 +24,20 @@ import pymongo
 from bson import ObjectId
 from twisted.cred import checkers, portal, error as cred_error, credentials
 from twisted.internet import reactor, defer
-from twisted.internet.threads import deferToThreadPool
 from twisted.python import failure
 from twisted.python import threadpool
 from twisted.python.deprecate import deprecated
 from twisted.python.versions import Version
-from twisted.spread import pb, util
+from twisted.spread import pb
 from twisted.spread.util import CallbackPageCollector
 from zope.interface import implementer
 
 from ..common.encoding import force_bytes
+from ..common.wire_format import RecordsPager
 from . import settings_vars
 from .models import CloudClient, Mailing, SenderDomain
 from .models import RECIPIENT_STATUS, MAILING_STATUS
+from .sharded_executor import ShardedExecutor
 from ..common import settings
 from ..common.db_common import get_db
 
@@ -75,24 +75,24 @@ def get_new_recipients_threadpool():
         __new_recipients_threadpool.start()
     return __new_recipients_threadpool
 
-__reports_threadpool = None
+__reports_executor = None
 
-def get_reports_threadpool():
-    global __reports_threadpool
-    if __reports_threadpool is None:
-        __reports_threadpool = threadpool.ThreadPool(1, 1, "cm.send_reports")
-        __reports_threadpool.start()
-    return __reports_threadpool
+def get_reports_executor():
+    global __reports_executor
+    if __reports_executor is None:
+        __reports_executor = ShardedExecutor("cm.send_reports", settings.MASTER_REPORTS_WORKERS)
+        __reports_executor.start()
+    return __reports_executor
 
 
 def stop_all_threadpools():
-    global __new_recipients_threadpool, __reports_threadpool
+    global __new_recipients_threadpool, __reports_executor
     if __new_recipients_threadpool:
         __new_recipients_threadpool.stop()
         __new_recipients_threadpool = None
-    if __reports_threadpool:
-        __reports_threadpool.stop()
-        __reports_threadpool = None
+    if __reports_executor:
+        __reports_executor.stop()
+        __reports_executor = None
 
 
 class ClientAvatar(pb.Avatar):
@@ -272,7 +272,7 @@ class MailingManagerView(pb.Viewable):
                         self.log.debug("Found global DKIM configuration")
                         dkim = sender_domain.dkim
                         dkim["domain"] = mailing.domain_name
-                util.StringPager(collector, pickle.dumps({
+                RecordsPager(collector, [{
                     'id': mailing_id,
                     'header': header,
                     'body': body,
@@ -288,13 +288,13 @@ class MailingManagerView(pb.Viewable):
                     'type': mailing.type,
                     'url_encoding': mailing.url_encoding,
                     'delete': False,
-                }))
+                }])
             else:
                 self.log.error("Mailing [%d] doesn't exist anymore.", mailing_id)
-                util.StringPager(collector, pickle.dumps({'id': mailing_id, 'delete': True}))
+                RecordsPager(collector, [{'id': mailing_id, 'delete': True}])
         except Exception:
             self.log.exception("Can't get mailing [%d]", mailing_id)
-            util.StringPager(collector, pickle.dumps({'id': mailing_id, 'delete': True}))
+            RecordsPager(collector, [{'id': mailing_id, 'delete': True}])
         #self.log.debug("get_mailing(%d) finished", mailing_id)
 
     @deprecated(Version('cloud_mailing', 0, 5, 2),
@@ -304,8 +304,7 @@ class MailingManagerView(pb.Viewable):
         Returns an array of recipients. Each recipient is described by a dictionary with all its attributes.
         """
         self.log.warning("get_recipients(count=%d) DEPRECATED", count)
-        data = pickle.dumps([])
-        util.StringPager(collector, data)
+        RecordsPager(collector, [])
 
     @defer.inlineCallbacks
     def view_get_my_recipients(self, client, collector):
@@ -317,94 +316,139 @@ class MailingManagerView(pb.Viewable):
         db = get_db()
         recipients = yield db.mailingrecipient.find({'cloud_client': self.cloud_client.serial, 'in_progress': True}, fields=[])
         # recipients = list(recipients)
-        data = pickle.dumps([str(r['_id']) for r in recipients])
-        # print "sending %d length data for %d recipients" % (len(data), len(recipients))
-        util.StringPager(collector, data)
+        RecordsPager(collector, [{'_id': str(r['_id'])} for r in recipients])
 
     @staticmethod
     def _store_reports(_recipients, serial, log):
+        """
+        Stores satellite reports with one query to read current recipients states, and one unordered bulk write.
+
+        @return: (list of successfully updated ids, dictionary of counters increments per mailing)
+        """
         from .models import MailingRecipient
         t0 = time.time()
 
         # We need to keep backup_customized_emails flag for each mailing to avoid consuming requests
-        mailing_ids = [recipient['mailing'] for recipient in _recipients]
+        mailing_ids = list(set(recipient['mailing'] for recipient in _recipients))
         mailings = {}
         for ml in Mailing._get_collection().find({'_id': {'$in': mailing_ids}}, {'backup_customized_emails': True}):
             mailings[ml['_id']] = ml
 
-        ids_ok = []
-        mailings_stats = {}
-        # TODO optimize this using UPDATE multiples
+        reports = {}  # key = recipient ObjectId, value = report
         for rcpt in _recipients:
-            name = "Unknown"
             try:
-                name = rcpt['email']
-                recipient = MailingRecipient.grab(rcpt['_id'])
+                reports[ObjectId(rcpt['_id'])] = rcpt
+            except Exception:
+                log.exception("Can't update recipient '%s'.", rcpt.get('email', "Unknown"))
+        current_states = dict((r['_id'], r) for r in MailingRecipient._get_collection().find(
+            {'_id': {'$in': list(reports.keys())}},
+            projection=('mailing', 'send_status', 'dsn', 'first_try')))
+
+        now = datetime.utcnow()
+        operations = []
+        updates = []  # list of (report id, mailing id, counters increments), in the same order as operations
+        ids_ok = []
+        for _id, rcpt in reports.items():
+            name = rcpt.get('email', "Unknown")
+            try:
+                recipient = current_states.get(_id)
                 if recipient is None:
                     log.warn("Can't update recipient '%s'. Mailing [%d] or recipient doesn't exist anymore.",
                              name, rcpt['mailing'])
-                elif recipient.send_status == RECIPIENT_STATUS.ERROR and recipient.dsn is not None:
+                    ids_ok.append(rcpt['_id'])
+                    continue
+                send_status = rcpt['send_status']
+                if recipient.get('send_status') == RECIPIENT_STATUS.ERROR and recipient.get('dsn') is not None:
                     # DSN received before this report, we have to ignore the report to not overwrite DSN
                     log.debug("[Mailing %d] Delivery Status Notification already received for recipient <%s>",
                               rcpt['mailing'], name)
+                    ids_ok.append(rcpt['_id'])
+                    continue
+                mailing_id = recipient['mailing'].id
+                was_in_softbounce = recipient.get('send_status') == RECIPIENT_STATUS.WARNING
+                fields = {
+                    'report_ready': True,
+                    'try_count': rcpt['try_count'],
+                    'send_status': send_status,
+                    'reply_code': rcpt.get('reply_code') or None,
+                    'reply_enhanced_code': rcpt.get('reply_enhanced_code') or None,
+                    'reply_text': rcpt.get('reply_text') or None,
+                    'smtp_log': rcpt.get('smtp_log') or None,
+                    'in_progress': False,
+                    'cloud_client': serial,
+                    'modified': now,
+                }
+                if not recipient.get('first_try'):
+                    fields['first_try'] = rcpt['first_try']
+                ml_stats = {}
+                if send_status not in (RECIPIENT_STATUS.FINISHED,
+                                       RECIPIENT_STATUS.ERROR,
+                                       RECIPIENT_STATUS.GENERAL_ERROR,
+                                       RECIPIENT_STATUS.TIMEOUT):
+                    fields['next_try'] = MailingRecipient.get_next_try(rcpt['try_count'], now)
+                    if not was_in_softbounce:
+                        ml_stats['total_softbounce'] = 1
                 else:
-                    assert(isinstance(recipient, MailingRecipient))
-                    recipient.report_ready = True
-                    if not recipient.first_try:
-                        recipient.first_try = rcpt['first_try']
-                    was_in_softbounce = recipient.send_status == RECIPIENT_STATUS.WARNING
-                    recipient.try_count = rcpt['try_count']
-                    recipient.update_send_status(rcpt['send_status'],
-                                                 rcpt.get('reply_code'),
-                                                 rcpt.get('reply_enhanced_code'),
-                                                 rcpt.get('reply_text'),
-                                                 smtp_log=rcpt.get('smtp_log'))
-                    ml_stats = mailings_stats.setdefault(recipient.mailing.id, {})
-                    if recipient.send_status not in (RECIPIENT_STATUS.FINISHED,
-                                                     RECIPIENT_STATUS.ERROR,
-                                                     RECIPIENT_STATUS.GENERAL_ERROR,
-                                                     RECIPIENT_STATUS.TIMEOUT):
-                        recipient.set_send_mail_next_time()
-                        if not was_in_softbounce:
-                            # recipient.mailing.total_softbounce += 1
-                            # recipient.mailing.save()
-                            ml_stats['total_softbounce'] = ml_stats.setdefault('total_softbounce', 0) + 1
+                    ml_stats['total_pending'] = -1
+                    if was_in_softbounce:
+                        ml_stats['total_softbounce'] = -1
+                    if send_status == RECIPIENT_STATUS.FINISHED:
+                        fields['next_try'] = now
+                        ml_stats['total_sent'] = 1
+                        if mailings[mailing_id].get('backup_customized_emails', False):
+                            if not os.path.exists(make_customized_file_name(mailing_id, str(_id))):
+                                fields['report_ready'] = False
                     else:
-                        # recipient.mailing.total_pending -= 1
-                        ml_stats['total_pending'] = ml_stats.setdefault('total_pending', 0) - 1
-                        if was_in_softbounce:
-                            # recipient.mailing.total_softbounce -= 1
-                            ml_stats['total_softbounce'] = ml_stats.setdefault('total_softbounce', 0) - 1
-                        if recipient.send_status == RECIPIENT_STATUS.FINISHED:
-                            # recipient.mailing.total_sent += 1
-                            ml_stats['total_sent'] = ml_stats.setdefault('total_sent', 0) + 1
-                            if mailings[recipient.mailing.id].get('backup_customized_emails', False):
-                                if not os.path.exists(make_customized_file_name(recipient.mailing.id, str(recipient.id))):
-                                    recipient.report_ready = False
-                        else:
-                            # recipient.mailing.total_error += 1
-                            ml_stats['total_error'] = ml_stats.setdefault('total_error', 0) + 1
-                        # recipient.mailing.save()
-
-                    recipient.cloud_client = serial
-                    recipient.save()
-                ids_ok.append(rcpt['_id'])
-            except:
+                        ml_stats['total_error'] = 1
+                operations.append(pymongo.UpdateOne({'_id': _id}, {'$set': fields}))
+                updates.append((rcpt['_id'], mailing_id, ml_stats))
+            except Exception:
                 log.exception("Can't update recipient '%s'.", name)
 
+        failed_indexes = set()
+        if operations:
+            try:
+                MailingRecipient._get_collection().bulk_write(operations, ordered=False)
+            except pymongo.errors.BulkWriteError as ex:
+                failed_indexes = set(e['index'] for e in ex.details.get('writeErrors', []))
+                log.error("Can't update %d recipients: %s", len(failed_indexes), ex.details.get('writeErrors', [])[:1])
+
+        mailings_stats = {}
+        for index, (rcpt_id, mailing_id, ml_stats) in enumerate(updates):
+            if index in failed_indexes:
+                continue
+            stats = mailings_stats.setdefault(mailing_id, {})
+            for key, value in ml_stats.items():
+                stats[key] = stats.get(key, 0) + value
+            ids_ok.append(rcpt_id)
+
         log.debug("Stored %d reports from satellite [%s] in %.2f s", len(ids_ok), serial, time.time() - t0)
         return ids_ok, mailings_stats
 
     @staticmethod
     def _update_mailings_stats(result):
         ids_ok, mailings_stats = result
-        for mailing_id, ml_stats in list(mailings_stats.items()):
-            Mailing.update({'_id': mailing_id}, {'$inc': {
-                'total_softbounce': ml_stats.get('total_softbounce', 0),
-                'total_sent': ml_stats.get('total_sent', 0),
-                'total_error': ml_stats.get('total_error', 0),
-                'total_pending': ml_stats.get('total_pending', 0),
-                }})
+        operations = [pymongo.UpdateOne({'_id': mailing_id}, {'$inc': {
+            'total_softbounce': ml_stats.get('total_softbounce', 0),
+            'total_sent': ml_stats.get('total_sent', 0),
+            'total_error': ml_stats.get('total_error', 0),
+            'total_pending': ml_stats.get('total_pending', 0),
+            }}) for mailing_id, ml_stats in mailings_stats.items()]
+        if operations:
+            Mailing._get_collection().bulk_write(operations, ordered=False)
+        return ids_ok
+
+    @staticmethod
+    def _process_reports(_recipients, serial, log):
+        return MailingManagerView._update_mailings_stats(MailingManagerView._store_reports(_recipients, serial, log))
+
+    def _cb_reports_processed(self, results):
+        ids_ok = []
+        for success, result in results:
+            if success:
+                ids_ok.extend(result)
+            else:
+                self.log.error("Can't store reports from satellite [%s]: %s", self.cloud_client.serial, result.value)
         return ids_ok
 
     def view_send_reports(self, client, recipients):
@@ -416,10 +460,15 @@ class MailingManagerView(pb.Viewable):
         """
         self.log.debug("send_reports(...) with %d recipients", len(recipients))
 
-
-        return deferToThreadPool(reactor, get_reports_threadpool(),
-                                 MailingManagerView._store_reports, recipients, self.cloud_client.serial, self.log).\
-            addCallback(self._update_mailings_stats)
+        reports_by_mailing = {}
+        for recipient in recipients:
+            reports_by_mailing.setdefault(recipient['mailing'], []).append(recipient)
+        # reports of a same mailing are always stored by the same worker, so its counters are updated in order
+        executor = get_reports_executor()
+        return defer.DeferredList([executor.submit(mailing_id, MailingManagerView._process_reports, reports,
+                                                   self.cloud_client.serial, self.log)
+                                   for mailing_id, reports in reports_by_mailing.items()], consumeErrors=True)\
+            .addCallback(self._cb_reports_processed)
 
     def view_send_statistics(self, client, stats_records):
         """
@@ -328,12 +328,18 @@ class MailingRecipient(Model):
         This implement the mailing specific strategy for retries.
         """
         self.in_progress = False
-        if not self.try_count or self.try_count < 3:
-            self.next_try = datetime.utcnow() + timedelta(minutes=10)
-        elif self.try_count < 10:
-            self.next_try = datetime.utcnow() + timedelta(minutes=60)
+        self.next_try = self.get_next_try(self.try_count)
+
+    @staticmethod
+    def get_next_try(try_count, now=None):
+        """Returns the date of the next try for a recipient already tried `try_count` times."""
+        now = now or datetime.utcnow()
+        if not try_count or try_count < 3:
+            return now + timedelta(minutes=10)
+        elif try_count < 10:
+            return now + timedelta(minutes=60)
         else:
-            self.next_try = datetime.utcnow() + timedelta(hours=6)
+            return now + timedelta(hours=6)
 
 
 class MailingHourlyStats(Model):
@@ -15,7 +15,6 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
 
-import pickle as pickle
 import logging
 import re
 import time
@@ -25,10 +24,10 @@ import pymongo
 import txmongo.filter
 from bson import DBRef
 from twisted.internet import defer
-from twisted.spread import util
 
 from ..common.db_common import get_db
 from ..common.singletonmixin import Singleton
+from ..common.wire_format import RecordsPager
 from . import settings_vars
 from .models import MAILING_STATUS, RECIPIENT_STATUS
 
@@ -342,14 +341,13 @@ class SendRecipientsTask(Singleton):
 
         recipients = yield self._get_recipients(min(count, wanted_count), serial)
 
-        def show_time_at_end(_t0, rcpts_count, data_len):
+        def show_time_at_end(_t0):
             self.log.debug("_send_recipients_to_satellite(%s): Sent %d recipients (%.2f Kb) in %.2f s",
-                           serial, rcpts_count, data_len / 1024.0, time.time() - _t0)
+                           serial, pager.count, pager.size / 1024.0, time.time() - _t0)
 
         self.log.debug("_send_recipients_to_satellite(%s): starting sending %d recipients at %.2f s",
                        serial, len(recipients), time.time() - t0)
-        data = pickle.dumps(recipients)
-        util.StringPager(collector, data, 262144, show_time_at_end, t0, len(recipients), len(data))
+        pager = RecordsPager(collector, recipients, 262144, True, show_time_at_end, t0)
 
     @defer.inlineCallbacks
     def run(self):
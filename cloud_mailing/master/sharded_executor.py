@@ -0,0 +1,86 @@
+# Copyright 2015-2019 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python import failure, threadpool
+
+__author__ = 'Cedric RICARD'
+
+
+class ShardedExecutor(object):
+    """
+    Runs functions in several single-thread pools (shards). Calls submitted with the same key always run in the same
+    shard, so they are executed in submission order, while calls with different keys run in parallel.
+    """
+    def __init__(self, name, shards_count):
+        self.name = name
+        self.pools = [threadpool.ThreadPool(1, 1, "%s.%d" % (name, i)) for i in range(max(1, shards_count))]
+        self.pending = [0] * len(self.pools)  # queue depth per shard
+        self.processed = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def start(self):
+        for pool in self.pools:
+            pool.start()
+
+    def stop(self):
+        for pool in self.pools:
+            pool.stop()
+
+    def get_shard(self, key):
+        return hash(key) % len(self.pools)
+
+    def submit(self, key, f, *args, **kwargs):
+        """
+        Runs `f(*args, **kwargs)` in the shard of `key`.
+
+        @return: a Deferred fired (in the reactor thread) with the result of `f`
+        """
+        shard = self.get_shard(key)
+        self.pending[shard] += 1
+        d = deferToThreadPool(reactor, self.pools[shard], f, *args, **kwargs)
+        d.addBoth(self._done, shard, time.time())
+        return d
+
+    def _done(self, result, shard, t0):
+        latency = time.time() - t0
+        self.pending[shard] -= 1
+        self.processed += 1
+        if isinstance(result, failure.Failure):
+            self.errors += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        return result
+
+    def get_stats(self):
+        """
+        Returns queue depths and latencies (time between submission and end of execution, in seconds) of the executor.
+        """
+        return {
+            'shards': len(self.pools),
+            'queue_depth': sum(self.pending),
+            'max_shard_queue_depth': max(self.pending),
+            'processed': self.processed,
+            'errors': self.errors,
+            'avg_latency': self.processed and self.total_latency / self.processed or 0.0,
+            'max_latency': self.max_latency,
+        }
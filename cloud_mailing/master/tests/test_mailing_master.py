@@ -15,7 +15,6 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
 import hashlib
-import pickle as pickle
 import email
 import email.message
 import hmac
@@ -44,6 +43,7 @@ from ..models import Mailing, MailingRecipient, MAILING_STATUS, RECIPIENT_STATUS
 from ...common import settings
 from ...common.html_tools import strip_tags
 from ...common.unittest_mixins import DatabaseMixin
+from ...common.wire_format import decode_records
 
 
 def make_email():
@@ -143,7 +143,7 @@ class CloudClient(pb.Referenceable):
         return count, collector
 
     def cb_get_recipients(self, data_list, t0):
-        recipients = pickle.loads(b''.join(data_list))
+        recipients = decode_records(b''.join(data_list))
         # print "Received %d new recipients from Manager in %.1fs." % (len(recipients), time.time() - t0)
         self.get_recipients_deferred.callback(recipients)
 
@@ -250,7 +250,7 @@ class MailingMasterTest(DatabaseMixin, TestCase):
         # print "cb_get_mailing", data_list
         data = b''.join(data_list)
         mailing_id = None
-        mailing_dict = pickle.loads(data)
+        mailing_dict = decode_records(data)[0]
         original = Mailing.grab(mailing_dict['id'])
         self.assertFalse(mailing_dict['delete'])
         #self.assertEquals(mailing_dict['header'], original.header)
@@ -529,6 +529,37 @@ class SendReportTest(DatabaseMixin, TestCase):
         self.assertEqual(50, ml2.total_sent)
         self.assertEqual(30, ml2.total_error)
 
+    def test_store_reports_states_transitions(self):
+        ml = factories.MailingFactory()
+        softbounced = factories.RecipientFactory(mailing=ml, email='soft@domain.tld',
+                                                 send_status=RECIPIENT_STATUS.WARNING)
+        with_dsn = factories.RecipientFactory(mailing=ml, email='dsn@domain.tld', send_status=RECIPIENT_STATUS.ERROR,
+                                              dsn={'Action': 'failed'})
+        unknown_id = ObjectId()
+        one_hour_ago = datetime.utcnow() - timedelta(hours=1)
+        MailingRecipient.update({'_id': softbounced.id}, {'$set': {'modified': one_hour_ago}})
+
+        def report(_id, email, send_status):
+            return {'email': email, '_id': str(_id), 'mailing': ml.id, 'first_try': datetime.now(), 'try_count': 2,
+                    'send_status': send_status, 'reply_code': 250, 'reply_text': "Ok"}
+
+        r, mailings_stats = MailingManagerView._store_reports([
+            report(softbounced.id, 'soft@domain.tld', RECIPIENT_STATUS.FINISHED),
+            report(with_dsn.id, 'dsn@domain.tld', RECIPIENT_STATUS.FINISHED),
+            report(unknown_id, 'unknown@domain.tld', RECIPIENT_STATUS.FINISHED),
+        ], "SERIAL", logging.getLogger())
+        self.assertEqual(set(str(_id) for _id in (softbounced.id, with_dsn.id, unknown_id)), set(r))
+        self.assertEqual({ml.id: {'total_pending': -1, 'total_softbounce': -1, 'total_sent': 1}}, mailings_stats)
+
+        recipient = MailingRecipient.grab(softbounced.id)
+        self.assertEqual(RECIPIENT_STATUS.FINISHED, recipient.send_status)
+        self.assertEqual(2, recipient.try_count)
+        self.assertEqual("SERIAL", recipient.cloud_client)
+        self.assertTrue(recipient.report_ready)
+        self.assertFalse(recipient.in_progress)
+        self.assertGreater(recipient.modified, one_hour_ago + timedelta(minutes=30))
+        self.assertEqual(RECIPIENT_STATUS.ERROR, MailingRecipient.grab(with_dsn.id).send_status)
+
 
 class MailingManagerQueries(DatabaseMixin, TestCase):
 
@@ -0,0 +1,73 @@
+# Copyright 2015-2019 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+
+from ..sharded_executor import ShardedExecutor
+
+__author__ = 'ricard'
+
+
+class TestShardedExecutor(TestCase):
+    def setUp(self):
+        self.executor = ShardedExecutor("test", 3)
+        self.executor.start()
+
+    def tearDown(self):
+        self.executor.stop()
+
+    @defer.inlineCallbacks
+    def test_same_key_runs_in_order_on_same_thread(self):
+        calls = []
+
+        def f(i):
+            calls.append((i, threading.current_thread().name))
+            return i
+
+        results = yield defer.gatherResults([self.executor.submit(42, f, i) for i in range(20)])
+        self.assertEqual(list(range(20)), results)
+        self.assertEqual(list(range(20)), [i for i, name in calls])
+        self.assertEqual(1, len(set(name for i, name in calls)))
+
+    @defer.inlineCallbacks
+    def test_different_keys_run_in_parallel(self):
+        event = threading.Event()
+        shards = set(self.executor.get_shard(key) for key in (1, 2))
+        self.assertEqual(2, len(shards))
+        # the first call would block forever if the second one wasn't run by another thread
+        d1 = self.executor.submit(1, event.wait, 5)
+        d2 = self.executor.submit(2, event.set)
+        self.assertEqual(2, self.executor.get_stats()['queue_depth'])
+        yield d2
+        self.assertTrue((yield d1))
+
+    @defer.inlineCallbacks
+    def test_stats(self):
+        def fail():
+            raise ValueError()
+
+        yield self.executor.submit(1, lambda: None)
+        yield self.assertFailure(self.executor.submit(2, fail), ValueError)
+        stats = self.executor.get_stats()
+        self.assertEqual(3, stats['shards'])
+        self.assertEqual(0, stats['queue_depth'])
+        self.assertEqual(2, stats['processed'])
+        self.assertEqual(1, stats['errors'])
+        self.assertTrue(stats['max_latency'] >= stats['avg_latency'] > 0)
@@ -41,7 +41,7 @@ from ..common.encoding import force_text, force_bytes
 from .api_common import compute_hourly_stats
 from .api_common import log_cfg, log_security, log_api, pause_mailing, delete_mailing
 from .api_common import set_mailing_properties, start_mailing
-from .cloud_master import make_customized_file_name
+from .cloud_master import make_customized_file_name, get_reports_executor
 from .mailing_manager import MailingManager
 from .models import CloudClient, Mailing, relay_status, MAILING_STATUS, MailingRecipient, RECIPIENT_STATUS, \
     recipient_status
@@ -1050,8 +1050,10 @@ class CloudMailingRpc(BasicHttpAuthXMLRPC, XMLRPCDocGenerator):
             'recipients_count': MailingRecipient.count(),
             'active_recipients_count': MailingRecipient.find({'send_status': {'$in': [RECIPIENT_STATUS.READY,
                                                                                       RECIPIENT_STATUS.IN_PROGRESS,
-                                                                                      RECIPIENT_STATUS.WARNING]}}).count()
+                                                                                      RECIPIENT_STATUS.WARNING]}}).count(),
+            'reports_executor': get_reports_executor().get_stats(),
         }
+        return stats
 
     @doc_hide
     def xmlrpc_master_db_find(self, request, collection, filter, projection, skip, limit, sort):
@@ -23,7 +23,6 @@ import hmac
 import logging
 import os
 
-import time
 from bson import ObjectId
 import errno
 
@@ -32,11 +31,11 @@ from twisted.internet import reactor, defer
 from twisted.python import failure
 from twisted.cred import credentials
 from twisted.internet.protocol import ReconnectingClientFactory
-from twisted.spread.util import CallbackPageCollector
 
 from . import settings_vars
+from .db_thread import deferToDb
 from .mail_customizer import MailCustomizer
-from .models import MailingRecipient, Mailing
+from .models import MailingRecipient, Mailing, WriteBehind
 from ..common.config_file import ConfigFile
 from ..common import settings
 from ..common.models import Settings
@@ -96,28 +95,36 @@ class CloudClient(pb.Referenceable):
 
     def remote_mailing_changed(self, mailing_id):
         """Informs satellite that mailing content has changed."""
-        Mailing.update({'_id': mailing_id}, {'$set': {'body_downloaded': False}})
+        d = deferToDb(Mailing.update, {'_id': mailing_id}, {'$set': {'body_downloaded': False}})
+        MailCustomizer.invalidate_mailing_body(mailing_id)
         import os, glob
         for entry in glob.glob(os.path.join(settings.MAIL_TEMP, MailCustomizer.make_patten_for_queue(mailing_id))):
             try:
                 os.remove(entry)
             except Exception:
                 log.exception("Can't remove customized file '%s'", entry)
+        return d.addCallback(lambda _: None)
 
     def remote_get_recipients_list(self):
         """
-        Returns the list of currently handled recipient ids.
+        Returns (through a Deferred) the list of currently handled recipient ids.
         """
-        return [str(x['_id']) for x in MailingRecipient._get_collection().find(projection=('_id',))]
+        return deferToDb(lambda: [str(x['_id']) for x in MailingRecipient._get_collection().find(projection=('_id',))])
 
     def remote_check_recipients(self, recipient_ids):
         """
-        Returns a dictionary mapping for each input id the corresponding recipient object, nor None is not found.
+        Returns (through a Deferred) a dictionary mapping for each input id the corresponding recipient object, nor
+        None is not found.
         """
         log.debug('check_recipients(...%d recipients...)', len(recipient_ids))
+        return deferToDb(self._check_recipients, recipient_ids)
+
+    @staticmethod
+    def _check_recipients(recipient_ids):
         recipients_dict = {}
         for _id in recipient_ids:
             recipients_dict[_id] = None
+        WriteBehind.flush()
         for recipient in MailingRecipient._get_collection().find({'_id': {'$in': [ObjectId(x) for x in recipient_ids]}}):
             for field in ('contact_data', 'unsubscribe_id'):
                 recipient.pop(field, None)
@@ -179,10 +186,7 @@ class CloudClient(pb.Referenceable):
         count = min(count, mailing_queue_max_size - temp_queue_count)
         log.debug("Requesting %d recipients...", count)
 
-        d = defer.Deferred()
-        collector = CallbackPageCollector(d.callback)
-        d.addCallbacks(self.mailing_queue.cb_get_recipients, self.mailing_queue.eb_get_recipients, callbackArgs=[time.time()])
-        return count, collector
+        return count, self.mailing_queue.get_recipients_collector()
 
 
 class CloudClientFactory(pb.PBClientFactory, ReconnectingClientFactory):
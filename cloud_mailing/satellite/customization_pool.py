@@ -0,0 +1,186 @@
+# Copyright 2015-2019 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Pool of worker processes used to customize emails.
+
+Jinja rendering, MIME generation and DKIM signing are CPU bound, so customizing in the reactor threadpool is
+limited to one core by the GIL. When `customization_processes` is set in the [MAILING] section of the config file,
+recipients are sent by batches to worker processes. Each worker holds its own compiled mailings cache and returns
+the Message-ID and the path of the customized files. The ids of the active mailings are sent with each batch, so
+workers can forget the mailings closed since then.
+"""
+
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from mogo import connect
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+
+from ..common import settings
+from .db_thread import deferToDb
+from .mail_customizer import MailCustomizer
+from .models import Mailing, MailingRecipient
+
+__author__ = 'ricard'
+
+log = logging.getLogger("mailing")
+
+BATCH_SIZE = 10  # recipients count sent at once to a worker
+
+__customization_pool = None
+
+
+def get_customization_pool():
+    """
+    Returns the customization process pool, or None if customization should be done in threads.
+    """
+    global __customization_pool
+    if __customization_pool is None and settings.CUSTOMIZATION_PROCESSES > 0:
+        log.info("Starting %d customization processes", settings.CUSTOMIZATION_PROCESSES)
+        __customization_pool = ProcessPoolExecutor(max_workers=settings.CUSTOMIZATION_PROCESSES,
+                                                   mp_context=multiprocessing.get_context('spawn'),
+                                                   initializer=_init_worker,
+                                                   initargs=(settings.SATELLITE_DATABASE,
+                                                             settings.SATELLITE_DATABASE_URI))
+        reactor.addSystemEventTrigger('before', 'shutdown', stop_customization_pool)
+    return __customization_pool
+
+
+def stop_customization_pool():
+    global __customization_pool
+    if __customization_pool:
+        __customization_pool.shutdown(wait=False)
+        __customization_pool = None
+
+
+def _deferred_from_future(future):
+    """Returns a Deferred fired in the reactor thread when the future is done."""
+    d = defer.Deferred()
+
+    def _done(f):
+        ex = f.exception()
+        if ex is not None:
+            reactor.callFromThread(d.errback, Failure(ex))
+        else:
+            reactor.callFromThread(d.callback, f.result())
+
+    future.add_done_callback(_done)
+    return d
+
+
+def customize_recipients(pool, recipients, in_memory=False):
+    """
+    Customizes recipients using the process pool.
+
+    @param pool: the pool returned by L{get_customization_pool}
+    @param recipients: list of L{MailingRecipient}
+    @param in_memory: if True, customized emails are returned as bytes instead of being written on disk.
+    @return: a Deferred fired with a dictionary mapping each recipient id to a tuple (Message-ID, path or bytes), or
+        to the exception raised by its customization.
+    """
+    by_mailing = {}
+    for recipient in recipients:
+        by_mailing.setdefault(recipient['mailing'].id, []).append(dict(recipient))
+    d = deferToDb(_get_modification_dates)
+    d.addCallback(_submit_batches, pool, by_mailing, in_memory)
+    return d
+
+
+def _get_modification_dates():
+    """Returns the modification date of each active mailing. Executed by the database thread."""
+    return {m['_id']: m.get('modified') for m in Mailing._get_collection().find(projection=('modified',))}
+
+
+def _submit_batches(modified, pool, by_mailing, in_memory):
+    # The worker reloads its mailing content only if the mailing has been modified since the last time
+    l = []
+    active_ids = list(modified)
+    for mailing_id, recipient_docs in by_mailing.items():
+        for i in range(0, len(recipient_docs), BATCH_SIZE):
+            batch = recipient_docs[i:i + BATCH_SIZE]
+            d = _deferred_from_future(pool.submit(_customize_batch, mailing_id, modified.get(mailing_id), batch,
+                                                   in_memory, active_ids))
+            d.addErrback(_eb_batch, [doc['_id'] for doc in batch])
+            l.append(d)
+
+    def _merge_results(results):
+        customized = {}
+        for success, value in results:
+            customized.update(value)
+        return customized
+
+    return defer.DeferredList(l).addCallback(_merge_results)
+
+
+def _eb_batch(err, recipient_ids):
+    log.error("Customization batch failed: %s", err.value)
+    return dict.fromkeys(recipient_ids, err.value)
+
+
+# Worker side
+
+_mailings = {}  # key = mailing__id, value = Mailing
+
+
+def _init_worker(db_name, db_uri):
+    connect(db_name, uri=db_uri)
+
+
+def _evict_closed_mailings(active_ids):
+    """Forgets the mailings which are no longer active, and their MailCustomizer caches."""
+    active_ids = set(active_ids)
+    for mailing_id in [m_id for m_id in _mailings if m_id not in active_ids]:
+        del _mailings[mailing_id]
+        MailCustomizer.invalidate_mailing_body(mailing_id)
+
+
+def _get_mailing(mailing_id, modified):
+    mailing = _mailings.get(mailing_id)
+    if mailing is None or mailing.modified != modified:
+        MailCustomizer.invalidate_mailing_body(mailing_id)
+        mailing = Mailing.grab(mailing_id)
+        _mailings[mailing_id] = mailing
+    return mailing
+
+
+def _customize_batch(mailing_id, modified, recipient_docs, in_memory=False, active_ids=None):
+    """
+    Customizes a batch of recipients from the same mailing. Executed by worker processes.
+
+    @param active_ids: if not None, ids of the active mailings. Other mailings are removed from worker caches.
+    """
+    results = {}
+    if active_ids is not None:
+        _evict_closed_mailings(active_ids)
+    mailing = _get_mailing(mailing_id, modified)
+    for doc in recipient_docs:
+        recipient = MailingRecipient(**doc)
+        try:
+            if mailing is None:
+                raise ValueError("Mailing [%d] not found" % mailing_id)
+            customizer = MailCustomizer(recipient, mailing.read_tracking, mailing.click_tracking,
+                                        mailing.url_encoding, mailing=mailing)
+            if in_memory:
+                results[recipient.id] = customizer.customize_in_memory()
+            else:
+                results[recipient.id] = customizer.customize()
+        except Exception as ex:
+            results[recipient.id] = ex
+    return results
@@ -0,0 +1,127 @@
+# Copyright 2015-2019 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from datetime import datetime
+
+import pymongo
+
+from ..common import settings
+from ..common.db_common import create_index
+
+__author__ = 'Cedric RICARD'
+
+
+# Increment this version each time indexes definitions change.
+INDEXES_VERSION = 1
+
+# (collection, keys, name)
+indexes = [
+    # Queue selection: equality fields, then sort field, then ranges ($in / $or)
+    ('mailingrecipient', [('finished', pymongo.ASCENDING), ('send_status', pymongo.ASCENDING),
+                          ('next_try', pymongo.ASCENDING), ('mailing.$id', pymongo.ASCENDING),
+                          ('in_progress', pymongo.ASCENDING)], 'queue_selection'),
+    # Recipients counts and reports
+    ('mailingrecipient', [('in_progress', pymongo.ASCENDING), ('finished', pymongo.ASCENDING)], 'in_progress_finished'),
+    # Mailing closing
+    ('mailingrecipient', [('mailing.$id', pymongo.ASCENDING), ('in_progress', pymongo.ASCENDING),
+                          ('finished', pymongo.ASCENDING)], 'mailing'),
+    # Statistics upserts
+    ('hourlystats', [('epoch_hour', pymongo.ASCENDING)], 'epoch_hour'),
+    ('domainstats', [('domain_name', pymongo.ASCENDING)], 'domain_name'),
+]
+
+# (collection, name) of indexes replaced by the ones above
+obsolete_indexes = [
+    ('mailingrecipient', 'next_try_1'),
+]
+
+
+def init_satellite_db(db):
+    if settings.LIVE_STATS_CAPPED_SIZE > 0:
+        if 'live_stats' not in db.collection_names():
+            db.create_collection("live_stats", capped=True, size=settings.LIVE_STATS_CAPPED_SIZE)
+    else:
+        create_index(db.live_stats, [('date', pymongo.ASCENDING)], 'date_expiration',
+                     expireAfterSeconds=settings.LIVE_STATS_TTL)
+    # 'live_stats2' is not fed anymore: it can be dropped
+    update_indexes(db)
+
+
+def update_indexes(db):
+    """Creates indexes and drops obsolete ones, once per indexes version."""
+    log = logging.getLogger('migrations')
+    name = 'indexes_v%d' % INDEXES_VERSION
+    if db['_migrations'].find_one({'name': name}):
+        return
+    log.info("Updating indexes to version %d...", INDEXES_VERSION)
+    for collection, keys, index_name in indexes:
+        create_index(db[collection], keys, index_name)
+    for collection, index_name in obsolete_indexes:
+        if index_name in db[collection].index_information():
+            db[collection].drop_index(index_name)
+    db['_migrations'].insert_one({'name': name, 'applied': datetime.now()})
+
+
+def get_hot_queries(queue_filter):
+    """
+    Returns the queries periodically run by the satellite.
+
+    @param queue_filter: the recipients selection filter (see L{MailingSender.make_queue_filter})
+    @return: list of (name, collection, filter, sort)
+    """
+    return [
+        ('queue selection', 'mailingrecipient', queue_filter, [('next_try', pymongo.ASCENDING)]),
+        ('in progress count', 'mailingrecipient', {'in_progress': True}, None),
+        ('queue count', 'mailingrecipient', {'finished': False}, None),
+        ('to report count', 'mailingrecipient', {'finished': True}, None),
+        ('finished recipients', 'mailingrecipient', {'in_progress': False, 'finished': True}, None),
+    ]
+
+
+def _get_stages(plan):
+    stages = [plan['stage']]
+    if 'inputStage' in plan:
+        stages.extend(_get_stages(plan['inputStage']))
+    for input_stage in plan.get('inputStages', []):
+        stages.extend(_get_stages(input_stage))
+    return stages
+
+
+def _get_index_names(plan):
+    if 'indexName' in plan:
+        yield plan['indexName']
+    if 'inputStage' in plan:
+        yield from _get_index_names(plan['inputStage'])
+    for input_stage in plan.get('inputStages', []):
+        yield from _get_index_names(input_stage)
+
+
+def explain_hot_queries(db, queue_filter):
+    """
+    Runs `explain()` on each hot query.
+
+    @return: list of (query name, winning plan stages, index names)
+    """
+    results = []
+    for name, collection, _filter, sort in get_hot_queries(queue_filter):
+        cursor = db[collection].find(_filter)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        results.append((name, _get_stages(plan), sorted(set(_get_index_names(plan)))))
+    return results
@@ -0,0 +1,58 @@
+# Copyright 2015-2019 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Dedicated thread running the blocking (pymongo / mogo) requests of the satellite, so the reactor never waits for the
+database. Requests are run one after the other, in submission order.
+
+Recipients updates and statistics counters made when deliveries end (in the reactor thread) are only kept in memory by
+L{WriteBehind} and L{StatsCounters}, then flushed from this thread. Setting `write_behind_delay` or `stats_flush_delay`
+to 0 disables them, so these writes are synchronous again.
+"""
+
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python import threadpool
+
+__author__ = 'Cedric RICARD'
+
+__db_threadpool = None
+
+
+def get_db_threadpool():
+    global __db_threadpool
+    if __db_threadpool is None:
+        __db_threadpool = threadpool.ThreadPool(1, 1, "cm.satellite_db")
+        __db_threadpool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', stop_db_threadpool)
+    return __db_threadpool
+
+
+def stop_db_threadpool():
+    global __db_threadpool
+    if __db_threadpool:
+        __db_threadpool.stop()
+        __db_threadpool = None
+
+
+def deferToDb(f, *args, **kwargs):
+    """
+    Runs `f(*args, **kwargs)` in the database thread.
+
+    @return: a Deferred fired (in the reactor thread) with the result of `f`
+    """
+    return deferToThreadPool(reactor, get_db_threadpool(), f, *args, **kwargs)
@@ -0,0 +1,236 @@
+# Copyright 2015-2019 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+DKIM and Feedback-ID signatures of customized emails.
+
+Compared to calling `dkim.sign()` for each email, the L{DkimSigner}:
+ - parses each private key only once (keys are cached by domain and selector),
+ - parses the customized message only once, even if it is signed twice (DKIM + Feedback Loop),
+ - reuses the last body hash of a mailing when the body is identical (non personalised body),
+ - computes RSA signatures with OpenSSL (through `cryptography`) when available, instead of the pure python
+   implementation of dkimpy.
+"""
+
+import base64
+import logging
+import threading
+import time
+
+import dkim
+from dkim.canonicalization import CanonicalizationPolicy
+from dkim.crypto import HASH_ALGORITHMS, parse_pem_private_key, UnparsableKeyError
+
+from ..common.encoding import force_bytes
+
+try:
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa, utils
+    _RSA_HASHES = {b'rsa-sha256': hashes.SHA256, b'rsa-sha1': hashes.SHA1}
+except ImportError:
+    rsa = None
+
+__author__ = 'ricard'
+
+
+class _Message(dkim.DKIM):
+    """
+    DKIM message signed with an already parsed private key.
+
+    Body hashes are computed only once per canonicalization and algorithm.
+    """
+    def __init__(self, message, logger=None):
+        dkim.DKIM.__init__(self, message, logger=logger)
+        self.body_hashes = {}  # key = (body canonicalization, algorithm), value = (body hash, body length)
+
+    def get_body_hash(self, canon_policy, body_cache=None):
+        key = (canon_policy.to_c_value().split(b'/')[-1], self.signature_algorithm)
+        if key not in self.body_hashes:
+            if body_cache is not None:
+                cached = body_cache.get(key)
+                if cached is not None and cached[0] == self.body:
+                    self.body_hashes[key] = cached[1]
+                    return cached[1]
+            body = canon_policy.canonicalize_body(self.body)
+            h = HASH_ALGORITHMS[self.signature_algorithm]()
+            h.update(body)
+            self.body_hashes[key] = (base64.b64encode(h.digest()), len(body))
+            if body_cache is not None:
+                body_cache[key] = (self.body, self.body_hashes[key])
+        return self.body_hashes[key]
+
+    def sign_with_key(self, selector, domain, pk, signature_algorithm=b'rsa-sha256',
+                      canonicalize=(b'relaxed', b'simple'), include_headers=None, length=False, body_cache=None):
+        """Same as L{dkim.DKIM.sign} but with a parsed private key."""
+        self.signature_algorithm = signature_algorithm
+        canon_policy = CanonicalizationPolicy.from_c_value(b'/'.join(canonicalize))
+
+        if include_headers is None:
+            include_headers = self.default_sign_headers()
+        include_headers = tuple([x.lower() for x in include_headers])
+        self.include_headers = include_headers
+
+        if b'from' not in include_headers:
+            raise dkim.ParameterError("The From header field MUST be signed")
+        for x in set(include_headers).intersection(self.should_not_sign):
+            raise dkim.ParameterError("The %s header field SHOULD NOT be signed" % x)
+
+        self.hasher = HASH_ALGORITHMS[self.signature_algorithm]
+        bodyhash, body_length = self.get_body_hash(canon_policy, body_cache)
+
+        sigfields = [x for x in [
+            (b'v', b"1"),
+            (b'a', self.signature_algorithm),
+            (b'c', canon_policy.to_c_value()),
+            (b'd', domain),
+            (b'i', b"@" + domain),
+            length and (b'l', str(body_length).encode('ascii')),
+            (b'q', b"dns/txt"),
+            (b's', selector),
+            (b't', str(int(time.time())).encode('ascii')),
+            (b'h', b" : ".join(include_headers)),
+            (b'bh', bodyhash),
+            (b'b', b'0' * 60),
+        ] if x]
+
+        res = self.gen_header(sigfields, include_headers, canon_policy, b"DKIM-Signature", pk)
+        self.domain = domain
+        self.selector = selector
+        self.signature_fields = dict(sigfields)
+        return b'DKIM-Signature: ' + res
+
+    def gen_header(self, fields, include_headers, canon_policy, header_name, pk, standardize=False):
+        if rsa is None or not isinstance(pk, rsa.RSAPrivateKey):
+            return dkim.DKIM.gen_header(self, fields, include_headers, canon_policy, header_name, pk, standardize)
+        # Same as dkim.DKIM.gen_header() but the digest is signed by OpenSSL
+        header_value = b"; ".join(b"=".join(x) for x in fields)
+        header_value = dkim.fold(header_value, namelen=len(header_name), linesep=b'\r\n')
+        header_value = dkim.RE_BTAG.sub(b'\\1', header_value)
+        h = self.hasher()
+        headers = canon_policy.canonicalize_headers(self.headers)
+        self.signed_headers = dkim.hash_headers(h, canon_policy, headers, include_headers,
+                                                (header_name, b' ' + header_value), dict(fields))
+        sig = pk.sign(h.digest(), padding.PKCS1v15(), utils.Prehashed(_RSA_HASHES[self.signature_algorithm]()))
+        idx = [i for i in range(len(fields)) if fields[i][0] == b'b'][0]
+        fields[idx] = (b'b', base64.b64encode(sig))
+        header_value = b"; ".join(b"=".join(x) for x in fields) + self.linesep
+        return dkim.fold(header_value, namelen=len(header_name), linesep=self.linesep)
+
+    def add_header(self, name, value):
+        """Prepends a header, as if it was in the parsed message."""
+        self.headers.insert(0, [name, value])
+
+
+class DkimSigner(object):
+    """
+    Adds DKIM and Feedback Loop signatures to customized emails of a mailing.
+    """
+    privateKeys = {}  # key = (domain, selector, privkey), value = parsed private key
+    bodyHashes = {}  # key = (mailing__id, signer name), value = {(canonicalization, algorithm): (body, body hash)}
+    _keysLock = threading.Lock()
+
+    def __init__(self, mailing, logger=None):
+        self.mailing = mailing
+        self.log = logger or logging.getLogger('dkim')
+        self.dkim_settings = mailing.get('dkim', None)
+        if self.dkim_settings and not self.dkim_settings.get('enabled', True):
+            self.dkim_settings = None
+        self.fbl_settings = None
+        self.fbl_header = None
+        fbl_settings = mailing.get('feedback_loop', None) or {}
+        if fbl_settings.get('dkim') and fbl_settings.get('sender_id'):
+            self.fbl_settings = fbl_settings['dkim']
+            campaign_id = fbl_settings.get('campaign_id', mailing.id)
+            customer_id = fbl_settings.get('customer_id', mailing.domain_name)
+            mail_type_id = fbl_settings.get('mail_type_id', mailing.type)
+            self.fbl_header = 'Feedback-ID: %s:%s:%s:%s\n' % (campaign_id, customer_id, mail_type_id,
+                                                              fbl_settings['sender_id'])
+
+    @property
+    def enabled(self):
+        return bool(self.dkim_settings or self.fbl_settings)
+
+    @staticmethod
+    def invalidate_mailing(mailing_id):
+        """Forget the body hashes of a mailing."""
+        DkimSigner.bodyHashes.pop((mailing_id, 'dkim'), None)
+        DkimSigner.bodyHashes.pop((mailing_id, 'fbl'), None)
+
+    @staticmethod
+    def get_private_key(domain, selector, privkey, signature_algorithm=b'rsa-sha256'):
+        """Returns the parsed private key, parsing it only on first use."""
+        key = (domain, selector, privkey)
+        pk = DkimSigner.privateKeys.get(key)
+        if pk is None:
+            if signature_algorithm == b'ed25519-sha256':
+                try:
+                    import nacl.signing
+                    import nacl.encoding
+                except ImportError:
+                    raise dkim.NaClNotFoundError('pynacl module required for ed25519 signing')
+                pk = nacl.signing.SigningKey(privkey, encoder=nacl.encoding.Base64Encoder)
+            elif rsa is not None:
+                try:
+                    pk = serialization.load_pem_private_key(privkey, password=None)
+                except ValueError as e:
+                    raise dkim.KeyFormatError(str(e))
+            else:
+                try:
+                    pk = parse_pem_private_key(privkey)
+                except UnparsableKeyError as e:
+                    raise dkim.KeyFormatError(str(e))
+            with DkimSigner._keysLock:
+                pk = DkimSigner.privateKeys.setdefault(key, pk)
+        return pk
+
+    def _sign(self, message, settings, name, include_headers):
+        signature_algorithm = settings.get('signature_algorithm', 'rsa-sha256').encode()
+        domain = settings['domain'].encode()
+        selector = settings['selector'].encode()
+        pk = self.get_private_key(domain, selector, settings['privkey'].encode(), signature_algorithm)
+        sig = message.sign_with_key(selector, domain, pk,
+                                    signature_algorithm=signature_algorithm,
+                                    canonicalize=tuple(map(force_bytes, settings.get('canonicalize', (b'relaxed', b'simple')))),
+                                    include_headers=include_headers,
+                                    length=settings.get('length', False),
+                                    body_cache=DkimSigner.bodyHashes.setdefault((self.mailing.id, name), {}))
+        return sig
+
+    def sign(self, flattened_message):
+        """
+        Signs the message with the mailing DKIM settings, then adds the Feedback-ID header and signs it with the
+        feedback loop DKIM settings.
+
+        @param flattened_message: the customized email, as a string with '\\n' line endings
+        @return: the signed email
+        """
+        if not self.enabled:
+            return flattened_message
+        message = _Message(flattened_message.encode(), logger=self.log)
+        header = ''
+        if self.dkim_settings:
+            include_headers = list(map(force_bytes, self.dkim_settings.get('include_headers', []))) or None
+            sig = self._sign(message, self.dkim_settings, 'dkim', include_headers)
+            message.add_header(b'DKIM-Signature', sig[len(b'DKIM-Signature:'):])
+            header = sig.replace(b'\r\n', b'\n').decode()
+        if self.fbl_settings:
+            message.add_header(b'Feedback-ID', self.fbl_header[len('Feedback-ID:'):-1].encode() + b'\r\n')
+            include_headers = list(map(force_bytes, self.fbl_settings.get('include_headers', message.default_sign_headers()))) \
+                              + [b'Feedback-ID']
+            sig = self._sign(message, self.fbl_settings, 'fbl', include_headers)
+            header = sig.replace(b'\r\n', b'\n').decode() + self.fbl_header + header
+        return header + flattened_message
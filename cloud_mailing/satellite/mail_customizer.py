@@ -28,10 +28,10 @@ import logging
 import os
 import re
 import threading
+import uuid
 import urllib.request, urllib.parse, urllib.error
 from email.message import EmailMessage
 
-import dkim
 import jinja2
 from jinja2 import nodes
 from jinja2.ext import Extension
@@ -39,6 +39,7 @@ from jinja2.ext import Extension
 import sys
 print(sys.path)
 from ..common.encoding import force_bytes, force_str
+from .dkim_signer import DkimSigner
 from .models import MailingRecipient
 from ..common import settings
 from ..common.email_tools import header_to_unicode
@@ -50,15 +51,24 @@ class MailCustomizer:
     """Customize the mailing email to a recipient, then save it to a folder."""
 
     mailingsContent = {} # key = mailing__id, value = email.message.EmailMessage
+    mailingsVersion = {}  # key = mailing__id, value = number of invalidations (see InMemoryContent)
+    compiledMailings = {}  # key = mailing__id, value = CompiledMailing
     _parserLock = threading.Lock()
+    templatesCache = {}  # key = mailing__id, value = dict(key = (body, is_html, click_tracking, url_encoding), value = jinja2.Template)
+    _templatesLock = threading.Lock()
+    removed_headers = ('Subject', 'Received', 'To', 'From', 'User-Agent', 'Date', 'Message-ID', 'List-Unsubscribe',
+                       'DKIM-Signature', 'Authentication-Results', 'Received-SPF', 'X-Received',
+                       'Delivered-To', 'Feedback-ID', 'Precedence', 'Return-Path')
     re_links = re.compile(r"(<a [^>]*href\s*=\s*['\"])(https?://[^'\"]*)(['\"])")
 
-    def __init__(self, recipient, read_tracking=True, click_tracking=False, url_encoding=None):
+    def __init__(self, recipient, read_tracking=True, click_tracking=False, url_encoding=None, mailing=None,
+                 shared=False):
         assert(isinstance(recipient, MailingRecipient))
 
         self.recipient = recipient
-        self.unsubscribe_url = self.make_unsubscribe_url(recipient.mailing.tracking_url, recipient.tracking_id)
-        self.tracking_url = self.make_tracking_url(recipient.mailing.tracking_url, recipient.tracking_id)
+        self.mailing = mailing or recipient.mailing  # each access to recipient.mailing makes a db query
+        self.unsubscribe_url = self.make_unsubscribe_url(self.mailing.tracking_url, recipient.tracking_id)
+        self.tracking_url = self.make_tracking_url(self.mailing.tracking_url, recipient.tracking_id)
         self.log = logging.getLogger("mailing")
         self.temp_path = settings.MAIL_TEMP
         if not os.path.exists(settings.MAIL_TEMP):
@@ -66,6 +76,7 @@ class MailCustomizer:
         self.read_tracking = read_tracking
         self.click_tracking = click_tracking
         self.url_encoding = url_encoding
+        self.shared = shared  # if True, the email is built for several recipients at once (see is_shareable())
 
     @staticmethod
     def make_original_file_name(mailing_id):
@@ -103,22 +114,47 @@ class MailCustomizer:
                                             'sha1': contact_sha1,
         }
 
+    @staticmethod
+    def invalidate_mailing_body(mailing_id):
+        """Forget the parsed content, the compiled templates and the DKIM body hashes of a mailing."""
+        with MailCustomizer._parserLock:
+            MailCustomizer.mailingsContent.pop(mailing_id, None)
+            MailCustomizer.compiledMailings.pop(mailing_id, None)
+            MailCustomizer.mailingsVersion[mailing_id] = MailCustomizer.mailingsVersion.get(mailing_id, 0) + 1
+        with MailCustomizer._templatesLock:
+            MailCustomizer.templatesCache.pop(mailing_id, None)
+        DkimSigner.invalidate_mailing(mailing_id)
+
+    def _get_template(self, body, is_html=False):
+        """Returns the compiled template for this body part.
+
+        Templates are compiled only once per mailing, so only the rendering is done for each recipient.
+        """
+        key = (body, is_html, is_html and self.click_tracking, self.url_encoding)
+        templates = MailCustomizer.templatesCache.get(self.mailing.id)
+        template = templates and templates.get(key)
+        if template is None:
+            source = body.replace(r"%7B%7B%20unsubscribe%20%7D%7D", r"{{ unsubscribe }}")
+            source = source.replace(r"%7B%7Bunsubscribe%7D%7D", r"{{ unsubscribe }}")
+            if is_html and self.click_tracking:
+                output_link = r"\1{{ _tracking_url }}?"
+                if self.url_encoding == 'base64':
+                    output_link += 'c=b64&'
+                source = self.re_links.sub(output_link + r"o={{ '\2'|url_encode }}&t={% click %}\2{% endclick %}\3", source)
+            template = jinja2.Template(source, extensions=['jinja2.ext.with_', ClickExtension])
+            with MailCustomizer._templatesLock:
+                template = MailCustomizer.templatesCache.setdefault(self.mailing.id, {}).setdefault(key, template)
+        return template
+
     def _do_customization(self, body, contact_data, is_html=False):
-        body = body.replace(r"%7B%7B%20unsubscribe%20%7D%7D", r"{{ unsubscribe }}")
-        body = body.replace(r"%7B%7Bunsubscribe%7D%7D", r"{{ unsubscribe }}")
-        if is_html and self.click_tracking:
-            output_link = r"\1{{ _tracking_url }}?"
-            if self.url_encoding == 'base64':
-                output_link += 'c=b64&'
-            body = self.re_links.sub(output_link + r"o={{ '\2'|url_encode }}&t={% click %}\2{% endclick %}\3", body)
         context = {
             'UNSUBSCRIBE': self.unsubscribe_url,
             'unsubscribe': self.unsubscribe_url,
-            '_tracking_url': self.make_clic_url(self.recipient.mailing.tracking_url, self.recipient.tracking_id),
+            '_tracking_url': self.make_clic_url(self.mailing.tracking_url, self.recipient.tracking_id),
             '_url_encoding': self.url_encoding,
         }
         context.update(contact_data)
-        template = jinja2.Template(body, extensions=['jinja2.ext.with_', ClickExtension])
+        template = self._get_template(body, is_html)
         if is_html and self.read_tracking:
             tracking_img = '<img src="%s" border="0" alt="" width="1" height="1" />\n' % self.tracking_url
         else:
@@ -192,14 +228,28 @@ class MailCustomizer:
             contact_data = {'email': str(recipient.email)}
         return contact_data
 
-    def _run_customizer(self):
+    def _run_customizer(self, memory_budget=None):
         """Executes the entire process of customize a mailing for a recipient
         and returns its full path.
 
+        If a L{MemoryBudget} is given, the customized email is kept in memory (as an L{InMemoryContent}) if the
+        budget allows it.
+
         This may take some time and shouldn't be run from the reactor thread.
         """
+        message_id, content = self.customize_in_memory()
+        if isinstance(content, bytes):
+            content = MailCustomizer.store_content(self.mailing, self.recipient.id, content, memory_budget)
+        return message_id, content
+
+    def customize_in_memory(self):
+        """Customizes the email without storing it.
+
+        Returns a tuple (Message-ID, content) where content is the customized email as bytes, or the path of the
+        customized email if it was already on disk.
+        """
         try:
-            fullpath = os.path.join(self.temp_path, MailCustomizer.make_file_name(self.recipient.mailing.id, self.recipient.id))
+            fullpath = os.path.join(self.temp_path, MailCustomizer.make_file_name(self.mailing.id, self.recipient.id))
             if os.path.exists(fullpath):
                 self.log.debug("Customized email found here: %s", fullpath)
                 parser = email.parser.Parser(policy=email.policy.default)
@@ -207,185 +257,306 @@ class MailCustomizer:
                     header = parser.parse(fd, headersonly=True)
                     return header['Message-ID'], fullpath
             contact_data = self.make_contact_data_dict(self.recipient)
-            message = self._parse_message()
             assert(isinstance(contact_data, dict))
-            assert(isinstance(message, EmailMessage))
-            #email.iterators._structure(message)
-
-            mixed_attachments=[]
-            related_attachments=[]
-            for attachment in contact_data.get('attachments', []):
-                if 'content-id' in attachment:
-                    related_attachments.append(attachment)
+            if contact_data.get('attachments'):
+                # Recipient's attachments change the MIME structure, so the compiled mailing can't be used.
+                message = self._make_customized_message(contact_data)
+                fp = io.StringIO()
+                generator = email.generator.Generator(fp, mangle_from_=False)
+                generator.flatten(message)
+                flattened_message = fp.getvalue()
+            else:
+                flattened_message = self._get_compiled_mailing().customize(self, contact_data)
+            flattened_message = DkimSigner(self.mailing, self.log).sign(flattened_message)
+            return self.make_message_id(), flattened_message.encode()
+
+        except Exception:
+            self.log.exception("Failed to customize mailing '%s' for recipient '%s'" % (self.recipient.mail_from, self.recipient.email))
+            raise
+
+    @staticmethod
+    def store_content(mailing, recipient_id, data, memory_budget=None):
+        """Keeps the customized email in memory if the budget allows it, else writes it into the temp folder.
+
+        Emails of mailings with `backup_customized_emails` set are always written on disk.
+
+        @return: an L{InMemoryContent} or the full path of the customized email
+        """
+        if memory_budget is not None and not mailing.backup_customized_emails and memory_budget.reserve(len(data)):
+            return InMemoryContent(mailing.id, data, memory_budget)
+        fullpath = os.path.join(settings.MAIL_TEMP, MailCustomizer.make_file_name(mailing.id, recipient_id))
+        with open(fullpath+'.tmp', 'wb') as fp:
+            fp.write(data)
+        if os.path.exists(fullpath):
+            os.remove(fullpath)
+        os.rename(fullpath+'.tmp', fullpath)
+        return fullpath
+
+    def _make_customized_message(self, contact_data):
+        """Customizes the whole mailing message for the recipient and returns it.
+
+        This is the slow path, only used when the recipient has its own attachments.
+        """
+        message = self._parse_message()
+        assert(isinstance(message, EmailMessage))
+        #email.iterators._structure(message)
+
+        mixed_attachments=[]
+        related_attachments=[]
+        for attachment in contact_data.get('attachments', []):
+            if 'content-id' in attachment:
+                related_attachments.append(attachment)
+            else:
+                mixed_attachments.append(attachment)
+
+        #bodies = MailingBody.objects.filter(relay = self.recipient.mailing_queue).order_by('header_pos')
+        def convert_to_mixed(part, mixed_attachments, subtype):
+            import email.mime.multipart
+
+            part2 = email.mime.multipart.MIMEMultipart(_subtype=subtype)
+            part2.set_payload(part.get_payload())
+            del part['Content-Type']
+            part['Content-Type'] = 'multipart/mixed'
+            part.set_payload(None)
+            part.attach(part2)
+            for attachment in mixed_attachments:
+                part.attach(self._make_mime_part(attachment))
+
+        def personalise_bodies(part, mixed_attachments=[], related_attachments=[]):
+            import email.message
+            assert(isinstance(part, email.message.EmailMessage))
+            if part.is_multipart():
+                subtype = part.get_content_subtype()
+                if subtype == 'mixed':
+                    personalise_bodies(part.get_payload(0), related_attachments=related_attachments)
+                    for attachment in mixed_attachments:
+                        part.attach(self._make_mime_part(attachment))
+
+                elif subtype == 'alternative':
+                    for p in part.get_payload():
+                        personalise_bodies(p, related_attachments=related_attachments)
+                    if mixed_attachments:
+                        convert_to_mixed(part, mixed_attachments, subtype="alternative")
+
+                elif subtype == 'digest':
+                    raise email.errors.MessageParseError("multipart/digest not supported")
+
+                elif subtype == 'parallel':
+                    raise email.errors.MessageParseError("multipart/parallel not supported")
+
+                elif subtype == 'related':
+                    personalise_bodies(part.get_payload(0))
+                    for attachment in related_attachments:
+                        part.attach(self._make_mime_part(attachment))
+                    if mixed_attachments:
+                        convert_to_mixed(part, mixed_attachments, subtype="related")
+
                 else:
-                    mixed_attachments.append(attachment)
-
-            #bodies = MailingBody.objects.filter(relay = self.recipient.mailing_queue).order_by('header_pos')
-            def convert_to_mixed(part, mixed_attachments, subtype):
-                import email.mime.multipart
-
-                part2 = email.mime.multipart.MIMEMultipart(_subtype=subtype)
-                part2.set_payload(part.get_payload())
-                del part['Content-Type']
-                part['Content-Type'] = 'multipart/mixed'
-                part.set_payload(None)
-                part.attach(part2)
-                for attachment in mixed_attachments:
-                    part.attach(self._make_mime_part(attachment))
-
-            def personalise_bodies(part, mixed_attachments=[], related_attachments=[]):
-                import email.message
-                assert(isinstance(part, email.message.EmailMessage))
-                if part.is_multipart():
-                    subtype = part.get_content_subtype()
-                    if subtype == 'mixed':
-                        personalise_bodies(part.get_payload(0), related_attachments=related_attachments)
+                    self.log.warn("Unknown multipart subtype '%s'" % subtype)
+
+            else:
+                maintype = part.get_content_maintype()
+                if maintype == 'text':
+                    self._customize_message(part, contact_data)
+
+                    if mixed_attachments:
+                        import email.mime.text
+
+                        part2 = email.mime.text.MIMEText(part.get_payload(decode=True).decode())
+                        del part['Content-Type']
+                        part['Content-Type'] = 'multipart/mixed'
+                        part.set_payload(None)
+                        part.attach(part2)
                         for attachment in mixed_attachments:
                             part.attach(self._make_mime_part(attachment))
 
-                    elif subtype == 'alternative':
-                        for p in part.get_payload():
-                            personalise_bodies(p, related_attachments=related_attachments)
-                        if mixed_attachments:
-                            convert_to_mixed(part, mixed_attachments, subtype="alternative")
-
-                    elif subtype == 'digest':
-                        raise email.errors.MessageParseError("multipart/digest not supported")
+                else:
+                    self.log.warn("personalise_bodies(): can't handle '%s' parts" % part.get_content_type())
 
-                    elif subtype == 'parallel':
-                        raise email.errors.MessageParseError("multipart/parallel not supported")
+        personalise_bodies(message, mixed_attachments, related_attachments)
 
-                    elif subtype == 'related':
-                        personalise_bodies(part.get_payload(0))
-                        for attachment in related_attachments:
-                            part.attach(self._make_mime_part(attachment))
-                        if mixed_attachments:
-                            convert_to_mixed(part, mixed_attachments, subtype="related")
+        # Customize the subject
+        subject = self._do_customization(header_to_unicode('subject', message.get("Subject", "")), contact_data)
+        # Remove some headers
+        for header in MailCustomizer.removed_headers:
+            if header in message:
+                del message[header]
 
-                    else:
-                        self.log.warn("Unknown multipart subtype '%s'" % subtype)
+        self._add_recipient_headers(message, subject, contact_data)
+        return message
 
-                else:
-                    maintype = part.get_content_maintype()
-                    if maintype == 'text':
-                        self._customize_message(part, contact_data)
-
-                        if mixed_attachments:
-                            import email.mime.text
-
-                            part2 = email.mime.text.MIMEText(part.get_payload(decode=True).decode())
-                            del part['Content-Type']
-                            part['Content-Type'] = 'multipart/mixed'
-                            part.set_payload(None)
-                            part.attach(part2)
-                            for attachment in mixed_attachments:
-                                part.attach(self._make_mime_part(attachment))
-
-                    else:
-                        self.log.warn("personalise_bodies(): can't handle '%s' parts" % part.get_content_type())
-
-            personalise_bodies(message, mixed_attachments, related_attachments)
-
-            # Customize the subject
-            subject = self._do_customization(header_to_unicode('subject', message.get("Subject", "")), contact_data)
-            # Remove some headers
-            for header in ('Subject', 'Received', 'To', 'From', 'User-Agent', 'Date', 'Message-ID', 'List-Unsubscribe',
-                           'DKIM-Signature', 'Authentication-Results', 'Received-SPF', 'Received-SPF', 'X-Received',
-                           'Delivered-To', 'Feedback-ID', 'Precedence', 'Return-Path'):
-                if header in message:
-                    del message[header]
-
-            message['Subject'] = subject
-
-            # Adding missing headers
-            # message['Precedence'] = "bulk"
-            message['From'] = Address(self.recipient.sender_name, *self.recipient.mail_from.split('@'))
+    def is_shareable(self):
+        """
+        Returns True if the email is the same for all recipients of the mailing, so it can be customized only once
+        and sent to several recipients in a single SMTP transaction: no tracking, no personalisation and no
+        recipient's attachments.
+        """
+        if self.read_tracking or self.click_tracking or self.mailing.tracking_url or self.mailing.return_path_domain:
+            return False
+        if self.make_contact_data_dict(self.recipient).get('attachments'):
+            return False
+        return self._get_compiled_mailing().is_static()
+
+    def make_message_id(self):
+        # email.utils.make_msgid() is very very slow on certain circumstance
+        return "<%s.%d@cm.%s>" % (self.recipient.id, self.mailing.id, self.recipient.domain_name)
+
+    def _add_recipient_headers(self, message, subject, contact_data):
+        message['Subject'] = subject
+
+        # Adding missing headers
+        # message['Precedence'] = "bulk"
+        message['From'] = Address(self.recipient.sender_name, *self.recipient.mail_from.split('@'))
+        if self.shared:
+            message['To'] = 'undisclosed-recipients:;'
+        else:
             message['To'] = Address(('%s %s' % (contact_data.get('firstname', ''), contact_data.get('lastname', ''))).strip(),
                                     *contact_data['email'].split('@'))
-            message['Date'] = email.utils.formatdate()
-            # message['Message-ID'] = email.utils.make_msgid()  # very very slow on certain circumstance
-            message['Message-ID'] = "<%s.%d@cm.%s>" % (self.recipient.id, self.recipient.mailing.id, self.recipient.domain_name )
-            if self.unsubscribe_url:
-                message['List-Unsubscribe'] = self.unsubscribe_url
-
-            fp = io.StringIO()
-            generator = email.generator.Generator(fp, mangle_from_=False)
-            generator.flatten(message)
-            flattened_message = fp.getvalue()
-            flattened_message = self.add_dkim_signature(flattened_message)
-            flattened_message = self.add_fbl(flattened_message)
-
-            with open(fullpath+'.tmp', 'wt') as fp:
-                fp.write(flattened_message)
-                fp.close()
-            if os.path.exists(fullpath):
-                os.remove(fullpath)
-            os.rename(fullpath+'.tmp', fullpath)
-            return message['Message-ID'], fullpath
-
-        except Exception:
-            self.log.exception("Failed to customize mailing '%s' for recipient '%s'" % (self.recipient.mail_from, self.recipient.email))
-            raise
-
-    def add_dkim_signature(self, flattened_message):
-        sig = ''
-        dkim_settings = self.recipient.mailing.get('dkim', None)
-        if dkim_settings and dkim_settings.get('enabled', True):
-            sig = dkim.sign(flattened_message.encode(), dkim_settings['selector'].encode(), dkim_settings['domain'].encode(),
-                            dkim_settings['privkey'].encode(),
-                            canonicalize=map(force_bytes, dkim_settings.get('canonicalize', (b'relaxed', b'simple'))),
-                            signature_algorithm=dkim_settings.get('signature_algorithm', 'rsa-sha256').encode(),
-                            include_headers=list(map(force_bytes, dkim_settings.get('include_headers', []))) or None,
-                            length=dkim_settings.get('length', False),
-                            logger=self.log)
-            sig = sig.replace(b'\r\n', b'\n').decode()
-        return sig + flattened_message
-
-    def add_fbl(self, flattened_message):
-        sig = ''
-        mailing = self.recipient.mailing
-        fbl_settings = mailing.get('feedback_loop', {})
-        if not fbl_settings:
-            return flattened_message
-        dkim_settings = fbl_settings.get('dkim', None)
-        sender_id = fbl_settings.get('sender_id', None)
-        if dkim_settings and sender_id:
-            campaign_id = fbl_settings.get('campaign_id', mailing.id)
-            customer_id = fbl_settings.get('customer_id', mailing.domain_name)
-            mail_type_id = fbl_settings.get('mail_type_id', mailing.type)
-            fbl_header = 'Feedback-ID: %s:%s:%s:%s\n' % (campaign_id, customer_id, mail_type_id, sender_id)
-            flattened_message = fbl_header + flattened_message
-            d = dkim.DKIM(flattened_message.encode(),
-                          signature_algorithm=dkim_settings.get('signature_algorithm', 'rsa-sha256').encode(),
-                          logger=self.log)
-            sig = d.sign(dkim_settings['selector'].encode(), dkim_settings['domain'].encode(), dkim_settings['privkey'].encode(),
-                         canonicalize=map(force_bytes, dkim_settings.get('canonicalize', (b'relaxed', b'simple'))),
-                         include_headers=map(force_bytes, dkim_settings.get('include_headers', d.default_sign_headers()) + [b'Feedback-ID']),
-                         length=dkim_settings.get('length', False),
-                         )
-            sig = sig.replace(b'\r\n', b'\n').decode()  # sig is in unicode
-        return sig + flattened_message
+        message['Date'] = email.utils.formatdate()
+        message['Message-ID'] = self.make_message_id()
+        if self.unsubscribe_url:
+            message['List-Unsubscribe'] = self.unsubscribe_url
+
+    def _get_compiled_mailing(self):
+        compiled_mailing = MailCustomizer.compiledMailings.get(self.mailing.id)
+        if compiled_mailing is None:
+            compiled_mailing = CompiledMailing(self.mailing.get_message())
+            with MailCustomizer._parserLock:
+                compiled_mailing = MailCustomizer.compiledMailings.setdefault(self.mailing.id, compiled_mailing)
+        return compiled_mailing
 
     def _parse_message(self):
         MailCustomizer._parserLock.acquire()
         try:
-            result = MailCustomizer.mailingsContent.get(self.recipient.mailing.id, None)
+            result = MailCustomizer.mailingsContent.get(self.mailing.id, None)
             if result:
                 return pickle.loads(result)
             else:
-                result = self.recipient.mailing.get_message()
-                MailCustomizer.mailingsContent[self.recipient.mailing.id] = pickle.dumps(result)
+                result = self.mailing.get_message()
+                MailCustomizer.mailingsContent[self.mailing.id] = pickle.dumps(result)
             return result
         finally:
             MailCustomizer._parserLock.release()
 
-    def customize(self):
+    def customize(self, memory_budget=None):
         """Start the customization process. Returns a deferred.
         """
-        return self._run_customizer()
+        return self._run_customizer(memory_budget)
         #return deferToThread(self._run_customizer)
 
 
+class CompiledMailing:
+    """
+    Mailing content prepared once to be quickly customized for each recipient.
+
+    The mailing message is flattened only once. All its static content (headers, boundaries, attachments,
+    inline images, ...) is kept as text segments, and the only holes are the recipient headers and the
+    text parts which have to be personalised. So for each recipient, we only have to render these text
+    parts, encode them, then concatenate all segments.
+    """
+    re_part_placeholder = re.compile(r"\n@@CM_PART_([0-9a-f]{32})_(\d+)@@")
+
+    def __init__(self, message):
+        assert(isinstance(message, EmailMessage))
+        self.log = logging.getLogger("mailing")
+        self.subject = header_to_unicode('subject', message.get("Subject", ""))
+        for header in MailCustomizer.removed_headers:
+            if header in message:
+                del message[header]
+        self.policy = message.policy
+        self.parts = []  # list of (static headers, subtype, original body) for each personalised text part
+        self.segments = []  # static texts, personalised part indexes, or None for recipient headers
+        self._placeholder_key = uuid.uuid4().hex
+
+        if not message.is_multipart() and message.get_content_maintype() == 'text':
+            # The whole message is personalised, it will also contains recipient headers
+            self._compile_part(message)
+            self.segments.append(0)
+            return
+
+        message = self._compile_part(message)
+        fp = io.StringIO()
+        generator = email.generator.Generator(fp, mangle_from_=False)
+        generator.flatten(message)
+        headers, body = fp.getvalue().split('\n\n', 1)
+        self.segments.extend((headers + '\n', None))
+        body_segments = self.re_part_placeholder.split('\n' + body)
+        for i, segment in enumerate(body_segments):
+            if i % 3 == 0:
+                self.segments.append(segment)
+            elif i % 3 == 1:
+                assert(segment == self._placeholder_key)
+            else:
+                self.segments.append(int(segment))
+
+    def is_static(self):
+        """Returns True if neither the subject nor the text parts contain template tags or comments."""
+        texts = [self.subject] + [body for headers, subtype, body in self.parts]
+        return not any(tag in text for text in texts for tag in ('{{', '{%', '{#', '%7B%7B'))
+
+    def _compile_part(self, part):
+        """Replaces personalised text parts by placeholders, following the same rules than the full customization."""
+        if part.is_multipart():
+            subtype = part.get_content_subtype()
+            payload = part.get_payload()
+            if subtype in ('mixed', 'related'):
+                payload[0] = self._compile_part(payload[0])
+            elif subtype == 'alternative':
+                for i, p in enumerate(payload):
+                    payload[i] = self._compile_part(p)
+            elif subtype in ('digest', 'parallel'):
+                raise email.errors.MessageParseError("multipart/%s not supported" % subtype)
+            else:
+                self.log.warn("Unknown multipart subtype '%s'" % subtype)
+            return part
+
+        if part.get_content_maintype() != 'text':
+            self.log.warn("CompiledMailing: can't handle '%s' parts" % part.get_content_type())
+            return part
+
+        # Content headers will be set by the encoding of the personalised body
+        headers = [(name, value) for name, value in part.raw_items() if not name.lower().startswith('content-')]
+        self.parts.append((headers, part.get_content_subtype(), part.get_content()))
+        placeholder = EmailMessage(policy=self.policy)
+        placeholder.set_payload('@@CM_PART_%s_%d@@' % (self._placeholder_key, len(self.parts) - 1))
+        return placeholder
+
+    def _flatten(self, message):
+        fp = io.StringIO()
+        generator = email.generator.Generator(fp, mangle_from_=False)
+        generator.flatten(message)
+        return fp.getvalue()
+
+    def _make_part(self, index, customizer, contact_data):
+        headers, subtype, body = self.parts[index]
+        part = EmailMessage(policy=self.policy)
+        for name, value in headers:
+            part.set_raw(name, value)
+        part.set_content(customizer._do_customization(body, contact_data, subtype == 'html'), subtype)
+        return part
+
+    def customize(self, customizer, contact_data):
+        """Returns the flattened message customized for the recipient handled by this customizer."""
+        assert(isinstance(customizer, MailCustomizer))
+        subject = customizer._do_customization(self.subject, contact_data)
+        if self.segments == [0]:
+            message = self._make_part(0, customizer, contact_data)
+            customizer._add_recipient_headers(message, subject, contact_data)
+            return self._flatten(message)
+
+        recipient_headers = EmailMessage(policy=self.policy)
+        customizer._add_recipient_headers(recipient_headers, subject, contact_data)
+        output = []
+        for segment in self.segments:
+            if segment is None:
+                output.extend(self.policy.fold(name, value) for name, value in recipient_headers.raw_items())
+            elif isinstance(segment, int):
+                output.append(self._flatten(self._make_part(segment, customizer, contact_data)))
+            else:
+                output.append(segment)
+        return ''.join(output)
+
+
 
 
 class ClickExtension(Extension):
@@ -444,3 +615,55 @@ class ClickExtension(Extension):
             return force_str(base64.urlsafe_b64encode(s).strip(b'='))
         else:
             return urllib.parse.quote(s)
+
+
+class MemoryBudget(object):
+    """
+    Limits the memory used by customized emails kept in memory.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        """Returns True if `size` bytes can be used."""
+        with self._lock:
+            if self.used + size > self.size:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self._lock:
+            self.used -= size
+
+
+class InMemoryContent(object):
+    """
+    Customized email kept in memory, used instead of a temp file by the SMTP relayer.
+
+    The content becomes unavailable when the mailing is closed or its content changed (same as temp files which
+    are deleted in these cases).
+    """
+    def __init__(self, mailing_id, data, memory_budget):
+        self.mailing_id = mailing_id
+        self.data = data
+        self.memory_budget = memory_budget
+        self.version = MailCustomizer.mailingsVersion.get(mailing_id, 0)
+
+    def __len__(self):
+        return len(self.data) if self.data is not None else 0
+
+    def is_available(self):
+        return self.data is not None and self.version == MailCustomizer.mailingsVersion.get(self.mailing_id, 0)
+
+    def open(self):
+        """Returns a file-like object on the customized email."""
+        return io.BytesIO(self.data)
+
+    def release(self):
+        """Frees the memory once the email is sent."""
+        if self.data is not None:
+            self.memory_budget.release(len(self.data))
+            self.data = None
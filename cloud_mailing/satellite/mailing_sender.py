@@ -32,7 +32,7 @@ accepting mail for a small set of domains.
 The classes here are meant to facilitate support for such a configuration
 for the twisted.mail SMTP server
 """
-import pickle as pickle
+import heapq
 import logging
 import os
 import threading
@@ -41,7 +41,9 @@ from datetime import datetime
 from datetime import timedelta
 
 from bson import DBRef, ObjectId
+from pymongo.errors import BulkWriteError
 from twisted.internet import defer, task, reactor
+from twisted.internet.abstract import isIPAddress
 from twisted.internet import error #import DNSLookupError, TimeoutError, ConnectionLost, ConnectionRefusedError, ConnectError
 from twisted.internet.threads import deferToThread
 from twisted.mail import smtp
@@ -52,13 +54,17 @@ from twisted.spread.util import CallbackPageCollector
 from ..common.db_common import get_db
 from ..common.encoding import force_str
 from . import settings_vars
-from .mail_customizer import MailCustomizer
+from .customization_pool import get_customization_pool, customize_recipients
+from .db_thread import deferToDb
+from .mail_customizer import MailCustomizer, MemoryBudget, InMemoryContent
 from .models import Mailing, MailingRecipient, RECIPIENT_STATUS, HourlyStats, DomainStats, DomainConfiguration, \
-    ActiveQueue
-from .mx import MXCalculator, FakedMXCalculator
-from .sendmail import SMTPRelayerFactory
+    ActiveQueue, WriteBehind, StatsCounters, LiveStats, DomainNotations
+from .mx import MXCalculator, FakedMXCalculator, DnsCache, DnsPrefetcher
+from .rate_control import RateControl, THROTTLING_CODES
+from .sendmail import SMTPRelayerFactory, SMTPConnectionPool
 from ..common import settings
 from ..common.config_file import ConfigFile
+from ..common.wire_format import RecordsPageCollector, WireFormatError, decode_records
 
 
 class EmtpyFactory(Exception):
@@ -77,6 +83,61 @@ def getAllPages(referenceable, methodName, *args, **kw):
     return d
 
 
+class DomainPolicies(object):
+    """
+    Snapshot of domains sending policies, taken once per queue filling pass.
+
+    Loads domains configurations, active queues counts and domains notations with one query per collection, so
+    recipients selection doesn't need any query per recipient or per domain.
+    """
+    def __init__(self, max_messages_per_connection, queue_filter=None):
+        self.max_messages_per_connection = max_messages_per_connection
+        self.now = datetime.utcnow()
+        if queue_filter is not None:
+            DomainNotations.load(d.lower() for d in MailingRecipient._get_collection().distinct('domain_name',
+                                                                                                  queue_filter) if d)
+        self.configurations = dict((c['domain_name'], c) for c in DomainConfiguration._get_collection().find())
+        self.active_queues = dict((r['_id'], r['count']) for r in ActiveQueue._get_collection().aggregate([
+            {'$group': {'_id': '$domain_name', 'count': {'$sum': 1}}}
+        ]))
+        self.mapping_note_to_queue_size = settings_vars.get(settings_vars.DOMAINS_NOTATION)
+        self.default_max_relayers = settings_vars.get(settings_vars.DEFAULT_MAX_QUEUE_PER_DOMAIN)
+        self._max_recipients = {}
+
+    def get_notation(self, domain):
+        return DomainNotations.get(domain, self.now)
+
+    def get_max_recipients(self, domain):
+        """Returns the maximum recipients count for a queue of this domain, according to its notation."""
+        max_recipients = self._max_recipients.get(domain)
+        if max_recipients is None:
+            note = self.get_notation(domain)
+            max_recipients = self.max_messages_per_connection
+            for check, value in self.mapping_note_to_queue_size:
+                if note <= check:
+                    max_recipients = min(value, self.max_messages_per_connection)
+                    break
+            self._max_recipients[domain] = max_recipients
+        return max_recipients
+
+    def has_free_relayer(self, domain):
+        """
+        Returns True if a new queue can be started for this domain.
+
+        If `max_relayers` isn't configured for the domain, `cnx_per_mx` x `max_mx` is used if they are set. These
+        limits are upper bounds of the adaptive limit given by L{RateControl}, else the default one is its start value.
+        """
+        configuration = self.configurations.get(domain, {})
+        max_relayers = maximum = configuration.get('max_relayers')
+        if max_relayers is None:
+            if configuration.get('cnx_per_mx') and configuration.get('max_mx'):
+                max_relayers = maximum = configuration['cnx_per_mx'] * configuration['max_mx']
+            else:
+                max_relayers = self.default_max_relayers
+        max_relayers = RateControl.get_limit(domain, max_relayers, maximum)
+        return self.active_queues.get(domain, 0) < max_relayers
+
+
 class MailingSender(pb.Referenceable):
     """The CM mailing queue.
 
@@ -84,8 +145,10 @@ class MailingSender(pb.Referenceable):
     each connection's responsibility in term of messages. Create
     more relayers if the need arises.
 
-    Someone should press .checkState periodically
+    Queue filling passes are triggered by events (new recipients, new mailing content, relayer finished) through
+    L{wakeup}. Periodic checks are only a fallback.
     """
+    min_dispatch_interval = 1  # minimum delay (in seconds) between two queue filling passes
 
     def __init__(self, cloud_client, timer_delay=5, delay_if_empty=20, maxConnections=2):
         """
@@ -106,30 +169,80 @@ class MailingSender(pb.Referenceable):
         self.maxMessagesPerConnection = 100
         self.relay_manager = ActiveQueuesList(self.log)
         self.nextTime = 0
+        self.lastDispatch = 0
+        self._deadlines = []  # heap of wake up times
+        self._dispatch_call = None
+        self._wakeup_requested = False
         self.handlingQueueLock = threading.Lock()
         self.handling_get_mailing_next_time = 0
+        self.dns_cache = None
+        self.dns_prefetcher = None
         if settings.TEST_FAKE_DNS:
             Queue.mxcalc = FakedMXCalculator()
+        elif settings.DNS_CACHE:
+            from twisted.names.client import createResolver
+            self.dns_cache = DnsCache(createResolver(), max_entries=settings.DNS_CACHE_MAX_ENTRIES)
+            self.dns_cache.load(settings.DNS_CACHE_FILE)
+            reactor.addSystemEventTrigger('before', 'shutdown', self.dns_cache.save, settings.DNS_CACHE_FILE)
+            Queue.mxcalc = MXCalculator(self.dns_cache)
+            if settings.DNS_PREFETCH_CONCURRENCY > 0:
+                self.dns_prefetcher = DnsPrefetcher(Queue.mxcalc, settings.DNS_PREFETCH_CONCURRENCY)
         else:
             Queue.mxcalc = MXCalculator()
+        if settings.SMTP_POOL_IDLE_TIMEOUT > 0 and Queue.connection_pool is None:
+            Queue.connection_pool = SMTPConnectionPool(idle_timeout=settings.SMTP_POOL_IDLE_TIMEOUT,
+                                                       max_idle=settings.SMTP_POOL_MAX_IDLE)
+            reactor.addSystemEventTrigger('before', 'shutdown', Queue.connection_pool.close_all)
 
         self.is_connected = False
+        if settings.WRITE_BEHIND_DELAY > 0 and not WriteBehind.is_active():
+            WriteBehind.start(settings.WRITE_BEHIND_JOURNAL)
+            reactor.addSystemEventTrigger('before', 'shutdown', WriteBehind.stop)
+        if settings.STATS_FLUSH_DELAY > 0 and not StatsCounters.is_active():
+            StatsCounters.start()
+            reactor.addSystemEventTrigger('before', 'shutdown', StatsCounters.stop)
+        RateControl.configure(enabled=settings.RATE_CONTROL, max_window=settings.RATE_CONTROL_MAX_RELAYERS,
+                              min_backoff=settings.RATE_CONTROL_MIN_BACKOFF,
+                              max_backoff=settings.RATE_CONTROL_MAX_BACKOFF)
+        LiveStats.configure(enabled=settings.LIVE_STATS, sampling_rate=settings.LIVE_STATS_SAMPLING,
+                            batch_size=settings.LIVE_STATS_BATCH_SIZE if settings.LIVE_STATS_FLUSH_DELAY > 0 else 0)
+        if LiveStats.batch_size > 0:
+            reactor.addSystemEventTrigger('before', 'shutdown', LiveStats.flush)
         self.invalidate_all_mailing_content()
         self.delete_all_customized_temp_files()
         self.invalidate_all_recipients_and_reset_in_progress_status()
         self.tasks = []
 
     def start_tasks(self):
-        for fn, delay, startNow in ((self.check_mailing, self.timer_delay, False),
-                                    (self.remove_closed_mailings, 33600, False),
+        for fn, delay, startNow in ((self.check_mailing, self.delay_if_empty, False),  # fallback of wakeup()
+                                    (lambda: deferToDb(self.remove_closed_mailings), 33600, False),
                                     (self.relay_manager.check_for_zombie_queues, 60, False),
                                     (self.check_for_missing_mailing, 2, False),
                                     (self.send_report_for_finished_recipients, 20, False),
                                     (self.send_statistics, 30, False),
+                                    (DomainNotations.cleanup, 3600, False),
+                                    (RateControl.cleanup, 3600, False),
                                     ):
             t = task.LoopingCall(fn)
             t.start(delay, now=startNow)
             self.tasks.append(t)
+        if WriteBehind.is_active():
+            t = task.LoopingCall(deferToDb, WriteBehind.flush)
+            t.start(settings.WRITE_BEHIND_DELAY, now=False)
+            self.tasks.append(t)
+        if self.dns_cache:
+            for fn, args in ((self.dns_cache.cleanup, ()), (self.dns_cache.save, (settings.DNS_CACHE_FILE,))):
+                t = task.LoopingCall(fn, *args)
+                t.start(300, now=False)
+                self.tasks.append(t)
+        if StatsCounters.is_active():
+            t = task.LoopingCall(deferToDb, StatsCounters.flush)
+            t.start(settings.STATS_FLUSH_DELAY, now=False)
+            self.tasks.append(t)
+        if LiveStats.batch_size > 0:
+            t = task.LoopingCall(deferToDb, LiveStats.flush)
+            t.start(settings.LIVE_STATS_FLUSH_DELAY, now=False)
+            self.tasks.append(t)
         self.log.info("Mailing sender started")
 
     def stop_tasks(self):
@@ -163,7 +276,7 @@ class MailingSender(pb.Referenceable):
             self.log.debug("Verifying recipients (%d unverified)...", count)
             data_list = yield getAllPages(self.mailing_manager, "get_my_recipients")
             data = b''.join(data_list)
-            recipient_ids = pickle.loads(data)
+            recipient_ids = [r['_id'] for r in decode_records(data)]
 
             self.log.debug("Master returns us %d recipients", len(recipient_ids))
             if recipient_ids:
@@ -174,48 +287,86 @@ class MailingSender(pb.Referenceable):
             yield db.mailingrecipient.delete_many({'send_status': RECIPIENT_STATUS.UNVERIFIED})
 
 
-    def cb_get_recipients(self, data_list, t0):
-        self.is_connected = True
+    def get_recipients_collector(self):
+        """
+        Returns a page collector inserting recipients into the local queue as soon as their page is received.
+        """
+        t0 = time.time()
+        domains = set()
+
+        def _insert_page(recipients):
+            deferToDb(self.add_recipients, recipients, domains).addErrback(self.eb_get_recipients)
+
+        collector = RecordsPageCollector(_insert_page)
+        # requests are run in order by the database thread: this waits for the insertion of all pages
+        collector.deferred.addCallback(lambda count: deferToDb(lambda: count))
+        collector.deferred.addCallbacks(self.cb_get_recipients, self.eb_get_recipients,
+                                        callbackArgs=(domains, t0))
+        return collector
+
+    def add_recipients(self, recipients, domains):
+        """
+        Inserts recipients received from the master into the local queue, with one bulk insert. Missing mailings are
+        created too.
+
+        @param domains: set where the domains of inserted recipients are added
+        """
+        mailing_ids = set(r['mailing'] for r in recipients)
+        existing_ids = set(m['_id'] for m in Mailing._get_collection().find({'_id': {'$in': list(mailing_ids)}},
+                                                                              projection=[]))
+        if mailing_ids - existing_ids:
+            try:
+                Mailing._get_collection().insert_many([dict(Mailing(_id=mailing_id))
+                                                       for mailing_id in mailing_ids - existing_ids], ordered=False)
+            except BulkWriteError:
+                pass  # created meanwhile
+
+        documents = []
+        for r in recipients:
+            try:
+                documents.append(dict(MailingRecipient(mailing=DBRef("mailing", r['mailing']),
+                                                       _id=r['_id'],
+                                                       tracking_id=r['tracking_id'],
+                                                       contact_data=r.get('contact'),
+                                                       email=r['email'],
+                                                       mail_from=r['mail_from'],
+                                                       sender_name=r.get('sender_name'),
+                                                       domain_name=r['email'].split('@', 1)[1],
+                                                       first_try=r.get('first_try'),
+                                                       next_try=r['next_try'],
+                                                       try_count=r.get('try_count'),
+                )))
+            except Exception as ex:
+                self.log.warn("Recipient '%s' was ignored due to Exception: %s", r.get('email'), ex)
+        if not documents:
+            return
+        failed_indexes = set()
         try:
-            recipients = pickle.loads(b''.join(data_list))
-            self.log.debug("Received %d new recipients from Manager in %.1fs.", len(recipients), time.time() - t0)
-            mailings = {}   # dict(mailing_id, mailing)
-            c = 0
-            for r in recipients:
-                # self.log.debug("Recipient: %s", r)
-                mailing_id = r['mailing']
-                mailing = mailings.get(mailing_id)
-                if not mailing:
-                    mailing = Mailing.grab(mailing_id)
-                    if not mailing:
-                        mailing = Mailing.create(_id=mailing_id)
-                try:
-                    MailingRecipient.create(mailing=DBRef("mailing", mailing.id),
-                                            _id=r['_id'],
-                                            tracking_id=r['tracking_id'],
-                                            contact_data=r.get('contact'),
-                                            email=r['email'],
-                                            mail_from=r['mail_from'],
-                                            sender_name=r.get('sender_name'),
-                                            domain_name=r['email'].split('@', 1)[1],
-                                            first_try=r.get('first_try'),
-                                            next_try=r['next_try'],
-                                            try_count=r.get('try_count'),
-                    )
-                    c += 1
-                    #print r['id'], '-->', r['recipient']
-                except Exception as ex:
-                    # print ex
-                    self.log.warn("Recipient '%s' was ignored due to Exception: %s", r['email'], ex)
-                    # should we inform the master ? it may be not necessary because it means that it is currently already handled
-                    # and so, an update will be sent soon or late.
-            if c:
-                self.log.debug("Recipients added to local queue.")
-            self.nextTime = 0
-        except pickle.PickleError:
-            self.log.exception("Can't decode recipients data")
-        except Exception:
-            self.log.exception("Unexpected error getting recipients data")
+            MailingRecipient._get_collection().insert_many(documents, ordered=False)
+        except BulkWriteError as ex:
+            for write_error in ex.details.get('writeErrors', []):
+                document = documents[write_error['index']]
+                failed_indexes.add(write_error['index'])
+                if write_error.get('code') == 11000:
+                    # it is already handled, so an update will be sent soon or late: no need to inform the master.
+                    self.log.warn("Recipient '%s' [%s] was ignored: already in queue", document['email'],
+                                  document['_id'])
+                else:
+                    self.log.warn("Recipient '%s' [%s] was ignored due to error: %s", document['email'],
+                                  document['_id'], write_error.get('errmsg'))
+        for index, document in enumerate(documents):
+            if index not in failed_indexes:
+                domains.add(document['domain_name'].lower())
+
+    def cb_get_recipients(self, count, domains, t0):
+        self.is_connected = True
+        self.log.debug("Received %d new recipients from Manager in %.1fs.", count, time.time() - t0)
+        if domains:
+            self.log.debug("Recipients added to local queue.")
+            if self.dns_prefetcher:
+                self.dns_prefetcher.prefetch(domains)
+            self.handling_get_mailing_next_time = 0
+            self.wakeup()
         return None
 
     def eb_get_recipients(self, err):
@@ -231,21 +382,30 @@ class MailingSender(pb.Referenceable):
             return
         if time.time() < self.handling_get_mailing_next_time:
             return
-        mailing_id = None
+        # no new pass until this one is finished
+        self.handling_get_mailing_next_time = time.time() + self.delay_if_empty
+        d = deferToDb(self._find_missing_mailing)
+        d.addCallback(self._cb_find_missing_mailing)
+        d.addErrback(self.eb_get_mailing)
+        return d
+
+    def _find_missing_mailing(self):
+        """Returns the id of a mailing without content, or of a missing mailing referenced by a recipient."""
         mailing = Mailing.find({'$or': [{'header': None}, {'body_downloaded': False}], 'deleted': False}).first()
         if mailing:
-            mailing_id = mailing._id
-        else:
-            existing_mailings_ids = [m._id for m in Mailing.find({}, projection=[])]
-            orphan_recipient = MailingRecipient._collection.find_one({'mailing.$id': {'$not': {'$in': existing_mailings_ids}}})
-            if orphan_recipient:
-                self.log.warning("Found recipient without mailing for mailing [%s]", orphan_recipient['mailing'])
-                mailing_id = orphan_recipient['mailing'].id
+            return mailing._id
+        existing_mailings_ids = [m._id for m in Mailing.find({}, projection=[])]
+        orphan_recipient = MailingRecipient._collection.find_one({'mailing.$id': {'$not': {'$in': existing_mailings_ids}}})
+        if orphan_recipient:
+            self.log.warning("Found recipient without mailing for mailing [%s]", orphan_recipient['mailing'])
+            return orphan_recipient['mailing'].id
+        return None
+
+    def _cb_find_missing_mailing(self, mailing_id):
         if mailing_id is None:
-            self.handling_get_mailing_next_time = time.time() + self.delay_if_empty
             # print "check_for_missing_mailing: Waiting for %d seconds..." % self.delay_if_empty
             return
-            
+        self.handling_get_mailing_next_time = 0
         try:
             self.log.info("Requesting content for mailing [%d]", mailing_id)
             d = getAllPages(self.mailing_manager, "get_mailing", mailing_id)
@@ -258,55 +418,63 @@ class MailingSender(pb.Referenceable):
     def cb_get_mailing(self, data_list):
         self.is_connected = True
         data = b''.join(data_list)
-        mailing_id = None
-        #noinspection PyBroadException
         try:
-            mailing_dict = pickle.loads(data)
-            mailing_id = mailing_dict['id']
-            if mailing_id in MailCustomizer.mailingsContent:
-                del MailCustomizer.mailingsContent[mailing_id]
-
-            if not mailing_dict.get('delete', False):
-                header = mailing_dict['header']
-                body = mailing_dict['body']
-                tracking_url = mailing_dict['tracking_url']
-                self.log.debug("Received header and body for mailing [%d] from Manager", mailing_id)
-                mailing = Mailing.grab(mailing_id)
-                if mailing:
-                    mailing.header = header
-                    mailing.body = body
-                    mailing.body_downloaded = True
-                    mailing.testing = mailing_dict.get('testing', False)
-                    mailing.backup_customized_emails = mailing_dict.get('backup_customized_emails', False)
-                    mailing.read_tracking = mailing_dict.get('read_tracking', True)
-                    mailing.click_tracking = mailing_dict.get('click_tracking', False)
-                    mailing.tracking_url = tracking_url
-                    mailing.dkim = mailing_dict.get('dkim', None)
-                    mailing.feedback_loop = mailing_dict.get('feedback_loop', None)
-                    mailing.domain_name = mailing_dict.get('domain_name', None)
-                    mailing.return_path_domain = mailing_dict.get('return_path_domain', None)
-                    mailing.type = mailing_dict.get('type', None)
-                    mailing.url_encoding = mailing_dict.get('url_encoding', None)
-                    mailing.save()
-                else:
-                    self.log.error("Mailing [%d] doesn't exist. Can't update header and body data.", mailing_id)
-            else:
-                self.log.warn("Received DELETE order for mailing [%d] from Manager", mailing_id)
-                self.close_mailing(mailing_id)
-                # self.log.info("Deleting recipients from mailing [%d]", mailing_id)
-                # MailingRecipient.remove({'mailing.$id': mailing_id})
-                #
-                # mailing = Mailing.grab(mailing_id)
-                # if mailing:
-                #     self.log.info("Deleting mailing [%d]", mailing_id)
-                #     mailing.delete()
-
-        except pickle.PickleError:
+            mailing_dict = decode_records(data)[0]
+        except WireFormatError:
             self.log.exception("Can't decode mailing data")
-        except Exception:
-            self.log.exception("Unexpected error getting mailing data")
-        return None
-        
+            return None
+        d = deferToDb(self._store_mailing, mailing_dict)
+        d.addCallbacks(lambda stored: stored and self.wakeup(),
+                       lambda err: self.log.error("Unexpected error getting mailing data: %s", err.getTraceback()))
+        return d
+
+    def _store_mailing(self, mailing_dict):
+        """
+        Updates (or deletes) a mailing with the data received from the master.
+
+        @return: True if the mailing content has been updated
+        """
+        mailing_id = mailing_dict['id']
+        MailCustomizer.invalidate_mailing_body(mailing_id)
+
+        if not mailing_dict.get('delete', False):
+            header = mailing_dict['header']
+            body = mailing_dict['body']
+            tracking_url = mailing_dict['tracking_url']
+            self.log.debug("Received header and body for mailing [%d] from Manager", mailing_id)
+            mailing = Mailing.grab(mailing_id)
+            if mailing:
+                mailing.header = header
+                mailing.body = body
+                mailing.body_downloaded = True
+                mailing.testing = mailing_dict.get('testing', False)
+                mailing.backup_customized_emails = mailing_dict.get('backup_customized_emails', False)
+                mailing.read_tracking = mailing_dict.get('read_tracking', True)
+                mailing.click_tracking = mailing_dict.get('click_tracking', False)
+                mailing.tracking_url = tracking_url
+                mailing.dkim = mailing_dict.get('dkim', None)
+                mailing.feedback_loop = mailing_dict.get('feedback_loop', None)
+                mailing.domain_name = mailing_dict.get('domain_name', None)
+                mailing.return_path_domain = mailing_dict.get('return_path_domain', None)
+                mailing.type = mailing_dict.get('type', None)
+                mailing.url_encoding = mailing_dict.get('url_encoding', None)
+                mailing.save()
+                return True
+            else:
+                self.log.error("Mailing [%d] doesn't exist. Can't update header and body data.", mailing_id)
+        else:
+            self.log.warn("Received DELETE order for mailing [%d] from Manager", mailing_id)
+            self.close_mailing(mailing_id)
+            # self.log.info("Deleting recipients from mailing [%d]", mailing_id)
+            # MailingRecipient.remove({'mailing.$id': mailing_id})
+            #
+            # mailing = Mailing.grab(mailing_id)
+            # if mailing:
+            #     self.log.info("Deleting mailing [%d]", mailing_id)
+            #     mailing.delete()
+
+        return False
+
     def eb_get_mailing(self, err):
         err_msg = str(err.value) or str(err)
         self.log.error("Error getting mailing data: %s", err_msg)
@@ -314,27 +482,32 @@ class MailingSender(pb.Referenceable):
     def send_report_for_finished_recipients(self):
         """
         Send status report for finished recipients to the master. 
-        
-        Args:
-            finished_recipients:  a query_set to these recipients.
-            
         """
         if not self.mailing_manager:
             self.log.info( "MailingManager not connected (NULL). Can't send reports. Waiting..." )
             return
 
-        t0 = time.time()
-        finished_recipients = MailingRecipient.search(in_progress=False, finished=True)
+        d = deferToDb(self._get_reports)
+        d.addCallback(self._cb_get_reports, time.time())
+        d.addErrback(self.eb_send_reports)
+        return d
+
+    def _get_reports(self):
+        """Returns the reports of finished recipients, as dictionaries."""
+        WriteBehind.flush()
+        rcpts = []
+        max_reports = min(settings_vars.get_int(settings_vars.MAILING_MAX_REPORTS), 5000)
+        for recipient in MailingRecipient.search(in_progress=False, finished=True)[0:max_reports]:
+            rcpt = dict(recipient)
+            for field in ('contact_data', 'unsubscribe_id'):
+                rcpt.pop(field, None)
+            rcpt['_id'] = str(recipient['_id'])
+            rcpt['mailing'] = recipient['mailing'].id
+            rcpts.append(rcpt)
+        return rcpts
+
+    def _cb_get_reports(self, rcpts, t0):
         try:
-            rcpts = []
-            max_reports = min(settings_vars.get_int(settings_vars.MAILING_MAX_REPORTS), 5000)
-            for recipient in finished_recipients[0:max_reports]:
-                rcpt = dict(recipient)
-                for field in ('contact_data', 'unsubscribe_id'):
-                    rcpt.pop(field, None)
-                rcpt['_id'] = str(recipient['_id'])
-                rcpt['mailing'] = recipient['mailing'].id
-                rcpts.append(rcpt)
             if rcpts:
                 self.log.debug("Sending reports for %d recipients", len(rcpts))
                 d = self.mailing_manager.callRemote('send_reports', rcpts)
@@ -343,28 +516,41 @@ class MailingSender(pb.Referenceable):
         except pb.DeadReferenceError:
             self.log.info("MailingManager not connected. Waiting...")
             self.is_connected = False
-        except Exception:
-            self.log.exception("Error in send_report_for_finished_recipients()")
 
     def cb_send_reports(self, recipient_ids, t0):
         self.is_connected = True
-        try:
-            MailingRecipient.remove({'_id': {'$in': [ObjectId(id) for id in recipient_ids]}})
-            self.log.debug("Reports for %d recipients sent in %.1f s", len(recipient_ids), time.time() - t0)
-        except Exception:
-            self.log.exception("Error while removing finished recipients.")
+        d = deferToDb(MailingRecipient.remove, {'_id': {'$in': [ObjectId(id) for id in recipient_ids]}})
+        d.addCallbacks(lambda _: self.log.debug("Reports for %d recipients sent in %.1f s", len(recipient_ids),
+                                                time.time() - t0),
+                       lambda err: self.log.error("Error while removing finished recipients: %s", err.value))
+        return d
         
     def eb_send_reports(self, err):
         err_msg = str(err.value) or str(err)
         self.log.error("Error while reporting finished recipients: %s", err_msg)
 
     def send_statistics(self):
+        if not self.mailing_manager:
+            self.log.info( "MailingManager not connected (NULL). Can't send statistics. Waiting..." )
+            return
+        d = deferToDb(self._get_statistics)
+        d.addCallback(self._cb_get_statistics)
+        d.addErrback(self.eb_send_statistics)
+        return d
+
+    @staticmethod
+    def _get_statistics():
+        """Returns hourly statistics not sent yet to the master."""
+        StatsCounters.flush()
+        stats = []
+        for stat in HourlyStats.search(up_to_date=False):
+            s = dict(stat)
+            s.pop('up_to_date',None)
+            stats.append(s)
+        return stats
+
+    def _cb_get_statistics(self, stats):
         try:
-            stats = []
-            for stat in HourlyStats.search(up_to_date=False):
-                s = dict(stat)
-                s.pop('up_to_date',None)
-                stats.append(s)
             if stats:
                 d = self.mailing_manager.callRemote('send_statistics', stats)
                 d.addCallbacks(self.cb_send_statistics, self.eb_send_statistics)
@@ -372,16 +558,14 @@ class MailingSender(pb.Referenceable):
         except pb.DeadReferenceError:
             self.log.info("MailingManager not connected. Waiting...")
             self.is_connected = False
-        except Exception:
-            self.log.exception("Error in send_report_for_finished_recipients()")
 
     def cb_send_statistics(self, stats_ids):
         self.is_connected = True
         # BUG possible loose of statistics if row updated since it was sent to master
-        try:
-            HourlyStats.update({'_id': {'$in': stats_ids}}, {'$set': {'up_to_date': True}}, multi=True)
-        except Exception as ex:
-            self.log.exception("Error while removing updated statistics for ids [%s].", stats_ids)
+        d = deferToDb(HourlyStats.update, {'_id': {'$in': stats_ids}}, {'$set': {'up_to_date': True}}, multi=True)
+        d.addErrback(lambda err: self.log.error("Error while removing updated statistics for ids [%s]: %s",
+                                                stats_ids, err.value))
+        return d
         
     def eb_send_statistics(self, err):
         err_msg = str(err.value) or str(err)
@@ -389,7 +573,43 @@ class MailingSender(pb.Referenceable):
         
     # KEEP ?
     def forceToCheck(self):
+        self.wakeup()
+
+    def wakeup(self, when=None):
+        """
+        Asks for a queue filling pass, as soon as possible or at a given time.
+
+        Close requests are coalesced into a single pass, and passes are spaced by at least
+        L{min_dispatch_interval} seconds.
+
+        @param when: optional time (as returned by time.time()) of the pass
+        """
+        when = max(when or 0, self.lastDispatch + self.min_dispatch_interval)
+        heapq.heappush(self._deadlines, when)
+        self._arm_dispatcher()
+
+    def _arm_dispatcher(self):
+        if not self._deadlines:
+            return
+        if self._dispatch_call is not None and self._dispatch_call.active():
+            if self._dispatch_call.getTime() <= self._deadlines[0]:
+                return
+            self._dispatch_call.cancel()
+        self._dispatch_call = reactor.callLater(max(0, self._deadlines[0] - time.time()), self._on_deadline)
+
+    def _on_deadline(self):
+        self._dispatch_call = None
+        now = time.time()
+        while self._deadlines and self._deadlines[0] <= now:
+            heapq.heappop(self._deadlines)
         self.nextTime = 0
+        self.check_mailing()
+        self._arm_dispatcher()
+
+    def _cb_dispatch_finished(self):
+        if self._wakeup_requested:
+            self._wakeup_requested = False
+            self.wakeup()
 
     @staticmethod
     def make_queue_filter():
@@ -407,43 +627,59 @@ class MailingSender(pb.Referenceable):
 
         Call me periodically to check I am still up to date.
 
-        @return: None or a Deferred which fires when all of the SMTP clients
-        started by this call have disconnected.
+        @return: None or a Deferred which fires once the queue state is read (and a queue filling pass maybe started).
         """
-        need_to_release = False
-
         if time.time() < self.nextTime:
             return
+        if not self.handlingQueueLock.acquire(False):
+            # a pass is running: run another one after it
+            self._wakeup_requested = True
+            return
+        # errors (in the database thread) release the lock in _eb_check_mailing()
+        d = deferToDb(self._get_queue_state)
+        d.addCallbacks(self._cb_check_mailing, self._eb_check_mailing)
+        return d
+
+    def _get_queue_state(self):
+        """Reads the settings, the queue filter and the queue counters needed by L{check_mailing}."""
+        queue_filter = self.make_queue_filter()
+        max_connections = settings_vars.get_int(settings_vars.MAILING_QUEUE_MAX_THREAD)
+        max_messages_per_connection = settings_vars.get_int(settings_vars.MAILING_QUEUE_MAX_THREAD_SIZE)
+        # recipients selection relies on their states
+        WriteBehind.flush()
+        return {
+            'max_connections': max_connections,
+            'max_messages_per_connection': max_messages_per_connection,
+            'in_progress': MailingRecipient.search(in_progress=True).count(),
+            'queue_size': MailingRecipient.search(finished=False).count(),
+            'to_report': MailingRecipient.search(finished=True).count(),
+            'queue_filter': queue_filter,
+            'has_recipients': MailingRecipient.find(queue_filter).first() is not None,
+        }
+
+    def _cb_check_mailing(self, state):
+        need_to_release = True
         try:
             delay_for_next_time = self.delay_if_empty  # default delay
-            if not self.handlingQueueLock.acquire(False):
-                return
-            need_to_release = True
-            
-            self.maxConnections = settings_vars.get_int(settings_vars.MAILING_QUEUE_MAX_THREAD)
-            self.maxMessagesPerConnection = settings_vars.get_int(settings_vars.MAILING_QUEUE_MAX_THREAD_SIZE)
-            
-            in_progress = MailingRecipient.search(in_progress=True).count()
-            temp_queue_count = MailingRecipient.search(finished=False).count()
-            to_report_count = MailingRecipient.search(finished=True).count()
+            self.maxConnections = state['max_connections']
+            self.maxMessagesPerConnection = state['max_messages_per_connection']
             active_relay_count = self.relay_manager.activeRelayCount()
 
             self.log.debug("Number of active relays: %d / Max relays count: %d / Max recipients per relay: %d / "
                            "In progress = %d / Queue size = %d / ReportsQueue % d",
-                           active_relay_count, self.maxConnections, self.maxMessagesPerConnection, in_progress,
-                           temp_queue_count, to_report_count)
+                           active_relay_count, self.maxConnections, self.maxMessagesPerConnection,
+                           state['in_progress'], state['queue_size'], state['to_report'])
 
-            if active_relay_count >= (int(self.maxConnections / 2) or 1):
-                # this is to limit the number of database queries. Assuming that there is a sufficient
-                # number of recipients to handle, we don't get new ones.
+            if active_relay_count >= self.maxConnections:
+                # we will be woken up when a relayer finishes
                 self.log.debug("Skipping filling queue due to too much concurrent connections (%d)", active_relay_count)
                 return
 
-            queue_filter = self.make_queue_filter()
-            if MailingRecipient.find(queue_filter).first():
+            if state['has_recipients']:
                 need_to_release = False
+                self.lastDispatch = time.time()
                 deferToThread(self.handle_mailing_queue, 
-                              queue_filter
+                              state['queue_filter']
                               )
                 delay_for_next_time = 0
             self.nextTime = time.time() + delay_for_next_time
@@ -453,6 +689,12 @@ class MailingSender(pb.Referenceable):
         finally:
             if need_to_release:
                 self.handlingQueueLock.release()
+                # wake up requests received while the queue state was read
+                self._cb_dispatch_finished()
+
+    def _eb_check_mailing(self, err):
+        self.log.error("Unknown exception in check_mailing: %s", err.getTraceback())
+        self.handlingQueueLock.release()
 
     def handle_mailing_queue(self, queue_filter):
         #noinspection PyBroadException
@@ -474,22 +716,23 @@ class MailingSender(pb.Referenceable):
 
             Queue.mxcalc.cleanupBadMXs()
 
+            policies = DomainPolicies(self.maxMessagesPerConnection, queue_filter)
             testing_mailings = [x['_id'] for x in Mailing._get_collection().find({'testing': True}, projection=('_id',))]
             testing_queue_filter = queue_filter.copy()
             queue_filter.setdefault('$and', []).append({'mailing.$id': {'$nin': testing_mailings}})
             testing_queue_filter.setdefault('$and', []).append({'mailing.$id': {'$in': testing_mailings}})
 
-            exchanges = self._get_exchanges_dict(dict(queue_filter))
-            test_exchanges = self._get_exchanges_dict(dict(testing_queue_filter))
+            exchanges = self._get_exchanges_dict(dict(queue_filter), policies)
+            test_exchanges = self._get_exchanges_dict(dict(testing_queue_filter), policies)
 
             if not exchanges and not test_exchanges:
                 # self.nextTime = time.time() + 60
                 return
 
             if exchanges:
-                self._make_relayers(exchanges, mail_server, testing=False)
+                self._make_relayers(exchanges, mail_server, testing=False, policies=policies)
             if test_exchanges:
-                self._make_relayers(test_exchanges, mail_server, testing=True)
+                self._make_relayers(test_exchanges, mail_server, testing=True, policies=policies)
 
         except KeyboardInterrupt:
             self.log.info('Mailing queue stopped by user (Crtl-C)')
@@ -499,19 +742,14 @@ class MailingSender(pb.Referenceable):
         finally:
             self.log.debug("handle_mailing_queue() finished in %.1fs", time.time() - t0)
             self.handlingQueueLock.release()
+            reactor.callFromThread(self._cb_dispatch_finished)
             
-    def _get_exchanges_dict(self, queue_filter):
+    def _get_exchanges_dict(self, queue_filter, policies=None):
         active_queues_count = self.relay_manager.activeRelayCount()
         exchanges = {}  # dict (Key: domain name; Value: list of recipients)
-        skip_domains = []
-        domains_notation = DomainStats.get_domains_notation()
-        mapping_note_to_queue_size = settings_vars.get(settings_vars.DOMAINS_NOTATION)
-
-        def check_mapping(mapping, note):
-            for check, value in mapping:
-                if note <= check:
-                    return min(value, self.maxMessagesPerConnection)
-            return self.maxMessagesPerConnection
+        skip_domains = set()
+        if policies is None:
+            policies = DomainPolicies(self.maxMessagesPerConnection)
 
         for recipient in MailingRecipient.find(queue_filter).sort('next_try'):
             assert(isinstance(recipient, MailingRecipient))
@@ -523,35 +761,34 @@ class MailingSender(pb.Referenceable):
             domain = parts[1].lower()
             if domain in skip_domains:
                 continue
-            notation = domains_notation.get(domain, 0)
-            max_recipients = check_mapping(mapping_note_to_queue_size, notation)
-            self.log.debug("Domain notation for [%s]: %.1f -> %d recipients max", domain, notation, max_recipients)
+            max_recipients = policies.get_max_recipients(domain)
             if max_recipients == 0:
                 # mark recipient as handled
                 recipient.mark_as_finished()
                 continue
 
-            domain_config = DomainConfiguration.search(domain_name=domain).first() or {}
-
             if domain not in exchanges:
+                self.log.debug("Domain notation for [%s]: %.1f -> %d recipients max", domain,
+                               policies.get_notation(domain), max_recipients)
                 if len(exchanges) >= (self.maxConnections - active_queues_count):
-                    skip_domains.append(domain)
+                    skip_domains.add(domain)
                     continue # skip this domain
-                if ActiveQueue.search(domain_name=domain).count() >= domain_config.get('max_relayers', settings_vars.get(settings_vars.DEFAULT_MAX_QUEUE_PER_DOMAIN)):
+                if not policies.has_free_relayer(domain):
                     # No more queue for this domain
-                    skip_domains.append(domain)
+                    skip_domains.add(domain)
                     continue
                 exchanges[domain] = []
             if len(exchanges[domain]) >= max_recipients:
-                skip_domains.append(domain)
+                skip_domains.add(domain)
                 continue # skip this recipient
             exchanges[domain].append(recipient)
             recipient.set_send_mail_in_progress()
         return exchanges
 
-    def _make_relayers(self, exchanges, mail_server, testing=False):
+    def _make_relayers(self, exchanges, mail_server, testing=False, policies=None):
         for (domain, recipients) in exchanges.items():
-            q_manager = Queue(domain, recipients, mail_server, testing)
+            q_manager = Queue(domain, recipients, mail_server, testing,
+                              configuration=policies and policies.configurations.get(domain))
             queue_id = self.relay_manager.add_queue(q_manager)
             self.log.debug("Relayer for '%s' created." % domain)
             d = q_manager.start()
@@ -563,6 +800,7 @@ class MailingSender(pb.Referenceable):
     def _cbRelayer(self, domainName, queue_id):
         self.log.debug("Relayer for '%s' finished." % domainName)
         self.relay_manager.removeActiveRelay(queue_id)
+        self.wakeup()
 
     def _ebRelayer(self, err, domain, queue_id):
         # if err.check(dns.exception.DNSException):
@@ -574,6 +812,7 @@ class MailingSender(pb.Referenceable):
         if recipients:
             # by security, to be certain to not block our mailing queue
             self.relay_manager.removeActiveRelay(queue_id)
+        self.wakeup()
 
     def invalidate_all_mailing_content(self):
         self.log.debug("Invalidating all mailing content...")
@@ -605,8 +844,7 @@ class MailingSender(pb.Referenceable):
         # else:
         #     self.log.warn("Mailing id [%d] doesn't exist!", queue_id)
 
-        if queue_id in MailCustomizer.mailingsContent:
-            del MailCustomizer.mailingsContent[queue_id]
+        MailCustomizer.invalidate_mailing_body(queue_id)
 
         self.log.debug("Delete all customized files for mailing [%d].", queue_id)
         import glob
@@ -620,6 +858,8 @@ class MailingSender(pb.Referenceable):
 
     def remove_closed_mailings(self):
         self.log.info("Remove closed mailings")
+        # recipients selection relies on their states
+        WriteBehind.flush()
         for mailing in Mailing.search(deleted=True):
             MailingRecipient.remove({'mailing.$id': mailing.id, 'in_progress': False, 'finished': False})
             if not MailingRecipient.find({'mailing.$id': mailing.id}).first():
@@ -667,19 +907,28 @@ class ActiveQueuesList(object):
         return len(self.managed)
 
     def removeActiveRelay(self, queue_id):
-        def _remove(queue_id):
-            self.log.debug("removeActiveRelay(%s)", queue_id)
-            queue = ActiveQueue.grab(queue_id)
-            age = datetime.utcnow() - queue.created
-            self.log.debug("Queue [%s:%s] was %d seconds old", queue.id, queue.domain_name, age.seconds)
-            ActiveQueue.remove({'_id': queue_id})
-            del self.managed[queue_id]
-
-        delay = settings_vars.get_float(settings_vars.MAILING_QUEUE_ENDING_DELAY)
-        if delay > 0:
-            reactor.callLater(delay, _remove, queue_id)
-        else:
-            _remove(queue_id)
+        def _remove(delay):
+            if delay > 0:
+                reactor.callLater(delay, self._remove_active_relay, queue_id)
+            else:
+                self._remove_active_relay(queue_id)
+
+        d = deferToDb(settings_vars.get_float, settings_vars.MAILING_QUEUE_ENDING_DELAY)
+        d.addCallback(_remove)
+        d.addErrback(lambda err: self.log.error("Can't remove active queue [%s]: %s", queue_id, err.getTraceback()))
+        return d
+
+    def _remove_active_relay(self, queue_id):
+        self.log.debug("removeActiveRelay(%s)", queue_id)
+        self.managed.pop(queue_id, None)  # zombie queues may be removed twice
+        deferToDb(self._delete_active_queue, queue_id)\
+            .addErrback(lambda err: self.log.error("Can't delete active queue [%s]: %s", queue_id, err.value))
+
+    def _delete_active_queue(self, queue_id):
+        queue = ActiveQueue.grab(queue_id)
+        age = datetime.utcnow() - queue.created
+        self.log.debug("Queue [%s:%s] was %d seconds old", queue.id, queue.domain_name, age.seconds)
+        ActiveQueue.remove({'_id': queue_id})
 
     # # Not used
     # def removeAllActiveRelays(self):
@@ -701,18 +950,31 @@ class ActiveQueuesList(object):
         return None
 
     def check_for_zombie_queues(self):
+        d = deferToDb(self._find_zombie_queues)
+        d.addCallback(self._cb_find_zombie_queues)
+        d.addErrback(lambda err: self.log.error("Error while checking for zombie queues: %s", err.getTraceback()))
+        return d
+
+    def _find_zombie_queues(self):
+        """Returns (ids of queues older than the max age, max age), or None if zombie queues aren't checked."""
         if not settings_vars.get_bool(settings_vars.ZOMBIE_QUEUE_CHECKING):
-            return
+            return None
         self.log.debug("Check for zombie queues")
         max_age = settings_vars.get_int(settings_vars.ZOMBIE_QUEUE_AGE_IN_SECONDS)
         ids = [queue.id for queue in ActiveQueue.find({'created': {'$lt': datetime.utcnow() - timedelta(seconds=max_age)}})]
-        if ids:
-            self.log.warn("Found %d zombie queues (older than %d seconds)", len(ids), max_age)
-            for _id in ids:
-                queue = self.managed[_id]
-                self.log.warn("Deleting queue for '%s' that contains %d recipients", queue.domain, len(queue.recipients))
-                queue._ebExchange(defer.failure.Failure(defer.TimeoutError), queue.factory, queue.domain, queue.recipients)
-                self.removeActiveRelay(_id)
+        return ids, max_age
+
+    def _cb_find_zombie_queues(self, result):
+        if not result or not result[0]:
+            return
+        ids, max_age = result
+        self.log.warn("Found %d zombie queues (older than %d seconds)", len(ids), max_age)
+        for _id in ids:
+            queue = self.managed[_id]
+            self.log.warn("Deleting queue for '%s' that contains %d recipients", queue.domain, len(queue.recipients))
+            queue._ebExchange(defer.failure.Failure(defer.TimeoutError), queue.factory, queue.domain, queue.recipients)\
+                .addErrback(lambda err: None)
+            self.removeActiveRelay(_id)
 
     # def unqueue_recipients(self, recipient_ids):
 
@@ -727,10 +989,19 @@ class Queue(object):
     PORT = 25
     mx_in_use = [] # IP addresses of MX server where we are currently connected
     mxcalc = None
+    connection_pool = None  # SMTPConnectionPool shared by all queues
 
-    def __init__(self, domain, recipients, mail_server, testing=False):
+    def __init__(self, domain, recipients, mail_server, testing=False, configuration=None):
+        """
+        @param configuration: the L{DomainConfiguration} of this domain (as a dictionary), if any
+        """
         self.domain = domain
+        self.mx_name = None  # MX currently used
         self.mx_ip = None
+        self.mxs = []  # list of (preference, MX name)
+        self.mx_ips = {}  # key = MX name, value = IP address
+        self.tried_mxs = set()
+        self.configuration = configuration or {}
         self.recipients = recipients
         self.mail_server = mail_server
         self.testing = testing
@@ -739,6 +1010,10 @@ class Queue(object):
         self.fake_target_port = settings.TEST_TARGET_PORT
         self.factory = None
         self.t0_customization = 0
+        self.lazy_customization = settings.CUSTOMIZATION_LOOKAHEAD > 0
+        self.memory_budget = None
+        if settings.CUSTOMIZATION_MEMORY_BUDGET > 0:
+            self.memory_budget = MemoryBudget(settings.CUSTOMIZATION_MEMORY_BUDGET)
 
     def start(self):
         """
@@ -756,6 +1031,10 @@ class Queue(object):
                                           connectionFailureErrback=self._ebConnectionFailure,
                                           **kw)
         self.factory.domain = str(main_domain or smtp.DNSNAME)
+        self.factory.connectionPool = self.connection_pool
+        self.factory.maxRecipientsPerMail = settings.SMTP_MAX_RECIPIENTS_PER_MAIL
+        self.factory.pipelining = settings.SMTP_PIPELINING
+        self.factory.chunkingThreshold = settings.SMTP_CHUNKING_THRESHOLD
 
         self.log.debug("Requesting MX servers for relayer '%s'...", self.domain)
 
@@ -767,7 +1046,16 @@ class Queue(object):
             d = self.mxcalc.getMX(self.domain)
             d.addCallback(self._cb_store_mx_list)
 
-        d.addCallback(lambda mxs: deferToThread(self._customize_recipients, mxs, self.factory, self.recipients))
+        customization_pool = get_customization_pool()
+        if customization_pool:
+            d.addCallback(self._customize_recipients_in_pool, customization_pool, self.factory, self.recipients)
+        elif self.lazy_customization:
+            # emails will be customized by the factory, just before sending them
+            self.factory.lookahead = settings.CUSTOMIZATION_LOOKAHEAD
+            d.addCallback(lambda mxs: deferToThread(self._customize_recipients, mxs, self.factory, self.recipients,
+                                                    lazy=True))
+        else:
+            d.addCallback(lambda mxs: deferToThread(self._customize_recipients, mxs, self.factory, self.recipients))
         d.addCallback(self._send_all_emails, self.PORT, self.factory, self.testing)
 
         d.addErrback(self._ebExchange, self.factory, self.domain, self.recipients)
@@ -776,92 +1064,227 @@ class Queue(object):
 
     def _cb_store_mx_list(self, mxs):
         self.log.debug("MX list for '%s': %s", self.domain, repr(mxs))
+        self.mxs = [(getattr(mx, 'preference', 0), str(mx.name)) for mx in mxs]
         return [str(mx.name) for mx in mxs]
 
+    def _next_mx(self):
+        """
+        Returns the next MX to connect to, or None if all MXs were already tried by this queue.
+
+        MXs are tried by preference order. Among MXs having the same preference, the one with the fewest connections
+        from other queues comes first, so concurrent queues for a domain are spread over its MXs. MXs already having
+        `cnx_per_mx` connections (or the adaptive limit given by L{RateControl}) are avoided, as well as new MXs once
+        `max_mx` MXs are connected.
+        """
+        candidates = [(preference, mx) for preference, mx in self.mxs if mx not in self.tried_mxs]
+        if not candidates:
+            return None
+        cnx_per_mx = self.configuration.get('cnx_per_mx')
+        max_mx = self.configuration.get('max_mx')
+        connected_mxs = set(mx for preference, mx in self.mxs if mx in self.mx_in_use)
+
+        def is_allowed(mx):
+            count = self.mx_in_use.count(mx)
+            limit = cnx_per_mx or None
+            if RateControl.enabled:
+                limit = RateControl.get_limit(self.mx_ips.get(mx, mx), cnx_per_mx or RateControl.max_window, limit)
+            if limit is not None and count >= limit:
+                return False
+            return not max_mx or count > 0 or len(connected_mxs) < max_mx
+
+        # the queue is already started: limits are only preferences if all MXs exceed them
+        candidates = [c for c in candidates if is_allowed(c[1])] or candidates
+        best_preference = min(preference for preference, mx in candidates)
+        mx = min((mx for preference, mx in candidates if preference == best_preference), key=self.mx_in_use.count)
+        self.tried_mxs.add(mx)
+        return mx
+
     def _cbConnectionClosed(self, connector):
         """Callback called by SMTPRelayerFactory for connection closed normally.
         Allows to remove this host from used list.
         """
-        ip = connector.getDestination().host
-        self.mx_in_use.remove(ip)
+        self.mx_in_use.remove(self.mx_name)
 
     def _ebConnectionFailure(self, connector, err):
         """Callback called by SMTPRelayerFactory for connection error.
-        Allows to temporary disable this host.
+        Allows to temporary disable this host, then to fail over to the next MX if no email was started yet.
+        """
+        failed_mx = self.mx_name
+        self.mxcalc.markBad(failed_mx)
+        self.mx_in_use.remove(failed_mx)
+        if self.testing or self.factory.last_email is not None or not self.factory.mails:
+            return
+        mx = self._next_mx()
+        if mx:
+            self.log.warn("Connection to MX '%s' failed. Failing over to '%s'...", failed_mx, mx)
+            self.mx_name = mx
+            self.mx_ip = self.mx_ips.get(mx, mx)
+            self.mx_in_use.append(mx)
+            connector.host = self.mx_ip
+            connector.connect()
+
+    def _resolve_mxs(self):
+        """
+        Resolves all MX hosts (in parallel, through the DNS cache), so connections are made to IP addresses. Hosts
+        that can't be resolved here are left to the reactor.
         """
-        ip = connector.getDestination().host
-        self.mxcalc.markBad(ip)
-        self.mx_in_use.remove(ip)
+        def _cb_resolved(ip, mx):
+            self.mx_ips[mx] = ip
 
-    def _customize_recipients(self, mxs, factory, recipients):
-        self.log.debug("Starting customization...")
+        def _eb_resolved(err, mx):
+            self.log.warn("Can't resolve MX '%s': %s", mx, err.value)
+
+        return defer.DeferredList([self.mxcalc.getHostByName(mx).addCallbacks(_cb_resolved, _eb_resolved,
+                                                                             callbackArgs=(mx,), errbackArgs=(mx,))
+                                   for preference, mx in self.mxs if not isIPAddress(mx)])
+
+    def _customize_recipients_in_pool(self, mxs, customization_pool, factory, recipients):
+        self.log.debug("Starting customization in processes pool...")
         self.t0_customization = time.time()
+        if factory.maxRecipientsPerMail > 1:
+            # shared contents are built by _customize_recipients(), they don't need to be customized by the workers
+            d = deferToThread(lambda: [r for r in recipients if r.mailing and not self._is_shareable(r)])
+        else:
+            d = defer.succeed(recipients)
+        d.addCallback(lambda to_customize: customize_recipients(customization_pool, to_customize,
+                                                                in_memory=self.memory_budget is not None))
+        d.addCallback(lambda customized: deferToThread(self._customize_recipients, mxs, factory, recipients, customized))
+        return d
+
+    def _customize_recipients(self, mxs, factory, recipients, customized=None, lazy=False):
+        """
+        Customizes emails for all recipients then adds them into the factory.
+
+        @param customized: optional dictionary of results from the customization pool (see
+            L{customize_recipients}). If None, customization is done here.
+        @param lazy: if True, recipients are added into the factory which will customize them on demand.
+        """
+        if customized is None and not lazy:
+            self.log.debug("Starting customization...")
+            self.t0_customization = time.time()
+        shared_contents = {}
         for recipient in recipients:
             if not recipient.mailing:
                 self.log.warn("Can't find mailing [%d] for recipient [%s:%s]",
                               recipient['mailing'], recipient.id, recipient.email)
                 continue
-            rcpt_manager = RecipientManager(factory, recipient, lambda: self.mx_ip, self.log)
-            rcpt_manager.send().addCallbacks(self._cbRecipient,
-                                             self._ebRecipient,
-                                             callbackArgs=(factory,),
-                                             errbackArgs=(recipient, factory,)
-                                             )
+            rcpt_manager = RecipientManager(factory, recipient, lambda: self.mx_ip, self.log,
+                                            memory_budget=self.memory_budget)
+            shared = factory.maxRecipientsPerMail > 1 and self._get_shared_content(recipient, factory, shared_contents)
+            if shared:
+                d = rcpt_manager.send(shared)
+            else:
+                d = rcpt_manager.send(customized and customized.get(recipient.id), lazy=lazy)
+            d.addCallbacks(self._cbRecipient, self._ebRecipient,
+                           callbackArgs=(factory,), errbackArgs=(recipient, factory,))
         if factory.get_recipients_count():
             return mxs
         else:
             self.log.error("Factory is empty! All recipients failed at customization level.")
             return Failure(EmtpyFactory("No recipients for domain '%s'!" % self.domain))
 
+    def _get_shared_content(self, recipient, factory, shared_contents):
+        """
+        Returns the customization result shared with other recipients of the same mailing and sender, or None if
+        the email has to be customized for this recipient only (see L{MailCustomizer.is_shareable}).
+
+        A new content is customized each time the previous one reached the recipients limit of the factory, so
+        each content is sent by only one SMTP transaction.
+
+        @param shared_contents: dictionary where key = (mailing id, mail from, sender name),
+            value = [customization result, recipients count]
+        """
+        mailing = recipient.mailing
+        customizer = self._make_shared_customizer(recipient)
+        try:
+            # checked for each recipient, as some of them may have their own attachments
+            if not customizer.is_shareable():
+                return None
+            key = (mailing.id, recipient.mail_from, recipient.sender_name)
+            entry = shared_contents.get(key)
+            if entry is None or entry[1] >= factory.maxRecipientsPerMail:
+                entry = shared_contents[key] = [customizer.customize(self.memory_budget), 0]
+        except Exception as ex:
+            return ex
+        entry[1] += 1
+        return entry[0]
+
+    @staticmethod
+    def _make_shared_customizer(recipient):
+        mailing = recipient.mailing
+        return MailCustomizer(recipient, mailing.read_tracking, mailing.click_tracking, mailing.url_encoding,
+                              mailing=mailing, shared=True)
+
+    def _is_shareable(self, recipient):
+        """
+        Returns True if the recipient will receive a shared content (see L{_get_shared_content}). Errors are
+        considered as shareable, as they will be reported by L{_get_shared_content} too.
+        """
+        try:
+            return self._make_shared_customizer(recipient).is_shareable()
+        except Exception:
+            return True
+
     def _send_all_emails(self, addresses, port, factory, testing):
-        self.log.debug("Customization finished in %.1fs", time.time() - self.t0_customization)
+        if self.t0_customization:
+            self.log.debug("Customization finished in %.1fs", time.time() - self.t0_customization)
         # print "_send_all_emails(%s): %s" % (factory.targetDomain, addresses)
-        DomainStats.add_dns_success(factory.targetDomain)
+        deferToDb(DomainStats.add_dns_success, factory.targetDomain)\
+            .addErrback(lambda err: self.log.error("Can't update DNS stats for '%s': %s", factory.targetDomain, err.value))
 
         self.log.debug("Factory [%s] contains '%d' recipients", factory.targetDomain, factory.get_recipients_count())
         if testing:
-            address = self.fake_target_ip
-            port = self.fake_target_port
+            return self._connect(self.fake_target_ip, self.fake_target_port, factory)
+        if not self.mxs:
+            self.mxs = [(0, address) for address in addresses]
+        d = self._resolve_mxs()
+        d.addCallback(lambda _: self._connect(self._next_mx(), port, factory))
+        return d
+
+    def _connect(self, mx, port, factory):
+        self.mx_name = mx
+        self.mx_ip = self.mx_ips.get(mx, mx)
+        p = self.connection_pool and self.connection_pool.acquire(self.mx_ip, port, factory._username)
+        if p:
+            factory.adopt(p)
         else:
-            address = addresses[0]
-        self.mx_ip = address
-        reactor.connectTCP(address, port, factory)
+            reactor.connectTCP(self.mx_ip, port, factory)
         #noinspection PyTypeChecker
-        self.mx_in_use.append(address)
+        self.mx_in_use.append(mx)
         #pylint: enable-msg=E1101
 
         return factory.deferred
 
     def _ebExchange(self, err, factory, domain, recipients):
+        """
+        Handles a queue failure: DNS stats and recipients are updated in the database thread.
+
+        @return: a Deferred failing with `err` once the database is updated
+        """
         self.log.error('Error setting up managed relay factory for %s: %s', domain, repr(err))
         try:
             from twisted.names.error import DNSServerError, DNSQueryRefusedError, DNSNameError, DNSQueryTimeoutError, \
                 DomainError, AuthoritativeDomainError
 
-            domain_in_error = DomainStats.search_or_create(domain_name=domain)
-            fatal_errors_count = domain_in_error.dns_fatal_errors # keep the value before changing it with 'F()' function
-
             if err.check(DNSServerError):
                 err_msg = "DNS error! Maybe a bad defined domain."
-                DomainStats.add_dns_fatal_error(domain, err.value)
-                fatal_errors_count += 1
+                fatal = True
 
             elif err.check(error.DNSLookupError, AuthoritativeDomainError):
                 err_msg = "DNS lookup failed! This domain name doesn't exist."
-                DomainStats.add_dns_fatal_error(domain, err.value)
-                fatal_errors_count += 1
+                fatal = True
 
             elif err.check(DNSQueryRefusedError):
                 err_msg = "DNS query refused! Maybe a network problem."
-                DomainStats.add_dns_temp_error(domain, err.value)
+                fatal = False
 
             elif err.check(defer.TimeoutError, DNSQueryTimeoutError):
                 err_msg = "DNS Timeout! Can't get answer in a reasonable time."
-                DomainStats.add_dns_temp_error(domain, err.value)
+                fatal = False
 
             elif err.check(AttributeError):
                 err_msg = "Unknown error (was AttributeError). We will try later."
-                DomainStats.add_dns_temp_error(domain, err.value)
+                fatal = False
                 import traceback
                 self.log.error("Attribute error: %s\n%s", err.value, ''.join(traceback.format_exception(type(err.value), err.value, err.getTracebackObject())))
 
@@ -874,34 +1297,47 @@ class Queue(object):
                         err_msg = str(err.value.__name__)
                 else:
                     err_msg = str(err.value) or str(err)
-                DomainStats.add_dns_fatal_error(domain, err.value)
-                fatal_errors_count += 1
+                fatal = True
 
             self.log.error(err_msg)
 
-            for recipient in recipients:
-                # TODO use handle_recipient_failure()
-                if recipient.in_progress:    # here should be always true
-                    if fatal_errors_count < 5:
-                        recipient.update_send_status(RECIPIENT_STATUS.WARNING, smtp_message = err_msg)
-                        HourlyStats.add_try()
-                        recipient.set_send_mail_next_time()
-                        self.log.debug("Mailing [%d]: from <%s> recipient <%s> postponed to %s" % (recipient.mailing.id,
-                                                                                                   recipient.mail_from,
-                                                                                         recipient,
-                                                                                         recipient.next_try.isoformat(' ')))
-                    else:
-                        self.log.error("Max errors count reach (%d) for domain '%s', rejecting recipient '%s'",
-                                       fatal_errors_count, domain, recipient)
-                        recipient.update_send_status(RECIPIENT_STATUS.ERROR, smtp_message = err_msg)
-                        recipient.mark_as_finished()
-                        HourlyStats.add_failed()
-            return err
-
         except Exception:
             self.log.exception("Exception handling errors in Queue")
             raise
 
+        d = deferToDb(self._store_exchange_error, domain, err.value, fatal, err_msg, recipients)
+        d.addErrback(lambda failure: self.log.error("Exception handling errors in Queue: %s", failure.getTraceback()))
+        d.addCallback(lambda _: err)
+        return d
+
+    def _store_exchange_error(self, domain, ex, fatal, err_msg, recipients):
+        """Updates DNS stats of the domain, then postpones or rejects the recipients of the failed queue."""
+        domain_in_error = DomainStats.search_or_create(domain_name=domain)
+        fatal_errors_count = domain_in_error.dns_fatal_errors  # keep the value before changing it
+        if fatal:
+            DomainStats.add_dns_fatal_error(domain, ex)
+            fatal_errors_count += 1
+        else:
+            DomainStats.add_dns_temp_error(domain, ex)
+
+        for recipient in recipients:
+            # TODO use handle_recipient_failure()
+            if recipient.in_progress:    # here should be always true
+                if fatal_errors_count < 5:
+                    recipient.update_send_status(RECIPIENT_STATUS.WARNING, smtp_message = err_msg)
+                    HourlyStats.add_try()
+                    recipient.set_send_mail_next_time()
+                    self.log.debug("Mailing [%d]: from <%s> recipient <%s> postponed to %s" % (recipient['mailing'].id,
+                                                                                               recipient.mail_from,
+                                                                                     recipient,
+                                                                                     recipient.next_try.isoformat(' ')))
+                else:
+                    self.log.error("Max errors count reach (%d) for domain '%s', rejecting recipient '%s'",
+                                   fatal_errors_count, domain, recipient)
+                    recipient.update_send_status(RECIPIENT_STATUS.ERROR, smtp_message = err_msg)
+                    recipient.mark_as_finished()
+                    HourlyStats.add_failed()
+
     def _cbRecipient(self, recipient, factory):
         #self.log.debug("Recipient '%s' finished with success." % recipient)
         pass
@@ -912,7 +1348,7 @@ class Queue(object):
 
 
 class RecipientManager(object):
-    def __init__(self, factory, recipient, get_target_ip, log):
+    def __init__(self, factory, recipient, get_target_ip, log, memory_budget=None):
         assert(isinstance(recipient, MailingRecipient))
         self.factory = factory
         self.recipient = recipient
@@ -922,48 +1358,89 @@ class RecipientManager(object):
         self.log = log
         self.email_from = recipient.mail_from
         self.email_to   = recipient.email
-        self.mailing_id = recipient.mailing.id
+        self.mailing_id = recipient['mailing'].id
         self.temp_filename = None
-        
-    def send(self):
+        self.memory_budget = memory_budget
+        self.content = None
+        self.backup_customized_emails = False
+
+    def send(self, customized=None, lazy=False):
+        """
+        Customizes the email for this recipient, then adds it into the factory.
+
+        @param customized: optional result of a customization already done by the customization pool. It can be
+            a tuple (Message-ID, path or content) or the exception raised during customization.
+        @param lazy: if True, the email will be customized only when the factory is about to send it.
+        """
         if self.recipient.mailing.return_path_domain:
             email_from = "%s-%s@%s" % (self.recipient.mailing.id, self.recipient.tracking_id,
                                        self.recipient.mailing.return_path_domain)
         else:
             email_from = self.email_from
         try:
-            uid, path = MailCustomizer(self.recipient,
-                                       self.recipient.mailing.read_tracking,
-                                       self.recipient.mailing.click_tracking,
-                                       self.recipient.mailing.url_encoding).customize()
-            self.temp_filename = path
-            self.factory.send_email(email_from, (self.email_to,), path)\
+            if lazy:
+                content = LazyCustomizedContent(self)
+            else:
+                content = self.customize(customized)
+            self.factory.send_email(email_from, (self.email_to,), content)\
                 .addCallbacks(self.onSuccess, self.onFailure)
 
-        except OSError as ex:
-            self.log.error("Mailing customizer failure for mailing %s and recipient %s: %s", self.email_from, self.email_to, str(ex))
-            if ex.errno == 2:  # No such file or directory
-                self.recipient.update_send_status(RECIPIENT_STATUS.WARNING, smtp_message = "Email customization temporary error: %s" % str(ex.message))
-            else:
-                self.recipient.update_send_status(RECIPIENT_STATUS.GENERAL_ERROR, smtp_message = str(ex))
+        except Exception as ex:
+            self.handle_send_error(ex)
 
-        except smtp.AddressError as ex:
-            self.log.error("[Mailing %s] Failed to add email '%s' to SMTPRelayerFactory: %s", self.email_from, self.email_to, ex.message)
-            self.recipient.update_send_status(RECIPIENT_STATUS.GENERAL_ERROR, smtp_message = ex.message)
-            self.recipient.mark_as_finished()
-            HourlyStats.add_failed()
-            DomainStats.add_failed(self.factory.targetDomain)
-            self.deferred.errback(Failure(ex))
+        return self.deferred
 
-        except Exception as ex:
-            self.log.exception("[Mailing %s] Failed to handle email '%s'", self.email_from, self.email_to)
+    def customize(self, customized=None):
+        """
+        Customizes the email for this recipient and returns its content (a path or an L{InMemoryContent}).
+
+        @param customized: see L{send}
+        """
+        mailing = self.recipient.mailing  # each access to recipient.mailing makes a db query
+        # kept to not query the mailing once the email is sent, in the reactor thread
+        self.backup_customized_emails = mailing.backup_customized_emails
+        if customized is None:
+            customized = MailCustomizer(self.recipient,
+                                        mailing.read_tracking,
+                                        mailing.click_tracking,
+                                        mailing.url_encoding,
+                                        mailing=mailing).customize(self.memory_budget)
+        elif isinstance(customized, Exception):
+            raise customized
+        uid, content = customized
+        if isinstance(content, bytes):
+            content = MailCustomizer.store_content(mailing, self.recipient.id, content, self.memory_budget)
+        if isinstance(content, InMemoryContent):
+            self.content = content
+        else:
+            self.temp_filename = content
+        return content
+
+    def handle_send_error(self, ex):
+        """
+        Updates the recipient when its email can't be customized or added into the factory (the email is not sent),
+        then fails the recipient deferred.
+        """
+        if isinstance(ex, OSError) and ex.errno == 2:  # No such file or directory
+            self.log.error("Mailing customizer failure for mailing %s and recipient %s: %s", self.email_from, self.email_to, str(ex))
+            self.recipient.update_send_status(RECIPIENT_STATUS.WARNING, smtp_message = "Email customization temporary error: %s" % str(ex))
+            self.recipient.set_send_mail_next_time()
+            HourlyStats.add_try()
+            DomainStats.add_try(self.factory.targetDomain)
+        else:
+            if isinstance(ex, OSError):
+                self.log.error("Mailing customizer failure for mailing %s and recipient %s: %s", self.email_from, self.email_to, str(ex))
+            elif isinstance(ex, smtp.AddressError):
+                self.log.error("[Mailing %s] Failed to add email '%s' to SMTPRelayerFactory: %s", self.email_from, self.email_to, str(ex))
+            else:
+                self.log.error("[Mailing %s] Failed to handle email '%s'", self.email_from, self.email_to, exc_info=ex)
             self.recipient.update_send_status(RECIPIENT_STATUS.GENERAL_ERROR, smtp_message = str(ex))
             self.recipient.mark_as_finished()
             HourlyStats.add_failed()
             DomainStats.add_failed(self.factory.targetDomain)
-            self.deferred.errback(Failure(ex))
-
-        return self.deferred
+        if self.content is not None:
+            self.content.release()
+        self.deferred.errback(Failure(ex))
 
     def onSuccess(self, data):
         logging.getLogger('mailing.out').info("MAILING [%d] SENT FROM <%s> TO <%s>", self.mailing_id,
@@ -972,9 +1449,12 @@ class RecipientManager(object):
         self.recipient.mark_as_finished()
         HourlyStats.add_sent()
         DomainStats.add_sent(self.factory.targetDomain)
-        # print Mailing._get_collection().find({'_id': self.mailing_id}, {'backup_customized_emails': True})[0]
+        RateControl.on_success(self.factory.targetDomain)
+        RateControl.on_success(self.get_target_ip())
+        if self.content is not None:
+            self.content.release()
         if self.temp_filename and os.path.exists(self.temp_filename):
-            if Mailing._get_collection().find({'_id': self.mailing_id}, {'backup_customized_emails': True})[0].get('backup_customized_emails', False):
+            if self.backup_customized_emails:
                 self.log.debug("Moving customized content '%s' to '%s' folder", os.path.basename(self.temp_filename), settings.CUSTOMIZED_CONTENT_FOLDER)
                 os.rename(self.temp_filename, os.path.join(settings.CUSTOMIZED_CONTENT_FOLDER, os.path.basename(self.temp_filename)))
                 self.log.debug(os.path.join(settings.CUSTOMIZED_CONTENT_FOLDER, os.path.basename(self.temp_filename)))
@@ -986,6 +1466,8 @@ class RecipientManager(object):
     
     def onFailure(self, err):
         handle_recipient_failure(err, self.recipient, self.email_from, self.email_to, self.get_target_ip(), self.log)
+        if self.content is not None:
+            self.content.release()
         if self.recipient.send_status in (RECIPIENT_STATUS.ERROR, RECIPIENT_STATUS.GENERAL_ERROR) \
                 and self.temp_filename and os.path.exists(self.temp_filename):
             self.log.debug("Deleting customized content: '%s'", self.temp_filename)
@@ -993,6 +1475,37 @@ class RecipientManager(object):
         self.deferred.errback(err)
 
 
+class LazyCustomizedContent(object):
+    """
+    Email content customized only when the SMTP relayer is about to send it (see L{SMTPRelayerFactory.send_email}).
+    """
+    def __init__(self, rcpt_manager):
+        self.rcpt_manager = rcpt_manager
+        self.content = None
+
+    def prepare(self):
+        d = deferToThread(self.rcpt_manager.customize)
+        d.addCallbacks(self._cb_customized, self._eb_customized)
+        return d
+
+    def _cb_customized(self, content):
+        self.content = content
+
+    def _eb_customized(self, err):
+        self.rcpt_manager.handle_send_error(err.value)
+        return err
+
+    def is_available(self):
+        if isinstance(self.content, str):
+            return os.path.exists(self.content)
+        return self.content is not None and self.content.is_available()
+
+    def open(self):
+        if isinstance(self.content, str):
+            return open(self.content, 'rb')
+        return self.content.open()
+
+
 def handle_recipient_failure(err, recipient, email_from, email_to, target_ip, log):
     assert(isinstance(recipient, MailingRecipient))
     if not recipient.in_progress:
@@ -1017,8 +1530,12 @@ def handle_recipient_failure(err, recipient, email_from, email_to, target_ip, lo
             code = exc.code
             resp = exc.resp
         if not code or code < 500:
+            if not code or code in THROTTLING_CODES:
+                # connection error or throttling reply
+                RateControl.on_deferral(domain_name.lower())
+                RateControl.on_deferral(target_ip)
             log.warn("WARNING sending mailing FROM <%s> TO <%s>: %s", email_from, email_to, resp)
-            logging.getLogger('mailing.out').warn("MAILING [%d] SOFTBOUNCED sending mailing FROM <%s> TO <%s>: %s", recipient.mailing.id, email_from, email_to, resp)
+            logging.getLogger('mailing.out').warn("MAILING [%d] SOFTBOUNCED sending mailing FROM <%s> TO <%s>: %s", recipient['mailing'].id, email_from, email_to, resp)
             recipient.update_send_status(RECIPIENT_STATUS.WARNING, smtp_code=code, smtp_message=resp, smtp_log=exc.log,
                                          target_ip=target_ip)
             recipient.set_send_mail_next_time()
@@ -1030,7 +1547,7 @@ def handle_recipient_failure(err, recipient, email_from, email_to, target_ip, lo
                                                                       recipient.next_try.isoformat(' '))
         else:
             log.error("ERROR sending mailing FROM <%s> TO <%s>: %s", email_from, email_to, resp)
-            logging.getLogger('mailing.out').error("MAILING [%d] ERROR sending mailing FROM <%s> TO <%s>: %s", recipient.mailing.id, email_from, email_to, resp)
+            logging.getLogger('mailing.out').error("MAILING [%d] ERROR sending mailing FROM <%s> TO <%s>: %s", recipient['mailing'].id, email_from, email_to, resp)
             recipient.update_send_status(RECIPIENT_STATUS.ERROR, smtp_code=code, smtp_message=resp, smtp_log=exc.log,
                                          target_ip=target_ip)
             recipient.mark_as_finished()
@@ -1038,7 +1555,7 @@ def handle_recipient_failure(err, recipient, email_from, email_to, target_ip, lo
             DomainStats.add_failed(domain_name)
     else:
         log.error("ERROR sending mailing FROM <%s> TO <%s>: %s", email_from, email_to, str(err))
-        logging.getLogger('mailing.out').error("MAILING [%d] ERROR sending mailing FROM <%s> TO <%s>", recipient.mailing.id, email_from, email_to)
+        logging.getLogger('mailing.out').error("MAILING [%d] ERROR sending mailing FROM <%s> TO <%s>", recipient['mailing'].id, email_from, email_to)
         recipient.update_send_status(RECIPIENT_STATUS.GENERAL_ERROR, smtp_message = str(err), target_ip=target_ip)
         recipient.mark_as_finished()
         HourlyStats.add_failed()
@@ -17,10 +17,19 @@
 
 import email
 import email.policy
+import logging
+import math
+import os
+import pickle
+import random
+import threading
 import time
 from datetime import datetime, timedelta
 
+from bson import ObjectId
 from mogo import Model, Field, EnumField, ReferenceField
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
 from twisted.internet import defer
 
 from ..common.db_common import get_db
@@ -49,6 +58,272 @@ recipient_status = (RECIPIENT_STATUS.UNVERIFIED,
                     )
 
 
+class WriteBehind(object):
+    """
+    Unit of work for recipients bookkeeping.
+
+    Once started, fields updates (by document) and inserts are kept in memory then written to the database by
+    `bulk_write` when L{flush} is called (periodically, and before any query depending on recipients states).
+    Successive updates of the same document are coalesced into a single `$set`.
+    All pending operations are also appended into a journal file, replayed at startup. Appends are buffered and the
+    journal is only rewritten and synced to disk on each flush, so a crash may still lose the last
+    `write_behind_delay` seconds of updates.
+
+    Until started, all writes are done immediately.
+    """
+    _lock = threading.Lock()
+    _flushLock = threading.Lock()
+    _updates = {}  # key = (collection name, _id), value = dict of fields to $set
+    _inserts = []  # list of (collection name, document)
+    _journal = None
+    journal_path = None
+    log = logging.getLogger('write_behind')
+
+    @staticmethod
+    def _get_database():
+        return MailingRecipient._get_collection().database
+
+    @classmethod
+    def is_active(cls):
+        return cls._journal is not None
+
+    @classmethod
+    def start(cls, journal_path):
+        """Replays the journal left by a previous run, then starts to delay writes."""
+        cls.journal_path = journal_path
+        # a crash during a journal rewrite may leave newer operations in the temporary journal
+        paths = [path for path in (journal_path, journal_path + '.tmp') if os.path.exists(path)]
+        if paths:
+            for path in paths:
+                with open(path, 'rb') as fd:
+                    while True:
+                        try:
+                            record = pickle.load(fd)
+                        except Exception:  # end of file or truncated record
+                            break
+                        cls._add(record)
+            cls.log.info("Replaying %d updates and %d inserts from write-behind journal",
+                         len(cls._updates), len(cls._inserts))
+            cls._write(cls._updates, cls._inserts)
+            cls._updates, cls._inserts = {}, []
+        cls._journal = open(journal_path, 'wb')
+        if os.path.exists(journal_path + '.tmp'):
+            os.remove(journal_path + '.tmp')
+
+    @classmethod
+    def stop(cls):
+        """Writes all pending operations and stops delaying writes."""
+        if cls.is_active():
+            cls.flush()
+            with cls._lock:
+                cls._journal.close()
+                cls._journal = None
+
+    @classmethod
+    def _add(cls, record):
+        if record[0] == 'u':
+            op, collection, _id, fields = record
+            cls._updates.setdefault((collection, _id), {}).update(fields)
+        else:
+            op, collection, document = record
+            cls._inserts.append((collection, document))
+
+    @classmethod
+    def _queue(cls, record):
+        with cls._lock:
+            if cls._journal is None:
+                return False
+            cls._add(record)
+            pickle.dump(record, cls._journal)
+            return True
+
+    @classmethod
+    def set_fields(cls, collection, _id, fields):
+        """Updates some fields of a document (`$set`)."""
+        if not cls._queue(('u', collection, _id, fields)):
+            cls._get_database()[collection].update_one({'_id': _id}, {'$set': fields})
+
+    @classmethod
+    def insert(cls, collection, document):
+        """Inserts a document. Returns True if the insert is delayed."""
+        document.setdefault('_id', ObjectId())  # needed to make journal replay idempotent
+        if not cls._queue(('i', collection, document)):
+            cls._get_database()[collection].insert_one(document)
+            return False
+        return True
+
+    @classmethod
+    def _write(cls, updates, inserts):
+        requests = {}  # key = collection name, value = list of operations
+        for (collection, _id), fields in updates.items():
+            requests.setdefault(collection, []).append(UpdateOne({'_id': _id}, {'$set': fields}))
+        for collection, document in inserts:
+            requests.setdefault(collection, []).append(InsertOne(document))
+        db = cls._get_database()
+        for collection, operations in requests.items():
+            try:
+                db[collection].bulk_write(operations, ordered=False)
+            except BulkWriteError as ex:
+                # Duplicate keys may happen when the journal is replayed
+                errors = [e for e in ex.details.get('writeErrors', []) if e.get('code') != 11000]
+                if errors:
+                    raise
+
+    @classmethod
+    def flush(cls):
+        """Writes all pending operations to the database."""
+        with cls._flushLock:
+            with cls._lock:
+                if not cls._updates and not cls._inserts:
+                    return
+                updates, inserts = cls._updates, cls._inserts
+                cls._updates, cls._inserts = {}, []
+            t0 = time.time()
+            try:
+                cls._write(updates, inserts)
+                cls.log.debug("%d updates and %d inserts written in %.3fs", len(updates), len(inserts),
+                              time.time() - t0)
+            except Exception:
+                cls.log.exception("Failed to write %d updates and %d inserts. Will retry later.",
+                                  len(updates), len(inserts))
+                with cls._lock:
+                    # newer operations have priority over the ones we failed to write
+                    for key, fields in cls._updates.items():
+                        updates.setdefault(key, {}).update(fields)
+                    cls._updates, cls._inserts = updates, inserts + cls._inserts
+            cls._rewrite_journal()
+
+    @classmethod
+    def _rewrite_journal(cls):
+        """
+        Replaces the journal by one containing only pending operations.
+
+        New operations are appended to the new journal as soon as it is created, and disk writes are done out of
+        `_lock`, so writers are never blocked by the disk sync.
+        """
+        tmp_path = cls.journal_path + '.tmp'
+        with cls._lock:
+            if cls._journal is None:
+                return
+            old_journal = cls._journal
+            cls._journal = open(tmp_path, 'wb')
+            for (collection, _id), fields in cls._updates.items():
+                pickle.dump(('u', collection, _id, fields), cls._journal)
+            for collection, document in cls._inserts:
+                pickle.dump(('i', collection, document), cls._journal)
+            cls._journal.flush()
+            new_journal = cls._journal
+        old_journal.close()
+        os.fsync(new_journal.fileno())
+        os.replace(tmp_path, cls.journal_path)
+
+
+class StatsCounters(object):
+    """
+    In-process aggregation of statistics counters.
+
+    Once started, `$inc` and `$set` operations on a same statistics entry (an hour, a domain, ...) are merged in
+    memory, then written with a single upsert per entry when L{flush} is called.
+    Until started, all updates are written immediately.
+    """
+    _lock = threading.Lock()
+    _flushLock = threading.Lock()
+    _pending = {}  # key = (collection name, selector items), value = {'$inc': {...}, '$set': {...}, ...}
+    _active = False
+    log = logging.getLogger('stats')
+
+    @classmethod
+    def is_active(cls):
+        return cls._active
+
+    @classmethod
+    def start(cls):
+        cls._active = True
+
+    @classmethod
+    def stop(cls):
+        """Writes pending counters and stops aggregating them."""
+        cls._active = False
+        cls.flush()
+
+    @staticmethod
+    def merge(pending, operations):
+        """
+        Merges operations into pending ones, as if they were applied one after the other.
+
+        @param pending: the pending operations, modified in place
+        @param operations: the operations to apply after pending ones
+        """
+        inc = pending.setdefault('$inc', {})
+        _set = pending.setdefault('$set', {})
+        for key, value in operations.get('$set', {}).items():
+            inc.pop(key, None)
+            _set[key] = value
+        for key, value in operations.get('$inc', {}).items():
+            if key in _set:
+                _set[key] += value
+            else:
+                inc[key] = inc.get(key, 0) + value
+        for key, value in operations.get('$setOnInsert', {}).items():
+            pending.setdefault('$setOnInsert', {}).setdefault(key, value)
+        return pending
+
+    @staticmethod
+    def _to_update(operations):
+        return dict((op, fields) for op, fields in operations.items() if fields)
+
+    @classmethod
+    def update(cls, collection, selector, operations):
+        """
+        Updates (or creates) the statistics entry matching the selector.
+
+        @param collection: the collection name
+        @param selector: dict of fields identifying the entry
+        @param operations: `$inc`, `$set` and `$setOnInsert` operations
+        """
+        if cls._active:
+            with cls._lock:
+                key = (collection, tuple(sorted(selector.items())))
+                cls.merge(cls._pending.setdefault(key, {}), operations)
+        else:
+            WriteBehind._get_database()[collection].update_one(selector, cls._to_update(operations), upsert=True)
+
+    @classmethod
+    def flush(cls):
+        """Writes all pending counters to the database, with one upsert per entry."""
+        with cls._flushLock:
+            with cls._lock:
+                if not cls._pending:
+                    return
+                pending = cls._pending
+                cls._pending = {}
+            requests = {}  # key = collection name, value = (list of pending keys, list of operations)
+            for key, operations in pending.items():
+                keys, requests_list = requests.setdefault(key[0], ([], []))
+                keys.append(key)
+                requests_list.append(UpdateOne(dict(key[1]), cls._to_update(operations), upsert=True))
+            db = WriteBehind._get_database()
+            failed = []  # keys of operations to retry
+            for collection, (keys, requests_list) in requests.items():
+                try:
+                    db[collection].bulk_write(requests_list, ordered=False)
+                except BulkWriteError as ex:
+                    # other operations succeeded: retrying them would count them twice
+                    errors = ex.details.get('writeErrors', [])
+                    cls.log.error("Failed to write %d statistics counters into '%s'. Will retry later.",
+                                  len(errors), collection)
+                    failed.extend(keys[e['index']] for e in errors)
+                except Exception:
+                    cls.log.exception("Failed to write statistics counters into '%s'. Will retry later.", collection)
+                    failed.extend(keys)
+            if failed:
+                with cls._lock:
+                    newer = cls._pending
+                    cls._pending = dict((key, pending[key]) for key in failed)
+                    for key, operations in newer.items():
+                        cls.merge(cls._pending.setdefault(key, {}), operations)
+
+
 class Mailing(Model):
     """Used to store headers and body."""
     # id              = models.IntegerField(primary_key=True)  # Should be the same as mailing_id in Master
@@ -127,6 +402,12 @@ class MailingRecipient(Model):
         self.modified = datetime.utcnow()
         return super(MailingRecipient, self).save(*args, **kwargs)
 
+    def save_fields(self, *fields):
+        """Saves only these fields, maybe later (see L{WriteBehind})."""
+        self.modified = datetime.utcnow()
+        WriteBehind.set_fields(self._get_collection().name, self.id,
+                               {field: getattr(self, field) for field in fields + ('modified',)})
+
     def set_send_mail_in_progress(self):
         self.send_status = RECIPIENT_STATUS.IN_PROGRESS
         if self.try_count is None:
@@ -136,14 +417,14 @@ class MailingRecipient(Model):
         if not self.first_try:
             self.first_try = datetime.utcnow()
         self.next_try = datetime.utcnow()
-        self.save()
+        self.save_fields('send_status', 'try_count', 'in_progress', 'first_try', 'next_try')
 
     def update_send_status(self, send_status, smtp_code=None, smtp_e_code=None, smtp_message=None, in_progress=False,
                            smtp_log=None, target_ip=None):
         """
         Updates the contact status.
         """
-        LiveStats.add_log(mailing_id = self.mailing.id, domain_name=self.domain_name,
+        LiveStats.add_log(mailing_id = self['mailing'].id, domain_name=self.domain_name,
                           mail_from=self.mail_from, mail_to=self.email,
                           send_status=send_status, reply_code=smtp_code, reply_enhanced_code=smtp_e_code,
                           reply_text=smtp_message, target_ip=target_ip)
@@ -155,7 +436,8 @@ class MailingRecipient(Model):
         self.reply_text = smtp_message and force_str(smtp_message, errors='replace') or None
         self.smtp_log = smtp_log and str(smtp_log, errors='replace') or None
         self.in_progress = in_progress
-        self.save()
+        self.save_fields('send_status', 'next_try', 'reply_code', 'reply_enhanced_code', 'reply_text', 'smtp_log',
+                         'in_progress')
         #if send_status in (RECIPIENT_STATUS.ERROR, RECIPIENT_STATUS.GENERAL_ERROR):
             #self.contact.status = CONTACT_STATUS.ERROR
             #self.contact.save()
@@ -175,11 +457,11 @@ class MailingRecipient(Model):
         else:
             self.next_try = datetime.utcnow() + timedelta(hours=6)
         self.finished = True
-        self.save()
+        self.save_fields('in_progress', 'next_try', 'finished')
 
     def mark_as_finished(self):
         self.finished = True
-        self.save()
+        self.save_fields('finished')
 
 
 class HourlyStats(Model):
@@ -192,14 +474,10 @@ class HourlyStats(Model):
 
     @staticmethod
     def __generic_update(operations):
-        r = HourlyStats.update({'epoch_hour': int(time.time() / 3600)},
-                               dict(operations, **{'$set': {'up_to_date': False}}),
-                               upsert=True,
-                               w=1)
-        if r is None or not r['updatedExisting']:
-            # entry = HourlyStats.search_or_create(epoch_hour=int(time.time() / 3600))
-            entry = HourlyStats.grab(r['upserted'])
-            entry.update(date=datetime.utcnow().replace(minute=0, second=0, microsecond=0))
+        epoch_hour = int(time.time() / 3600)
+        StatsCounters.update(HourlyStats._get_collection().name, {'epoch_hour': epoch_hour},
+                             dict(operations, **{'$set': {'up_to_date': False},
+                                                 '$setOnInsert': {'date': datetime.utcfromtimestamp(epoch_hour * 3600)}}))
 
     @staticmethod
     def add_sent():
@@ -262,30 +540,31 @@ class DomainStats(Model):
     @staticmethod
     def __generic_update(domain, operations):
         operations.setdefault('$set', {})['modified'] = datetime.utcnow()
-        r = DomainStats.update({'domain_name': domain},
-                               operations,
-                               upsert=True)
-        # if r is None or not r['updatedExisting']:
-        #     entry = DomainStats.search_or_create(domain_name=domain)
-        #     kwargs = {}
-        #     for key, value in operations['$inc'].items():
-        #         kwargs[key] = value
-        #     entry.update(date=datetime.utcnow().replace(minute=0, second=0, microsecond=0), **kwargs)
+        DomainNotations.apply(domain, operations)
+        DomainStats.update({'domain_name': domain},
+                           operations,
+                           upsert=True)
+
+    @staticmethod
+    def __aggregated_update(domain, operations):
+        operations.setdefault('$set', {})['modified'] = datetime.utcnow()
+        DomainNotations.apply(domain, operations)
+        StatsCounters.update(DomainStats._get_collection().name, {'domain_name': domain}, operations)
 
     @staticmethod
     def add_sent(domain):
-        DomainStats.__generic_update(domain, {'$inc': {'sent': 1, 'tries': 1, 'consecutive_sent': 1},
-                                              '$set': {'consecutive_failed': 0}})
+        DomainStats.__aggregated_update(domain, {'$inc': {'sent': 1, 'tries': 1, 'consecutive_sent': 1},
+                                                 '$set': {'consecutive_failed': 0}})
 
     @staticmethod
     def add_failed(domain):
-        DomainStats.__generic_update(domain, {'$inc': {'failed': 1, 'tries': 1, 'consecutive_failed': 1},
-                                              '$set': {'consecutive_sent': 0}})
+        DomainStats.__aggregated_update(domain, {'$inc': {'failed': 1, 'tries': 1, 'consecutive_failed': 1},
+                                                 '$set': {'consecutive_sent': 0}})
 
     @staticmethod
     def add_try(domain):
-        DomainStats.__generic_update(domain, {'$inc': {'tries': 1, 'consecutive_failed': 1},
-                                              '$set': {'consecutive_sent': 0}})
+        DomainStats.__aggregated_update(domain, {'$inc': {'tries': 1, 'consecutive_failed': 1},
+                                                 '$set': {'consecutive_sent': 0}})
 
     @staticmethod
     def add_dns_success(domain):
@@ -348,6 +627,81 @@ class DomainStats(Model):
         return {r['domain_name']: r['note'] for r in results}
 
 
+class DomainNotations(object):
+    """
+    In-process cache of domains notations, same as L{DomainStats.get_domains_notation} but without any aggregation.
+
+    Entries are loaded from DomainStats on first use, then maintained by DomainStats updates. The notation decreases
+    with the age of the last update, so it is computed on read.
+    DomainStats documents (persisted by L{StatsCounters}) stay the reference at startup.
+    """
+    _lock = threading.Lock()
+    _entries = {}  # key = domain name, value = [consecutive_sent, consecutive_failed, modified, last used]
+    load_chunk_size = 1000
+
+    @staticmethod
+    def compute(consecutive_sent, consecutive_failed, modified, now):
+        if modified is None:
+            return 0
+        age_hours = (now - modified).total_seconds() / 3600
+        return (consecutive_sent - (math.exp(min(consecutive_failed, 5)) - 1)) / max(0.1, age_hours)
+
+    @classmethod
+    def load(cls, domains):
+        """Loads missing domains, with one query per chunk of domains."""
+        now = datetime.utcnow()
+        with cls._lock:
+            missing = [domain for domain in set(domains) if domain not in cls._entries]
+        for i in range(0, len(missing), cls.load_chunk_size):
+            chunk = missing[i:i + cls.load_chunk_size]
+            entries = dict((domain, [0, 0, None, now]) for domain in chunk)
+            for doc in DomainStats._get_collection().find({'domain_name': {'$in': chunk}},
+                                                          projection=('domain_name', 'consecutive_sent',
+                                                                      'consecutive_failed', 'modified')):
+                entries[doc['domain_name']] = [doc.get('consecutive_sent') or 0, doc.get('consecutive_failed') or 0,
+                                               doc.get('modified'), now]
+            with cls._lock:
+                for domain, entry in entries.items():
+                    cls._entries.setdefault(domain, entry)
+
+    @classmethod
+    def get(cls, domain, now=None):
+        """Returns the notation of a domain."""
+        if domain not in cls._entries:
+            cls.load([domain])
+        now = now or datetime.utcnow()
+        with cls._lock:
+            entry = cls._entries[domain]
+            entry[3] = now
+            return cls.compute(entry[0], entry[1], entry[2], now)
+
+    @classmethod
+    def apply(cls, domain, operations):
+        """Applies DomainStats update operations to the cached domain, if any."""
+        with cls._lock:
+            entry = cls._entries.get(domain)
+            if entry is None:
+                return
+            for i, field in enumerate(('consecutive_sent', 'consecutive_failed')):
+                if field in operations.get('$set', {}):
+                    entry[i] = operations['$set'][field]
+                entry[i] += operations.get('$inc', {}).get(field, 0)
+            entry[2] = operations.get('$set', {}).get('modified', entry[2])
+
+    @classmethod
+    def cleanup(cls, max_idle=3600):
+        """Forgets domains not used since `max_idle` seconds."""
+        limit = datetime.utcnow() - timedelta(seconds=max_idle)
+        with cls._lock:
+            for domain in [domain for domain, entry in cls._entries.items() if entry[3] < limit]:
+                del cls._entries[domain]
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._entries = {}
+
+
 class DomainConfiguration(Model):
     domain_name = Field(required=True)
 #   - 'active_relayers': list of active relayers for this domain
@@ -365,10 +719,15 @@ class ActiveQueue(Model):
     created = Field(datetime, default=datetime.utcnow)
 
 
-class LiveStats():
+class LiveStats(object):
     """
     Register all tries to allow to compute real time statistics on errors, success, softbounces, etc...
     Statistics should be by domain, by MX and by mailing
+
+    Logs can be disabled or sampled. If `batch_size` is set, they are only buffered in memory, then written by
+    batches (`insert_many`) when L{flush} is called (periodically, out of the reactor thread) into the `live_stats`
+    collection, which expires old entries (TTL index) or is capped (see `init_satellite_db()`).
+    This is best effort: a batch that can't be written is lost.
     """
     # mailing_id      = Field(int)
     # domain_name     = Field()
@@ -380,23 +739,48 @@ class LiveStats():
     # reply_code      = Field(int)
     # reply_enhanced_code = Field()
     # reply_text      = Field()
-
-    @staticmethod
-    def add_log(mailing_id, domain_name, mail_from, mail_to, send_status, reply_code, reply_enhanced_code, reply_text,
-                target_ip):
-        db = get_db()
-        now = datetime.utcnow()
-        l = [
-            db.live_stats.insert_one({'date': now,
-                                      'mailing_id': mailing_id, 'domain_name': domain_name, 'ip': target_ip,
-                                      'mail_from': mail_from, 'mail_to': mail_to, 'send_status': send_status,
-                                      'reply_code': reply_code, 'reply_enhanced_code': reply_enhanced_code,
-                                      'reply_text': reply_text}),
-            db.live_stats2.insert_one({'date': now,
-                                       'mailing_id': mailing_id, 'domain_name': domain_name, 'ip': target_ip,
-                                       'mail_from': mail_from, 'mail_to': mail_to, 'send_status': send_status,
-                                       'reply_code': reply_code, 'reply_enhanced_code': reply_enhanced_code,
-                                       'reply_text': reply_text})
-        ]
-
-        return defer.DeferredList(l)
+    enabled = True
+    sampling_rate = 1.0  # ratio of logged tries, between 0 and 1
+    batch_size = 0  # if > 0, logs are buffered and written by batches of this size on flush
+    _lock = threading.Lock()
+    _buffer = []
+    log = logging.getLogger('stats')
+
+    @classmethod
+    def configure(cls, enabled=True, sampling_rate=1.0, batch_size=0):
+        cls.enabled = enabled
+        cls.sampling_rate = sampling_rate
+        cls.batch_size = batch_size
+
+    @classmethod
+    def add_log(cls, mailing_id, domain_name, mail_from, mail_to, send_status, reply_code, reply_enhanced_code,
+                reply_text, target_ip):
+        if not cls.enabled or (cls.sampling_rate < 1 and random.random() >= cls.sampling_rate):
+            return defer.succeed(None)
+        document = {'date': datetime.utcnow(),
+                    'mailing_id': mailing_id, 'domain_name': domain_name, 'ip': target_ip,
+                    'mail_from': mail_from, 'mail_to': mail_to, 'send_status': send_status,
+                    'reply_code': reply_code, 'reply_enhanced_code': reply_enhanced_code,
+                    'reply_text': reply_text}
+        if cls.batch_size <= 0:
+            return get_db().live_stats.insert_one(document)
+        with cls._lock:
+            cls._buffer.append(document)
+        return defer.succeed(None)
+
+    @classmethod
+    def flush(cls):
+        """Writes buffered logs."""
+        with cls._lock:
+            if not cls._buffer:
+                return
+            documents = cls._buffer
+            cls._buffer = []
+        batch_size = cls.batch_size or len(documents)
+        collection = WriteBehind._get_database().live_stats
+        for i in range(0, len(documents), batch_size):
+            batch = documents[i:i + batch_size]
+            try:
+                collection.insert_many(batch, ordered=False)
+            except Exception:
+                cls.log.exception("Failed to write %d live stats. They are lost.", len(batch))
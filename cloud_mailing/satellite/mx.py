@@ -15,7 +15,10 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import logging
+import os
+
 from twisted.internet import defer
 from twisted.internet.error import DNSLookupError
 from twisted.mail.relaymanager import CanonicalNameLoop, CanonicalNameChainTooLong
@@ -48,6 +51,10 @@ class MXCalculator:
         self.clock = clock
 
 
+    def getHostByName(self, name):
+        """Returns a Deferred fired with the IP address of the host."""
+        return self.resolver.getHostByName(name)
+
     def markBad(self, mx):
         """Indicate a given mx host is not currently functioning.
 
@@ -226,12 +233,220 @@ class MXCalculator:
         return failure
 
 
+class DnsCache(object):
+    """
+    Resolver wrapper caching MX and A lookups.
+
+    Entries are kept during their TTL (bounded by `min_ttl` and `max_ttl`). Unknown domains (NXDOMAIN) are cached
+    during the SOA minimum TTL, or `negative_ttl` if the SOA is not available. Expired entries are still used during
+    `stale_ttl` seconds while they are refreshed in background, or if the refresh fails.
+    The cache can be saved into a file and loaded at startup, so it survives satellite restarts.
+    Entries no longer usable are dropped by L{cleanup}, and the cache holds at most `max_entries` entries (the ones
+    expiring first are evicted).
+    """
+    def __init__(self, resolver, clock=None, min_ttl=60, max_ttl=86400, negative_ttl=300, stale_ttl=3600,
+                 max_entries=100000):
+        self.log = logging.getLogger('dns_cache')
+        self.resolver = resolver
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.entries = {}  # key = (record type, name), value = (expiration time, records or None for NXDOMAIN)
+        self._pending = {}  # key = (record type, name), value = list of Deferreds waiting for the running lookup
+
+    def lookupMailExchange(self, name, timeout=None):
+        return self._lookup('MX', name.lower())
+
+    def getHostByName(self, name, timeout=None):
+        d = self._lookup('A', name.lower())
+        d.addCallback(self._cbGetHost, name)
+        return d
+
+    @staticmethod
+    def _cbGetHost(addresses, name):
+        if not addresses:
+            raise DNSLookupError(name)
+        return addresses[0]
+
+    def _lookup(self, record_type, name):
+        key = (record_type, name)
+        entry = self.entries.get(key)
+        now = self.clock.seconds()
+        if entry is not None and now < entry[0]:
+            return self._make_result(key, entry)
+        if entry is not None and entry[1] is not None and now < entry[0] + self.stale_ttl:
+            self._refresh(key).addErrback(lambda err: None)  # stale entry: refreshed in background
+            return self._make_result(key, entry)
+        return self._refresh(key)
+
+    def _refresh(self, key):
+        d = defer.Deferred()
+        if key in self._pending:
+            self._pending[key].append(d)
+            return d
+        self._pending[key] = [d]
+        record_type, name = key
+        if record_type == 'MX':
+            lookup = self.resolver.lookupMailExchange(name)
+        else:
+            lookup = self.resolver.lookupAddress(name)
+        lookup.addCallbacks(self._cbLookup, self._ebLookup, callbackArgs=(key,), errbackArgs=(key,))
+        return d
+
+    def _cbLookup(self, result, key):
+        from twisted.names import dns
+        answers = result[0]
+        if key[0] == 'MX':
+            records = [('MX', str(r.name), r.payload.preference, str(r.payload.name)) for r in answers
+                       if r.type == dns.MX]
+            records.extend(('CNAME', str(r.name), str(r.payload.name)) for r in answers if r.type == dns.CNAME)
+        else:
+            records = [r.payload.dottedQuad() for r in answers if r.type == dns.A]
+        if records:
+            ttl = max(self.min_ttl, min([self.max_ttl] + [r.ttl for r in answers]))
+        else:
+            ttl = self.negative_ttl
+        self._store(key, (self.clock.seconds() + ttl, records))
+
+    def _ebLookup(self, err, key):
+        from twisted.names import error as dns_error
+        if err.check(dns_error.DNSNameError):
+            ttl = self.negative_ttl
+            message = err.value.args and err.value.args[0]
+            for rr in getattr(message, 'authority', []):
+                if hasattr(rr.payload, 'minimum'):
+                    ttl = min(rr.ttl, rr.payload.minimum)
+            self._store(key, (self.clock.seconds() + ttl, None))
+            return
+        entry = self.entries.get(key)
+        waiters = self._pending.pop(key, [])
+        if entry is not None and entry[1] is not None and self.clock.seconds() < entry[0] + self.stale_ttl:
+            self.log.warning("DNS error for %s %s: using stale entry (%s)", key[0], key[1], err.value)
+            for d in waiters:
+                self._make_result(key, entry).chainDeferred(d)
+        else:
+            for d in waiters:
+                d.errback(err)
+
+    def _store(self, key, entry):
+        self.entries[key] = entry
+        if len(self.entries) > self.max_entries:
+            self.cleanup()
+        for d in self._pending.pop(key, []):
+            self._make_result(key, entry).chainDeferred(d)
+
+    def _make_result(self, key, entry):
+        from twisted.names import dns, error as dns_error
+        expiration, records = entry
+        if records is None:
+            return defer.fail(dns_error.DNSNameError(key[1]))
+        if key[0] == 'A':
+            return defer.succeed(list(records))
+        ttl = max(0, int(expiration - self.clock.seconds()))
+        answers = []
+        for record in records:
+            if record[0] == 'MX':
+                answers.append(RRHeader(name=record[1], type=dns.MX, ttl=ttl,
+                                        payload=Record_MX(record[2], record[3], ttl=ttl)))
+            else:
+                answers.append(RRHeader(name=record[1], type=dns.CNAME, ttl=ttl,
+                                        payload=dns.Record_CNAME(record[2], ttl=ttl)))
+        return defer.succeed((answers, [], []))
+
+    def _is_usable(self, entry, now):
+        expiration, records = entry
+        return now < expiration + (self.stale_ttl if records is not None else 0)
+
+    def cleanup(self):
+        """
+        Drops entries that can't be used anymore (even as stale entries). If the cache is still too big, the entries
+        expiring first are evicted, down to 90% of `max_entries` so this isn't done on each new entry.
+        """
+        now = self.clock.seconds()
+        for key in [key for key, entry in self.entries.items() if not self._is_usable(entry, now)]:
+            del self.entries[key]
+        if len(self.entries) > self.max_entries:
+            keys = sorted(self.entries, key=lambda k: self.entries[k][0])
+            for key in keys[:len(keys) - int(self.max_entries * 0.9)]:
+                del self.entries[key]
+
+    def save(self, path):
+        """Writes entries that are still usable into a JSON file."""
+        now = self.clock.seconds()
+        entries = [[record_type, name, expiration, records]
+                   for (record_type, name), (expiration, records) in self.entries.items()
+                   if self._is_usable((expiration, records), now)]
+        try:
+            with open(path + '.tmp', 'wt') as fp:
+                json.dump(entries, fp)
+            os.replace(path + '.tmp', path)
+        except (IOError, OSError):
+            self.log.exception("Can't save DNS cache into '%s'", path)
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'rt') as fp:
+                entries = json.load(fp)
+        except (IOError, OSError, ValueError):
+            self.log.exception("Can't load DNS cache from '%s'", path)
+            return
+        now = self.clock.seconds()
+        for record_type, name, expiration, records in entries:
+            if records is not None:
+                records = [tuple(r) if isinstance(r, list) else r for r in records]
+            if self._is_usable((expiration, records), now):
+                self.entries[(record_type, name)] = (expiration, records)
+        if len(self.entries) > self.max_entries:
+            self.cleanup()
+        self.log.info("%d DNS entries loaded from '%s'", len(self.entries), path)
+
+
+class DnsPrefetcher(object):
+    """
+    Resolves MX and A records of domains before their queues are started, so the DNS cache (see L{DnsCache}) is
+    warm when relayers need it. At most `concurrency` domains are resolved at the same time.
+    """
+    def __init__(self, mxcalc, concurrency=20):
+        self.log = logging.getLogger('mx_calc')
+        self.mxcalc = mxcalc
+        self.semaphore = defer.DeferredSemaphore(concurrency)
+        self._running = set()  # domains being resolved
+
+    def prefetch(self, domains):
+        """
+        Starts resolution of the given domains.
+
+        @return: a Deferred fired once all domains are resolved (successfully or not)
+        """
+        domains = set(domains) - self._running
+        self._running.update(domains)
+        return defer.DeferredList([self.semaphore.run(self._resolve, domain) for domain in domains])
+
+    def _resolve(self, domain):
+        d = self.mxcalc.getMX(domain)
+        d.addCallback(lambda mxs: defer.DeferredList([self.mxcalc.getHostByName(str(mx.name)) for mx in mxs],
+                                                     consumeErrors=True))
+        d.addErrback(lambda err: self.log.debug("Prefetch of domain '%s' failed: %s", domain, err.value))
+        d.addBoth(lambda _: self._running.discard(domain))
+        return d
+
+
 class FakedMXCalculator:
     def getMX(self, domain):
         return defer.succeed([RRHeader(name=domain,
                                        type=Record_MX.TYPE,
                                        payload=Record_MX(1, 'localhost',))])
 
+    def getHostByName(self, name):
+        return defer.succeed(name)
+
     def markBad(self, ip):
         pass
 
@@ -0,0 +1,115 @@
+# Copyright 2015-2019 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+
+__author__ = 'Cedric RICARD'
+
+# SMTP replies meaning the remote server throttles us
+THROTTLING_CODES = (421, 451)
+
+
+class RateControl(object):
+    """
+    In-process AIMD (additive increase, multiplicative decrease) control of the concurrent connections to each
+    destination. A destination is a domain name or an MX IP address.
+
+    Each successful delivery grows the destination window by 1/window (about one more connection per window of
+    successes). A throttling reply or a connection error shrinks it by `decrease_factor` and pauses new connections to
+    the destination for a backoff delay, doubled on each consecutive deferral.
+    """
+    _lock = threading.Lock()
+    _entries = {}  # key = destination, value = [window, max window, backoff, paused until, last used]
+    enabled = False
+    max_window = 20
+    decrease_factor = 0.5
+    min_backoff = 60
+    max_backoff = 3600
+
+    @classmethod
+    def configure(cls, enabled=True, max_window=20, min_backoff=60, max_backoff=3600):
+        cls.enabled = enabled
+        cls.max_window = max_window
+        cls.min_backoff = min_backoff
+        cls.max_backoff = max_backoff
+
+    @classmethod
+    def get_limit(cls, destination, initial, maximum=None, now=None):
+        """
+        Returns how many connections to the destination are allowed now (0 while it is paused).
+
+        @param initial: the window of an unknown destination (static limit if rate control is disabled)
+        @param maximum: the highest window allowed for this destination (default: max(`max_window`, `initial`))
+        """
+        if not cls.enabled:
+            return initial
+        now = now or time.time()
+        if maximum is None:
+            maximum = max(cls.max_window, initial)
+        with cls._lock:
+            entry = cls._entries.get(destination)
+            if entry is None:
+                entry = cls._entries[destination] = [float(min(initial, maximum)), maximum, 0, 0, now]
+            entry[1] = maximum
+            entry[4] = now
+            if now < entry[3]:
+                return 0
+            return max(1, int(min(entry[0], maximum)))
+
+    @classmethod
+    def on_success(cls, destination, now=None):
+        """Grows the window of the destination."""
+        with cls._lock:
+            entry = cls._entries.get(destination)
+            if entry is None:
+                return
+            entry[0] = min(entry[1], entry[0] + 1.0 / entry[0])
+            entry[2] = 0
+            entry[4] = now or time.time()
+
+    @classmethod
+    def on_deferral(cls, destination, now=None):
+        """
+        Shrinks the window of the destination and pauses it. Deferrals received while the destination is paused are
+        consequences of the same congestion, so they are ignored.
+        """
+        now = now or time.time()
+        with cls._lock:
+            entry = cls._entries.get(destination)
+            if entry is None or now < entry[3]:
+                return
+            entry[0] = max(1.0, entry[0] * cls.decrease_factor)
+            entry[2] = min(cls.max_backoff, entry[2] * 2 or cls.min_backoff)
+            entry[3] = now + entry[2]
+            entry[4] = now
+        logging.getLogger('rate_control').info("Destination '%s' throttled: window reduced to %d, paused for %ds",
+                                               destination, entry[0], entry[2])
+
+    @classmethod
+    def cleanup(cls, max_idle=3600):
+        """Forgets destinations not used since `max_idle` seconds."""
+        limit = time.time() - max_idle
+        with cls._lock:
+            for destination in [d for d, entry in cls._entries.items() if entry[4] < limit and entry[3] < limit]:
+                del cls._entries[destination]
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._entries = {}
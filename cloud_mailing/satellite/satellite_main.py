@@ -17,7 +17,6 @@
 
 import logging
 
-import pymongo
 import twisted
 from mogo import connect
 from twisted.application import internet
@@ -25,11 +24,12 @@ from twisted.application.service import IService
 from twisted.internet import reactor, ssl
 from twisted.python.log import PythonLoggingObserver
 
-from ..common.db_common import Db, create_index
+from ..common.db_common import Db
 from .. import __version__ as VERSION
 from ..common import settings
 from ..common.cm_logging import configure_logging
 from ..common import colored_log
+from .db_initialization import init_satellite_db
 
 service_satellite = None
 
@@ -75,15 +75,6 @@ def stop_satellite_service():
         #     service_satellite.disconnect()  # don't known the function name
 
 
-def init_db(db):
-    # db.create_collection("live_stats")
-    create_index(db.live_stats, [('date', pymongo.ASCENDING)], 'date_expiration', expireAfterSeconds=7 * 86400)
-    create_index(db.mailingrecipient, [('next_try', pymongo.ASCENDING)])
-    # nb = 700000
-    # if 'live_stats2' not in db.collection_names():
-    #     db.create_collection("live_stats2", capped=True, size=nb * 1024, max=nb)
-
-
 def main(application=None):
     """
     Startup sequence for CM Satellite
@@ -109,7 +100,7 @@ def main(application=None):
     db_conn = connect(settings.SATELLITE_DATABASE, uri=settings.SATELLITE_DATABASE_URI)
     Db.getInstance(settings.SATELLITE_DATABASE, uri=settings.SATELLITE_DATABASE_URI)
 
-    init_db(db_conn[settings.SATELLITE_DATABASE])
+    init_satellite_db(db_conn[settings.SATELLITE_DATABASE])
 
     # attach the service to its parent application
     start_satellite_service(application=application, master_ip=settings.MASTER_IP, master_port=settings.MASTER_PORT,
@@ -159,7 +159,10 @@ class EmailSender(smtplib.SMTP):
 
 from OpenSSL.SSL import SSLv3_METHOD
 
-from twisted.mail.smtp import ESMTPClient, ESMTPSenderFactory, DNSNAME, Address
+from collections import deque
+from functools import partial
+
+from twisted.mail.smtp import ESMTPClient, ESMTPSenderFactory, DNSNAME, Address, quoteaddr
 from twisted.internet.ssl import ClientContextFactory
 from twisted.internet import defer
 from twisted.internet import reactor, protocol, error
@@ -232,13 +235,14 @@ class RelayerMixin:
                                             
         n = self.factory.getNextEmail()
         if n:
-            fromEmail, toEmails, filename, deferred = n
-            if not os.path.exists(filename):
+            fromEmail, toEmails, content, deferred = n
+            if not self._is_content_available(content):
                 # content is removed from disk as soon as the mailing is closed
                 raise smtp.SMTPClientError(471, "Sending aborted. Mailing stopped.")
             self.fromEmail = fromEmail
             self.toEmails = toEmails
-            self.mailFile = open(filename, 'rb')
+            self.mailContent = content
+            self.mailFile = open(content, 'rb') if isinstance(content, str) else content.open()
             self.result = deferred
             #WHY? self.result.addBoth(self._removeDeferred)
             return str(self.fromEmail)
@@ -255,12 +259,168 @@ class RelayerMixin:
         """
         # Rewind the file in case part of it was read while attempting to
         # send the message.
-        if not os.path.exists(self.mailFile.name):
+        if not self._is_content_available(self.mailContent):
             # content is removed from disk as soon as the mailing is closed
             raise smtp.SMTPClientError(471, "Sending aborted. Mailing stopped.")
         self.mailFile.seek(0, 0)
         return self.mailFile
 
+    idle = False  # True while the connection is kept in a L{SMTPConnectionPool}
+
+    def smtpState_from(self, code, resp):
+        # Next email may still be in preparation (see SMTPRelayerFactory.send_email)
+        d = self.factory.waitNextEmail()
+        if d is None:
+            return self._sendNextEmailOrRelease(code, resp)
+
+        def _email_ready(_):
+            if not self.transport.disconnecting:
+                self.resetTimeout()
+                self._sendNextEmailOrRelease(code, resp)
+        d.addCallback(_email_ready)
+
+    def _sendNextEmailOrRelease(self, code, resp):
+        pool = self.factory.connectionPool
+        if pool is not None and not self.factory.mails:
+            self.factory.getNextEmail()  # no more email
+            if pool.release(self):
+                return
+        if (self.factory.pipelining and b'PIPELINING' in self.extensions) \
+                or (self.factory.chunkingThreshold and b'CHUNKING' in self.extensions):
+            self._startTransaction()
+        else:
+            super(RelayerMixin, self).smtpState_from(code, resp)
+
+    extensions = frozenset()  # ESMTP extensions supported by the server
+
+    def esmtpState_serverConfig(self, code, resp):
+        self.extensions = frozenset(line.split(None, 1)[0].upper() for line in resp.splitlines() if line.strip())
+        super(RelayerMixin, self).esmtpState_serverConfig(code, resp)
+
+    def _startTransaction(self):
+        """
+        Sends the next email using PIPELINING (RFC 2920) and/or BDAT (RFC 3030) commands, depending on the
+        extensions supported by the server. Without PIPELINING, commands are sent one by one, as SMTPClient does.
+        """
+        self._from = self.getMailFrom()
+        self._failresponse = self.smtpTransferFailed
+        if self._from is None:
+            return self._disconnectFromServer()
+        self._pipelining = self.factory.pipelining and b'PIPELINING' in self.extensions
+        self._chunking = False
+        if self.factory.chunkingThreshold and b'CHUNKING' in self.extensions:
+            self.mailFile.seek(0, os.SEEK_END)
+            self._mailSize = self.mailFile.tell()
+            self._chunking = self._mailSize >= self.factory.chunkingThreshold
+        self.toAddressesResult = []
+        self.successAddresses = []
+        self._mailFromFailure = None
+        self._commands = deque()  # (command, reply handler) not yet sent
+        self._replies = deque()  # reply handlers of sent commands
+        self._queueCommand(b"MAIL FROM:" + quoteaddr(self._from), self._onMailFrom)
+        for address in self.getMailTo():
+            self._queueCommand(b"RCPT TO:" + quoteaddr(address), partial(self._onRcpt, address))
+        if self._pipelining and not self._chunking:
+            self._queueCommand(b"DATA", self._onData)
+        self._expected = range(0, 1000)
+        self._okresponse = self._onReply
+        self._flushCommands()
+
+    def _queueCommand(self, command, handler):
+        self._commands.append((command, handler))
+
+    def _flushCommands(self):
+        while self._commands and (self._pipelining or not self._replies):
+            command, handler = self._commands.popleft()
+            self._replies.append(handler)
+            self.sendLine(command)
+
+    def _onReply(self, code, resp):
+        why = self._replies.popleft()(code, resp)
+        self._flushCommands()
+        return why
+
+    def _onMailFrom(self, code, resp):
+        if code not in smtp.SUCCESS:
+            self._mailFromFailure = (code, resp)
+            self._commands.clear()  # already pipelined commands will be rejected by the server
+        return self._onEnvelopeSent(code, resp)
+
+    def _onRcpt(self, address, code, resp):
+        if self._mailFromFailure is None:
+            self.toAddressesResult.append((address, code, resp))
+            if code in smtp.SUCCESS:
+                self.successAddresses.append(address)
+        return self._onEnvelopeSent(code, resp)
+
+    def _onEnvelopeSent(self, code, resp):
+        """Sends the message once all replies to MAIL FROM and RCPT TO commands are received."""
+        if self._replies or self._commands:
+            return
+        if self._mailFromFailure is not None:
+            return self.smtpTransferFailed(*self._mailFromFailure)
+        if not self.successAddresses:
+            return self.smtpState_msgSent(code, b"No recipients accepted")
+        if self._chunking:
+            self.mailFile.seek(0, 0)
+            self._chunksInFlight = 0
+            self._lastChunkSent = False
+            self._chunkFailure = None
+            self._okresponse = self._onChunk
+            return self._sendChunks()
+        self._queueCommand(b"DATA", self._onData)
+
+    def _onData(self, code, resp):
+        if code == 354:
+            if not self.successAddresses:
+                # Not RFC compliant server: there is no way to cancel the message
+                return self.sendError(smtp.SMTPProtocolError(code, b"DATA accepted without valid recipient",
+                                                             self.log.str()))
+            return self.smtpState_data(code, resp)
+        if self._mailFromFailure is not None:
+            return self.smtpTransferFailed(*self._mailFromFailure)
+        return self.smtpState_msgSent(code, resp)
+
+    def _sendChunks(self):
+        """Sends the message by BDAT chunks. With PIPELINING, the next chunk is sent without waiting the reply."""
+        while not self._lastChunkSent and self._chunksInFlight < (2 if self._pipelining else 1):
+            data = self.mailFile.read(self.factory.chunkSize).replace(b"\n", b"\r\n")
+            self._lastChunkSent = self.mailFile.tell() >= self._mailSize
+            self.sendLine(b"BDAT %d%s" % (len(data), b" LAST" if self._lastChunkSent else b""))
+            self.transport.write(data)
+            self._chunksInFlight += 1
+            self.resetTimeout()
+
+    def _onChunk(self, code, resp):
+        self._chunksInFlight -= 1
+        if code not in smtp.SUCCESS and self._chunkFailure is None:
+            self._chunkFailure = (code, resp)
+        if self._chunkFailure is not None:
+            if not self._chunksInFlight:
+                return self.smtpState_msgSent(*self._chunkFailure)
+        elif not self._lastChunkSent:
+            self._sendChunks()
+        elif not self._chunksInFlight:
+            # reply to the last chunk
+            return self.smtpState_msgSent(code, resp)
+
+    def timeoutConnection(self):
+        if self.idle:
+            self.sendLine(b"QUIT")
+            self.transport.loseConnection()
+        else:
+            super(RelayerMixin, self).timeoutConnection()
+
+    @staticmethod
+    def _is_content_available(content):
+        """
+        @param content: full path of the email file, or object kept in memory which provides `is_available()` and
+            `open()` methods.
+        """
+        if isinstance(content, str):
+            return os.path.exists(content)
+        return content.is_available()
+
     def sendError(self, exc):
         """
         If an error occurs before a mail message is sent sendError will be
@@ -379,6 +539,7 @@ class SMTPRelayerFactory(protocol.ClientFactory):
         self._connectionFailureErrback = connectionFailureErrback
         self._connectionClosedCallback = connectionClosedCallback
         self._dateStarted = datetime.now()
+        self.connectionPool = None  # if set, the connection is released into this pool instead of being closed
         self._lastLogOnConnectionLost = ""    # Used to track message returned by server in case of early rejection (before EHLO)
 
         self.retries = -retries
@@ -386,6 +547,14 @@ class SMTPRelayerFactory(protocol.ClientFactory):
         
         self.mails = []
         self.last_email = None
+        self.lookahead = 1  # number of emails prepared in advance
+        self.pipelining = True  # use PIPELINING (RFC 2920) if the server supports it
+        self.chunkingThreshold = 0  # if > 0, emails of this size or bigger are sent by BDAT (RFC 3030) if possible
+        self.chunkSize = 1024 * 1024  # size of BDAT chunks
+        self.maxRecipientsPerMail = 1  # if > 1, emails with same sender and same content are sent in one transaction
+        self._groups = {}  # key = (sender, content), value = (queued email, list of (Deferred, addresses count))
+        self._started = set()  # contents being or already prepared
+        self._waiting = {}  # key = content being prepared, value = list of Deferreds waiting for it
         self.deferred = defer.Deferred()
         self.log = logger or logging.getLogger("sendmail")
 
@@ -464,6 +633,7 @@ class SMTPRelayerFactory(protocol.ClientFactory):
         
     def buildProtocol(self, addr):
         self.log.debug("[%s] BuildProtocol for ip '%s'.", self.targetDomain, addr)
+        self._prepare_next_emails()
         p = self.protocol(secret=self._secret, contextFactory=None, identity=self.domain, logsize=len(self.mails)*2+2)
         p.debug = True  # to enable SMTP log
         p.heloFallback = self._heloFallback
@@ -478,6 +648,28 @@ class SMTPRelayerFactory(protocol.ClientFactory):
             p.registerAuthenticator(smtp.PLAINAuthenticator(self._username))
         return p
 
+    def adopt(self, p):
+        """
+        Sends emails using an already opened connection, taken from a L{SMTPConnectionPool}.
+
+        @param p: an idle L{SMTPRelayer}
+        """
+        connector = p.transport.connector
+        connector.factory = self
+        self.doStart()
+        self.log.debug("[%s] Reusing SMTP connection to '%s'.", self.targetDomain, connector.getDestination())
+        p.factory = self
+        p.idle = False
+        p.setTimeout(self.timeout)
+        self._prepare_next_emails()
+        p.smtpState_from(250, b'')
+
+    def detach(self, connector):
+        """Called when the connection is released into a pool: this factory has nothing more to do."""
+        if self._connectionClosedCallback:
+            self._connectionClosedCallback(connector)
+        self.doStop()
+
     def send_email(self, fromEmail, toEmails, fileName):
         """
         @param fromEmail: The RFC 2821 address from which to send this
@@ -486,19 +678,77 @@ class SMTPRelayerFactory(protocol.ClientFactory):
         @param toEmails: A sequence of RFC 2821 addresses to which to
         send this message.
 
-        @param fileName: A full path to the file containing the message to send.
+        @param fileName: A full path to the file containing the message to send, or an object providing
+        `is_available()` and `open()` methods (for messages kept in memory). This object may also provide a
+        `prepare()` method returning a Deferred: it will be called only when the email is about to be sent (see
+        `lookahead`), and the email will be dropped if the Deferred fails.
 
         @param deferred: A Deferred to callback or errback when sending
         of this message completes.
+
+        If L{maxRecipientsPerMail} is greater than 1, recipients of emails having the same sender and the same
+        content object are merged into a single transaction (one RCPT TO for each).
         """
         deferred = defer.Deferred()
         self.log.debug("Add %s into factory (%s)", ', '.join(toEmails), self.targetDomain)
+        if self.maxRecipientsPerMail > 1 and not hasattr(fileName, 'prepare'):
+            return self._add_to_group(fromEmail, toEmails, fileName, deferred)
         self.mails.insert(0, (Address(fromEmail), list(map(Address, toEmails)), fileName, deferred))
         return deferred
+
+    def _add_to_group(self, fromEmail, toEmails, fileName, deferred):
+        """
+        Adds the recipients to the queued email having the same sender and the same content, if any (see
+        L{maxRecipientsPerMail}). The returned Deferred only gets results of its own addresses.
+        """
+        group = self._groups.get((fromEmail, fileName))
+        if group is not None and len(group[0][1]) + len(toEmails) <= self.maxRecipientsPerMail:
+            entry, callers = group
+            entry[1].extend(map(Address, toEmails))
+            callers.append((deferred, len(toEmails)))
+            return deferred
+        callers = [(deferred, len(toEmails))]
+        entry = (Address(fromEmail), list(map(Address, toEmails)), fileName, defer.Deferred())
+        entry[3].addCallbacks(self._cbGroupSent, self._ebGroupSent, callbackArgs=(callers,), errbackArgs=(callers,))
+        self._groups[(fromEmail, fileName)] = (entry, callers)
+        self.mails.insert(0, entry)
+        return deferred
+
+    @staticmethod
+    def _cbGroupSent(result, callers):
+        """Maps the result of a grouped email back to each caller, using the response to each RCPT command."""
+        numOk, addresses = result
+        i = 0
+        for d, count in callers:
+            own_addresses = addresses[i:i + count]
+            i += count
+            accepted = [a for a in own_addresses if a[1] in smtp.SUCCESS]
+            if accepted:
+                d.callback((len(accepted), own_addresses))
+            else:
+                code, resp = own_addresses[0][1:] if own_addresses else (-1, b"No response for this recipient")
+                d.errback(Failure(smtp.SMTPDeliveryError(code, resp, b'', own_addresses)))
+
+    @staticmethod
+    def _ebGroupSent(err, callers):
+        i = 0
+        for d, count in callers:
+            if err.check(smtp.SMTPClientError) and err.value.addresses:
+                exc = err.value
+                own_addresses = exc.addresses[i:i + count]
+                i += count
+                d.errback(Failure(smtp.SMTPDeliveryError(exc.code, exc.resp, exc.log, own_addresses)))
+            else:
+                d.errback(err)
     
     def getNextEmail(self):
         try:
             self.last_email = self.mails.pop()
+            for key, group in list(self._groups.items()):
+                if group[0] is self.last_email:
+                    del self._groups[key]  # no more recipient can be added
+            self._started.discard(self.last_email[2])
+            self._prepare_next_emails()
             self.log.debug("Factory (%s) return next email: %s", self.targetDomain, self.last_email[1])
             return self.last_email
         except IndexError:
@@ -507,6 +757,119 @@ class SMTPRelayerFactory(protocol.ClientFactory):
             #self.deferred.callback(self.targetDomain) 
             return None
 
+    def waitNextEmail(self):
+        """
+        Returns a Deferred fired when the next email is ready to be sent, or None if it is already ready (or if
+        there is no more email).
+        """
+        self._prepare_next_emails()
+        if self.mails and self.mails[-1][2] in self._waiting:
+            d = defer.Deferred()
+            self._waiting[self.mails[-1][2]].append(d)
+            # the email may have been dropped, so the new next one has to be checked
+            d.addCallback(lambda _: self.waitNextEmail())
+            return d
+        return None
+
+    def _prepare_next_emails(self):
+        """Starts preparation of the next emails, within the lookahead window."""
+        for entry in reversed(self.mails[-self.lookahead:]):
+            content = entry[2]
+            if hasattr(content, 'prepare') and content not in self._started:
+                self._started.add(content)
+                self._waiting[content] = []
+                content.prepare().addBoth(self._cbPrepared, entry)
+
+    def _cbPrepared(self, result, entry):
+        waiters = self._waiting.pop(entry[2], [])
+        if isinstance(result, Failure):
+            self.log.debug("Factory (%s) drops email to %s: %s", self.targetDomain, entry[1], result.value)
+            self._started.discard(entry[2])
+            if entry in self.mails:
+                self.mails.remove(entry)
+        for d in waiters:
+            d.callback(None)
+
     def get_recipients_count(self):
         return len(self.mails)
         
+
+
+class SMTPConnectionPool(protocol.ClientFactory):
+    """
+    Keeps SMTP connections open once their emails are sent, to reuse them for the next emails sent to the same
+    server (MX or smarthost).
+
+    Connections are keyed by (host, port, username). Idle connections are closed after `idle_timeout` seconds.
+    While a connection is idle, this pool is the factory of its connector.
+    """
+    def __init__(self, idle_timeout=10, max_idle=4, logger=None):
+        """
+        @param idle_timeout: Period, in seconds, for which an idle connection is kept open.
+        @param max_idle: Maximum count of idle connections per key.
+        """
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.connections = {}  # key = (host, port, username), value = list of idle SMTPRelayer
+        self.log = logger or logging.getLogger("sendmail")
+
+    @staticmethod
+    def get_key(host, port, username=None):
+        return host, port, username
+
+    def acquire(self, host, port, username=None):
+        """
+        Returns an idle connection to this server, or None.
+        """
+        connections = self.connections.get(self.get_key(host, port, username), [])
+        while connections:
+            p = connections.pop()
+            if p.transport.connected and not p.transport.disconnecting:
+                self.doStop()
+                return p
+        return None
+
+    def release(self, p):
+        """
+        Keeps the connection open for later use.
+
+        @param p: a L{SMTPRelayer} which has no more email to send
+        @return: True if the connection is kept by the pool
+        """
+        if self.idle_timeout <= 0 or p.transport.disconnecting:
+            return False
+        connector = p.transport.connector
+        destination = connector.getDestination()
+        connections = self.connections.setdefault(self.get_key(destination.host, destination.port,
+                                                               p.factory._username), [])
+        if len(connections) >= self.max_idle:
+            return False
+        self.log.debug("[%s] Keeping SMTP connection to '%s' for %ds.", p.factory.targetDomain, destination,
+                       self.idle_timeout)
+        p.idle = True
+        # Any message from the server while idle (ie. timeout) ends the connection
+        p._expected = range(0, 1000)
+        p._okresponse = p.smtpState_disconnect
+        p.setTimeout(self.idle_timeout)
+        connections.append(p)
+        connector.factory = self
+        self.doStart()
+        p.factory.detach(connector)
+        return True
+
+    def clientConnectionLost(self, connector, reason):
+        destination = connector.getDestination()
+        for connections in self.connections.values():
+            for p in connections:
+                if p.transport.connector is connector:
+                    self.log.debug("Idle SMTP connection to '%s' closed.", destination)
+                    connections.remove(p)
+                    return
+
+    def close_all(self):
+        """Closes all idle connections."""
+        for connections in self.connections.values():
+            for p in connections:
+                p.sendLine(b"QUIT")
+                p.transport.loseConnection()
+        self.connections = {}
@@ -0,0 +1,104 @@
+# Copyright 2015-2019 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import email.parser
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+
+from ...common import settings
+from ...common.unittest_mixins import DatabaseMixin
+from .. import customization_pool
+from ..customization_pool import customize_recipients, _deferred_from_future, _init_worker, \
+    _evict_closed_mailings
+from ..db_thread import stop_db_threadpool
+from ..mail_customizer import MailCustomizer
+from . import factories
+
+__author__ = 'ricard'
+
+
+def _fail():
+    raise ValueError("customization error")
+
+
+class DeferredFromFutureTestCase(TestCase):
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def tearDown(self):
+        self.executor.shutdown(wait=True)
+
+    @defer.inlineCallbacks
+    def test_result(self):
+        result = yield _deferred_from_future(self.executor.submit(sum, (1, 2, 3)))
+        self.assertEqual(6, result)
+
+    def test_exception(self):
+        return self.assertFailure(_deferred_from_future(self.executor.submit(_fail)), ValueError)
+
+
+class WorkerCacheTestCase(TestCase):
+    def test_closed_mailings_are_evicted(self):
+        invalidated = []
+        self.patch(customization_pool, '_mailings', {1: 'mailing 1', 2: 'mailing 2', 3: None})
+        self.patch(MailCustomizer, 'invalidate_mailing_body', staticmethod(invalidated.append))
+
+        _evict_closed_mailings([2, 4])
+
+        self.assertEqual({2: 'mailing 2'}, customization_pool._mailings)
+        self.assertEqual([1, 3], sorted(invalidated))
+
+
+class CustomizationPoolTestCase(DatabaseMixin, TestCase):
+    timeout = 60
+
+    def setUp(self):
+        self.connect_to_db()
+        self.pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=_init_worker,
+                                        initargs=(settings.TEST_DATABASE, settings.SATELLITE_DATABASE_URI))
+
+    def tearDown(self):
+        self.pool.shutdown(wait=True)
+        stop_db_threadpool()
+        return self.disconnect_from_db()
+
+    @staticmethod
+    def parse(data):
+        message = email.parser.BytesParser().parsebytes(data)
+        del message['Date']
+        return message.as_bytes()
+
+    @defer.inlineCallbacks
+    def test_pool_gives_same_result_than_in_process_customization(self):
+        mailing = factories.MailingFactory()
+        recipients = [factories.RecipientFactory(mailing=mailing, contact_data={
+            'email': 'rcpt%d@domain.com' % i,
+            'custom': 'custom %d' % i,
+        }) for i in range(3)]
+
+        customized = yield customize_recipients(self.pool, recipients, in_memory=True)
+
+        self.assertEqual(set(r.id for r in recipients), set(customized))
+        for recipient in recipients:
+            message_id, data = MailCustomizer(recipient, mailing.read_tracking, mailing.click_tracking,
+                                              mailing.url_encoding, mailing=mailing).customize_in_memory()
+            self.assertEqual(message_id, customized[recipient.id][0])
+            self.assertEqual(self.parse(data), self.parse(customized[recipient.id][1]))
@@ -0,0 +1,46 @@
+# Copyright 2015-2019 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.trial.unittest import TestCase
+
+from ...common.unittest_mixins import DatabaseMixin
+from ..db_initialization import init_satellite_db, explain_hot_queries, INDEXES_VERSION
+from ..mailing_sender import MailingSender
+from . import factories
+
+__author__ = 'ricard'
+
+
+class DbInitializationTestCase(DatabaseMixin, TestCase):
+    def setUp(self):
+        self.connect_to_db()
+
+    def tearDown(self):
+        self.disconnect_from_db()
+
+    def test_indexes_are_created_once(self):
+        init_satellite_db(self.db_sync)
+        self.assertIn('queue_selection', self.db_sync.mailingrecipient.index_information())
+        self.assertEqual(1, self.db_sync['_migrations'].find({'name': 'indexes_v%d' % INDEXES_VERSION}).count())
+        init_satellite_db(self.db_sync)
+        self.assertEqual(1, self.db_sync['_migrations'].find({'name': 'indexes_v%d' % INDEXES_VERSION}).count())
+
+    def test_hot_queries_dont_scan_collections(self):
+        factories.RecipientFactory()
+        init_satellite_db(self.db_sync)
+        for name, stages, index_names in explain_hot_queries(self.db_sync, MailingSender.make_queue_filter()):
+            self.assertNotIn('COLLSCAN', stages, name)
@@ -19,15 +19,19 @@ import base64
 import email.message
 import email.parser
 import os
+import time
 
 import dkim
 from twisted.trial.unittest import TestCase
 
 from ...common.email_tools import header_to_unicode
+from ...common import settings
 from ...common.encoding import force_bytes
 from ..models import Mailing
 from . import factories
-from ..mail_customizer import MailCustomizer
+from .. import dkim_signer
+from ..dkim_signer import DkimSigner
+from ..mail_customizer import MailCustomizer, MemoryBudget, InMemoryContent
 from ...common.unittest_mixins import DatabaseMixin
 
 __author__ = 'ricard'
@@ -552,6 +556,120 @@ Nothing else to say...
                     '&t=http%3A//my.com/the_page%3Fid%3D123">click here</a></p>',
             new_content)
 
+    def test_templates_are_compiled_once_per_mailing(self):
+        mailing = factories.MailingFactory(tracking_url='http://tr.net/')
+        recipient1 = factories.RecipientFactory(mailing=mailing, contact_data={'email': 'john@company.com', 'id': 1})
+        recipient2 = factories.RecipientFactory(mailing=mailing, contact_data={'email': 'jane@company.com', 'id': 2})
+        content = '<p>Please <a href="http://my.com/the_page?id={{ id }}">click here</a></p>'
+
+        customizer1 = MailCustomizer(recipient1, read_tracking=False, click_tracking=True)
+        customizer2 = MailCustomizer(recipient2, read_tracking=False, click_tracking=True)
+        self.assertIs(customizer1._get_template(content, is_html=True), customizer2._get_template(content, is_html=True))
+        self.assertIsNot(customizer1._get_template(content, is_html=True), customizer1._get_template(content))
+        self.assertIn('id%3D1', customizer1._do_customization(content, recipient1.contact_data, is_html=True))
+        self.assertIn('id%3D2', customizer2._do_customization(content, recipient2.contact_data, is_html=True))
+
+        template = customizer1._get_template(content, is_html=True)
+        MailCustomizer.invalidate_mailing_body(mailing.id)
+        self.assertNotIn(mailing.id, MailCustomizer.templatesCache)
+        self.assertIsNot(template, customizer1._get_template(content, is_html=True))
+
+    def test_customize_in_memory(self):
+        mailing = factories.MailingFactory()
+        recipient1 = factories.RecipientFactory(mailing=mailing)
+        recipient2 = factories.RecipientFactory(mailing=mailing)
+        for recipient in (recipient1, recipient2):
+            fullpath = os.path.join(settings.MAIL_TEMP, MailCustomizer.make_file_name(mailing.id, recipient.id))
+            if os.path.exists(fullpath):
+                os.remove(fullpath)
+
+        message_id, data = MailCustomizer(recipient1).customize_in_memory()
+        budget = MemoryBudget(len(data))
+        message_id, content = MailCustomizer(recipient1).customize(budget)
+        self.assertIsInstance(content, InMemoryContent)
+        self.assertEqual(data, content.open().read())
+        self.assertFalse(os.path.exists(os.path.join(settings.MAIL_TEMP, MailCustomizer.make_file_name(mailing.id, recipient1.id))))
+
+        # budget exceeded: spilled to disk
+        message_id, path = MailCustomizer(recipient2).customize(budget)
+        self.assertEqual(os.path.join(settings.MAIL_TEMP, MailCustomizer.make_file_name(mailing.id, recipient2.id)), path)
+        self.assertTrue(os.path.exists(path))
+
+        self.assertTrue(content.is_available())
+        MailCustomizer.invalidate_mailing_body(mailing.id)
+        self.assertFalse(content.is_available())
+        content.release()
+        self.assertEqual(0, budget.used)
+
+    def test_shared_content(self):
+        mailing = factories.MailingFactory(tracking_url=None, body=b"This is a plain newsletter.")
+        recipient = factories.RecipientFactory(mailing=mailing)
+        self.assertFalse(MailCustomizer(recipient, read_tracking=True).is_shareable())
+        customizer = MailCustomizer(recipient, read_tracking=False, shared=True)
+        self.assertTrue(customizer.is_shareable())
+        message_id, data = customizer.customize_in_memory()
+        message = email.parser.BytesParser().parsebytes(data)
+        self.assertEqual('undisclosed-recipients:;', message['To'])
+
+        personalized = factories.MailingFactory(tracking_url=None)
+        recipient = factories.RecipientFactory(mailing=personalized)
+        self.assertFalse(MailCustomizer(recipient, read_tracking=False).is_shareable())
+
+        commented = factories.MailingFactory(tracking_url=None, body=b"This is a {# hidden #}plain newsletter.")
+        recipient = factories.RecipientFactory(mailing=commented)
+        self.assertFalse(MailCustomizer(recipient, read_tracking=False, shared=True).is_shareable())
+
+    def test_compiled_mailing_gives_same_result_than_full_customization(self):
+        mailing = factories.MailingFactory(
+            header=b"""Content-Transfer-Encoding: 7bit
+Content-Type: multipart/alternative; boundary="===============2840728917476054151=="
+Subject: Great news {{ firstname }}!
+From: Mailing Sender <sender@my-company.biz>
+X-Mailer: CloudMailing
+""",
+            body=b"""
+This is a multi-part message in MIME format.
+--===============2840728917476054151==
+Content-Type: text/plain; charset="us-ascii"
+MIME-Version: 1.0
+Content-Transfer-Encoding: 7bit
+
+This is a very {{ custom }} mailing.
+--===============2840728917476054151==
+Content-Type: multipart/related; boundary="===============1786523402738471213=="
+
+--===============1786523402738471213==
+Content-Type: text/html; charset="us-ascii"
+Content-Transfer-Encoding: 7bit
+
+<html><body>This is <a href="http://www.mydomain.com/">a {{ custom }}</a> mailing.</body></html>
+--===============1786523402738471213==
+Content-Type: image/png
+Content-Transfer-Encoding: base64
+Content-ID: <image1>
+
+iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==
+--===============1786523402738471213==--
+
+--===============2840728917476054151==--
+""")
+        recipient = factories.RecipientFactory(mailing=mailing, contact_data={
+            'email': 'john.doe@domain.com',
+            'firstname': 'John',
+            'custom': 'very simple',
+        })
+        customizer = MailCustomizer(recipient, click_tracking=True)
+        contact_data = customizer.make_contact_data_dict(recipient)
+
+        message = customizer._make_customized_message(contact_data)
+        del message['Date']
+        compiled = email.parser.Parser(policy=email.policy.default).parsestr(
+            customizer._get_compiled_mailing().customize(customizer, contact_data))
+        del compiled['Date']
+        self.assertEqual(message.as_string(), compiled.as_string())
+        self.assertEqual("Great news John!", compiled['Subject'])
+        self.assertIs(customizer._get_compiled_mailing(), MailCustomizer(recipient)._get_compiled_mailing())
+
     def test_customize_message_encoding(self):
         mailing = factories.MailingFactory(
             header=b"""Content-Transfer-Encoding: 7bit
@@ -731,6 +849,25 @@ I=92m happy! Nothing else to say...
         self.assertTrue(d.verify(0, dnsfunc=self._get_txt))
         self.assertTrue(d.verify(1, dnsfunc=self._get_txt))
 
+    def test_dkim_private_key_and_body_hash_are_reused(self):
+        privkey = self._get_dkim_privkey()
+        mailing = factories.MailingFactory(dkim={'selector': 'mail', 'domain': 'unittest.cloud-mailing.net', 'privkey':privkey},
+                                           feedback_loop={'dkim': {'selector': 'mail', 'domain': 'unittest.cloud-mailing.net', 'privkey':privkey},
+                                                          'sender_id': 'CloudMailing'})
+        DkimSigner.privateKeys.clear()
+        DkimSigner.invalidate_mailing(mailing.id)
+
+        for i in range(2):
+            recipient = factories.RecipientFactory(mailing=mailing)
+            message_str = self._customize(recipient)
+            d = dkim.DKIM(message_str.encode())
+            self.assertTrue(d.verify(0, dnsfunc=self._get_txt))
+            self.assertTrue(d.verify(1, dnsfunc=self._get_txt))
+
+        self.assertEqual(1, len(DkimSigner.privateKeys))
+        self.assertIn((mailing.id, 'dkim'), DkimSigner.bodyHashes)
+        self.assertIn((mailing.id, 'fbl'), DkimSigner.bodyHashes)
+
     def _get_txt(self, name, timeout=5):
         self.assertEqual(b"mail._domainkey.unittest.cloud-mailing.net.", name)
         return "v=DKIM1; h=sha256; k=rsa; p=MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQDQKTyffdhVj+Z7xke+b3/ns2u9ls3pVdI0tgCYKe8Fi6mXbF+Bri6rBadih/etMNOZ1BO/meLF8wfVgbizxAXjeinKH23HXjqTipJXoWWiwFLIijmSG/2Q+9vseAPGlVpgormOVj67gJRhjJw50i9COiHIq6ChpE969i2LGIfXpQIDAQAB"
@@ -771,3 +908,43 @@ I=92m happy! Nothing else to say...
             '&t=aHR0cDovL3d3dy5teWRvbWFpbi5jb20vdGhlX3BhZ2U_cD1wYXJhbWV0ZXI">click here</a></p>',
             new_content)
 
+
+class DkimSignerTestCase(TestCase):
+    """DkimSigner reuses dkimpy internals, so its signatures are checked against the ones of dkimpy."""
+    message = "From: Sender <sender@unittest.cloud-mailing.net>\n" \
+              "To: recipient@example.com\n" \
+              "Subject: Great news!\n" \
+              "Date: Mon, 14 Oct 2019 10:00:00 +0200\n" \
+              "Message-ID: <1234@unittest.cloud-mailing.net>\n" \
+              "\n" \
+              "This is a very simple mailing.\n"
+
+    def setUp(self):
+        with open(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'deployment', 'acceptance_tests', 'data',
+                               'unittest.cloud-mailing.net', 'mail.private'), 'rt') as f:
+            self.dkim_settings = {'selector': 'mail', 'domain': 'unittest.cloud-mailing.net', 'privkey': f.read()}
+        self.mailing = Mailing(_id=1, type='standard', domain_name='unittest.cloud-mailing.net',
+                               dkim=self.dkim_settings,
+                               feedback_loop={'dkim': self.dkim_settings, 'sender_id': 'CloudMailing'})
+        now = time.time()
+        self.patch(time, 'time', lambda: now)
+        self.patch(DkimSigner, 'privateKeys', {})
+        self.patch(DkimSigner, 'bodyHashes', {})
+
+    def dkimpy_sign(self):
+        sig = dkim.sign(self.message.encode(), b'mail', b'unittest.cloud-mailing.net',
+                        self.dkim_settings['privkey'].encode(), canonicalize=(b'relaxed', b'simple'))
+        message = sig.replace(b'\r\n', b'\n').decode() + self.message
+        message = 'Feedback-ID: 1:unittest.cloud-mailing.net:standard:CloudMailing\n' + message
+        d = dkim.DKIM(message.encode())
+        sig = d.sign(b'mail', b'unittest.cloud-mailing.net', self.dkim_settings['privkey'].encode(),
+                     canonicalize=(b'relaxed', b'simple'),
+                     include_headers=list(map(force_bytes, d.default_sign_headers())) + [b'Feedback-ID'])
+        return sig.replace(b'\r\n', b'\n').decode() + message
+
+    def test_same_signatures_than_dkimpy(self):
+        self.assertEqual(self.dkimpy_sign(), DkimSigner(self.mailing).sign(self.message))
+
+    def test_same_signatures_than_dkimpy_without_cryptography(self):
+        self.patch(dkim_signer, 'rsa', None)
+        self.assertEqual(self.dkimpy_sign(), DkimSigner(self.mailing).sign(self.message))
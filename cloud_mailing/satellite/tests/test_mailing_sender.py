@@ -17,11 +17,23 @@
 
 from ...common.unittest_mixins import DatabaseMixin
 from ..mail_customizer import MailCustomizer
-from ..mailing_sender import MailingSender
-from ..models import MailingRecipient, Mailing
+from ..mailing_sender import MailingSender, DomainPolicies, Queue, RecipientManager, LazyCustomizedContent
+from ..db_thread import stop_db_threadpool
+from .. import mailing_sender
+from ..mx import FakedMXCalculator
+from ..rate_control import RateControl
+from ..sendmail import SMTPRelayerFactory
+from ..models import MailingRecipient, Mailing, DomainConfiguration, ActiveQueue, DomainStats, DomainNotations, \
+    RECIPIENT_STATUS
+from twisted.internet import defer, reactor
 from twisted.trial.unittest import TestCase
+from bson import ObjectId
 from . import factories
+from .test_sendmail import ESMTPServerStandInFactory, FakeContent
+import logging
 import os
+import threading
+from datetime import datetime
 import email.parser
 import email.message
 import base64
@@ -43,3 +55,269 @@ class TestMailingSender(DatabaseMixin, TestCase):
         factories.RecipientFactory(mailing=ml)
         filter = MailingSender.make_queue_filter()
         self.assertEqual(4, MailingRecipient.find(filter).count())
+
+    def test_add_recipients(self):
+        ml = factories.MailingFactory()
+        existing = factories.RecipientFactory(mailing=ml)
+        sender = MailingSender.__new__(MailingSender)  # without starting the whole sender
+        sender.log = logging.getLogger('ml_queue')
+        recipients = [{'_id': ObjectId(), 'mailing': mailing_id, 'tracking_id': 'T%d' % i, 'email': email,
+                       'mail_from': 'sender@cloud-mailing.net', 'next_try': datetime.utcnow()}
+                      for i, (mailing_id, email) in enumerate(((ml.id, 'rcpt1@Example.org'),
+                                                               (ml.id + 1, 'rcpt2@example.com')))]
+        recipients.append({'_id': existing.id, 'mailing': ml.id, 'tracking_id': 'T', 'email': 'dup@example.net',
+                           'mail_from': 'sender@cloud-mailing.net', 'next_try': datetime.utcnow()})
+        domains = set()
+        sender.add_recipients(recipients, domains)
+        self.assertEqual({'example.org', 'example.com'}, domains)
+        self.assertEqual(3, MailingRecipient.count())
+        self.assertIsNotNone(Mailing.grab(ml.id + 1))
+        recipient = MailingRecipient.grab(recipients[0]['_id'])
+        self.assertEqual(RECIPIENT_STATUS.READY, recipient.send_status)
+        self.assertEqual(ml.id, recipient.mailing.id)
+
+
+class FakeMailingManager(object):
+    def __init__(self):
+        self.calls = []
+
+    def callRemote(self, name, *args):
+        self.calls.append((name, args))
+        return defer.succeed([r['_id'] for r in args[0]])
+
+
+class TestDatabaseThread(TestCase):
+    def setUp(self):
+        self.sender = MailingSender.__new__(MailingSender)  # without starting the whole sender
+        self.sender.log = logging.getLogger('ml_queue')
+        self.sender.nextTime = 0
+        self.sender.handlingQueueLock = threading.Lock()
+        self.sender._wakeup_requested = False
+        self.sender.mailing_manager = FakeMailingManager()
+        self.threads = []  # names of threads running database requests
+
+    def tearDown(self):
+        stop_db_threadpool()
+
+    def fail(self, *args, **kwargs):
+        self.threads.append(threading.current_thread().name)
+        raise IOError("Database is down")
+
+    @defer.inlineCallbacks
+    def test_check_mailing_releases_lock_on_error(self):
+        self.patch(MailingSender, 'make_queue_filter', staticmethod(self.fail))
+        yield self.sender.check_mailing()
+        self.assertEqual(1, len(self.threads))
+        self.assertIn('cm.satellite_db', self.threads[0])
+        self.assertFalse(self.sender.handlingQueueLock.locked())
+
+    @defer.inlineCallbacks
+    def test_reports_are_handled_in_database_thread(self):
+        report_id = str(ObjectId())
+
+        def _get_reports():
+            self.threads.append(threading.current_thread().name)
+            return [{'_id': report_id}]
+
+        def _remove(spec):
+            self.threads.append(threading.current_thread().name)
+            self.assertEqual({'_id': {'$in': [ObjectId(report_id)]}}, spec)
+
+        self.patch(self.sender, '_get_reports', _get_reports)
+        self.patch(MailingRecipient, 'remove', _remove)
+        yield self.sender.send_report_for_finished_recipients()
+        self.assertEqual([('send_reports', ([{'_id': report_id}],))], self.sender.mailing_manager.calls)
+        self.assertEqual(2, len(self.threads))
+        for name in self.threads:
+            self.assertIn('cm.satellite_db', name)
+
+    @defer.inlineCallbacks
+    def test_reports_error_is_handled(self):
+        self.patch(self.sender, '_get_reports', self.fail)
+        yield self.sender.send_report_for_finished_recipients()
+        self.assertIn('cm.satellite_db', self.threads[0])
+        self.assertEqual([], self.sender.mailing_manager.calls)
+
+
+class TestSharedContent(DatabaseMixin, TestCase):
+    def setUp(self):
+        self.connect_to_db()
+
+    def tearDown(self):
+        self.disconnect_from_db()
+
+    def test_shared_content_is_checked_for_each_recipient(self):
+        ml = factories.MailingFactory(tracking_url=None, read_tracking=False, body=b"This is a plain newsletter.")
+        plain1 = factories.RecipientFactory(mailing=ml)
+        plain2 = factories.RecipientFactory(mailing=ml)
+        with_attachment = factories.RecipientFactory(mailing=ml, contact_data={
+            'email': 'firstname.lastname@domain.com',
+            'attachments': [{'filename': "export.csv", 'data': base64.b64encode(b"col1;col2\nval1;val2\n"),
+                             'content-type': 'text/plain', 'charset': 'us-ascii'}],
+        })
+        other_sender = factories.RecipientFactory(mailing=ml, mail_from="other@my-company.biz", sender_name="Other")
+        factory = SMTPRelayerFactory('domain.com')
+        factory.maxRecipientsPerMail = 10
+        queue = Queue('domain.com', [], {'mode': 'mx'})
+        queue.memory_budget = None
+
+        shared_contents = {}
+        content = queue._get_shared_content(plain1, factory, shared_contents)
+        self.assertIsNotNone(content)
+        self.assertIsNone(queue._get_shared_content(with_attachment, factory, shared_contents))
+        self.assertIs(content, queue._get_shared_content(plain2, factory, shared_contents))
+        other_content = queue._get_shared_content(other_sender, factory, shared_contents)
+        self.assertIsNotNone(other_content)
+        self.assertIsNot(content, other_content)
+        self.assertEqual(2, len(shared_contents))
+
+    @defer.inlineCallbacks
+    def test_only_personalised_recipients_are_customized_in_pool(self):
+        ml = factories.MailingFactory(tracking_url=None, read_tracking=False, body=b"This is a plain newsletter.")
+        plain = factories.RecipientFactory(mailing=ml)
+        with_attachment = factories.RecipientFactory(mailing=ml, contact_data={
+            'email': 'firstname.lastname@domain.com',
+            'attachments': [{'filename': "export.csv", 'data': base64.b64encode(b"col1;col2\nval1;val2\n"),
+                             'content-type': 'text/plain', 'charset': 'us-ascii'}],
+        })
+        factory = SMTPRelayerFactory('domain.com')
+        factory.maxRecipientsPerMail = 10
+        queue = Queue('domain.com', [plain, with_attachment], {'mode': 'mx'})
+        queue.memory_budget = None
+        submitted = []
+
+        def fake_customize_recipients(pool, recipients, in_memory=False):
+            submitted.extend(r.id for r in recipients)
+            return defer.succeed({})
+        self.patch(mailing_sender, 'customize_recipients', fake_customize_recipients)
+
+        yield queue._customize_recipients_in_pool(['mx.domain.com'], None, factory, [plain, with_attachment])
+        self.assertEqual([with_attachment.id], submitted)
+        self.assertEqual(2, factory.get_recipients_count())
+
+
+class TestLazyCustomization(DatabaseMixin, TestCase):
+    def setUp(self):
+        self.connect_to_db()
+
+    def tearDown(self):
+        self.disconnect_from_db()
+
+    def make_failing_content(self, ex):
+        recipient = factories.RecipientFactory()
+        recipient.set_send_mail_in_progress()
+        rcpt_manager = RecipientManager(SMTPRelayerFactory('domain.com'), recipient, lambda: '127.0.0.1',
+                                        logging.getLogger('ml_queue'))
+
+        def _fail():
+            raise ex
+        self.patch(rcpt_manager, 'customize', _fail)
+        return recipient, rcpt_manager, LazyCustomizedContent(rcpt_manager)
+
+    @defer.inlineCallbacks
+    def test_failed_customization_finishes_recipient(self):
+        recipient, rcpt_manager, content = self.make_failing_content(ValueError("customization error"))
+        yield self.assertFailure(content.prepare(), ValueError)
+        yield self.assertFailure(rcpt_manager.deferred, ValueError)
+        db_recipient = MailingRecipient.grab(recipient.id)
+        self.assertEqual(RECIPIENT_STATUS.GENERAL_ERROR, db_recipient.send_status)
+        self.assertTrue(db_recipient.finished)
+        self.assertFalse(db_recipient.in_progress)
+
+    @defer.inlineCallbacks
+    def test_missing_file_postpones_recipient(self):
+        recipient, rcpt_manager, content = self.make_failing_content(OSError(2, "No such file or directory"))
+        yield self.assertFailure(content.prepare(), OSError)
+        yield self.assertFailure(rcpt_manager.deferred, OSError)
+        db_recipient = MailingRecipient.grab(recipient.id)
+        self.assertEqual(RECIPIENT_STATUS.WARNING, db_recipient.send_status)
+        self.assertTrue(db_recipient.finished)
+        self.assertFalse(db_recipient.in_progress)
+        self.assertGreater(db_recipient.next_try, datetime.utcnow())
+
+
+class TestDomainPolicies(DatabaseMixin, TestCase):
+    def setUp(self):
+        self.connect_to_db()
+
+    def tearDown(self):
+        DomainNotations.clear()
+        self.disconnect_from_db()
+
+    def test_policies_snapshot(self):
+        DomainConfiguration.create(domain_name="example.org", max_relayers=2)
+        ActiveQueue.create(domain_name="example.org")
+        ActiveQueue.create(domain_name="example.com")
+        for i in range(10):
+            DomainStats.add_sent("example.net")
+        policies = DomainPolicies(50)
+        self.assertTrue(policies.has_free_relayer("example.org"))
+        self.assertFalse(policies.has_free_relayer("example.com"))
+        self.assertTrue(policies.has_free_relayer("unknown.org"))
+        self.assertEqual(10, policies.get_max_recipients("example.net"))  # note = 10 / 0.1 hour
+        self.assertEqual(1, policies.get_max_recipients("unknown.org"))
+
+    def test_mx_limits_bound_queues_count(self):
+        DomainConfiguration.create(domain_name="example.org", cnx_per_mx=2, max_mx=2)
+        for i in range(3):
+            ActiveQueue.create(domain_name="example.org")
+        policies = DomainPolicies(50)
+        self.assertTrue(policies.has_free_relayer("example.org"))
+        ActiveQueue.create(domain_name="example.org")
+        policies = DomainPolicies(50)
+        self.assertFalse(policies.has_free_relayer("example.org"))
+
+
+class TestQueueMXSelection(TestCase):
+    mail_server = {'mode': 'mx'}
+
+    def setUp(self):
+        self.patch(Queue, 'mx_in_use', [])
+        self.patch(Queue, 'mxcalc', FakedMXCalculator())
+
+    def test_queues_are_spread_over_equal_preference_mxs(self):
+        mxs = [(10, 'mx1'), (10, 'mx2'), (20, 'backup')]
+        chosen = []
+        for i in range(4):
+            queue = Queue('example.org', [], self.mail_server)
+            queue.mxs = mxs
+            chosen.append(queue._next_mx())
+            Queue.mx_in_use.append(chosen[-1])
+        self.assertEqual(['mx1', 'mx2', 'mx1', 'mx2'], chosen)
+
+    def test_mx_limits(self):
+        Queue.mx_in_use.extend(['mx1', 'mx1', 'mx2'])
+        queue = Queue('example.org', [], self.mail_server, configuration={'cnx_per_mx': 2, 'max_mx': 2})
+        queue.mxs = [(10, 'mx1'), (10, 'mx2'), (10, 'mx3')]
+        self.assertEqual('mx2', queue._next_mx())  # mx1 is full, mx3 would exceed max_mx
+        self.assertEqual('mx3', queue._next_mx())  # no more allowed MX: the least used one
+        self.assertEqual('mx1', queue._next_mx())
+        self.assertIsNone(queue._next_mx())
+
+    def test_throttled_mx_is_avoided(self):
+        self.patch(RateControl, 'enabled', True)
+        self.addCleanup(RateControl.clear)
+        queue = Queue('example.org', [], self.mail_server)
+        queue.mxs = [(10, 'mx1'), (10, 'mx2')]
+        queue.mx_ips = {'mx1': '10.0.0.1', 'mx2': '10.0.0.2'}
+        self.assertEqual('mx1', queue._next_mx())
+        RateControl.on_deferral('10.0.0.2')
+        queue.tried_mxs.clear()
+        Queue.mx_in_use.append('mx1')
+        self.assertEqual('mx1', queue._next_mx())  # mx2 is paused
+
+    @defer.inlineCallbacks
+    def test_failover_to_next_mx(self):
+        server = ESMTPServerStandInFactory((b'PIPELINING',))
+        port = reactor.listenTCP(0, server, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        queue = Queue('example.org', [], self.mail_server)
+        queue.factory = SMTPRelayerFactory('example.org', retries=0,
+                                           connectionClosedCallback=queue._cbConnectionClosed,
+                                           connectionFailureErrback=queue._ebConnectionFailure)
+        queue.factory.send_email('sender@cloud-mailing.net', ('rcpt@example.org',), FakeContent(b'Subject: test\n\n'))
+        queue.mxs = [(10, '127.0.0.2'), (20, '127.0.0.1')]  # nothing listens on 127.0.0.2
+        yield queue._connect(queue._next_mx(), port.getHost().port, queue.factory)
+        self.assertEqual('127.0.0.1', queue.mx_ip)
+        self.assertEqual(1, len(server.messages))
+        self.assertEqual([], Queue.mx_in_use)
@@ -23,7 +23,7 @@ __author__ = 'ricard'
 from twisted.trial import unittest
 from twisted.internet import reactor
 
-from ..mx import MXCalculator
+from ..mx import MXCalculator, DnsCache, DnsPrefetcher
 
 #noinspection PyUnresolvedReferences
 from zope.interface import Interface
@@ -538,5 +538,133 @@ class MXTestCase(unittest.TestCase):
         return self.assertFailure(self.mx.getMX("domain"), DNSServerError)
 
 
+class CountingResolver(object):
+    """Fake resolver counting lookups."""
+    def __init__(self):
+        self.lookups = []
+        self.fail_with = None
+
+    def lookupMailExchange(self, domain):
+        self.lookups.append(('MX', domain))
+        if self.fail_with:
+            return defer.fail(self.fail_with)
+        if domain == 'unknown.domain':
+            message = dns.Message()
+            message.authority = [RRHeader(domain, dns.SOA, dns.IN, 3600, dns.Record_SOA(minimum=120))]
+            return defer.fail(DNSNameError(message))
+        return defer.succeed(([RRHeader(domain, dns.MX, dns.IN, 300, Record_MX(10, 'mx.' + domain))], [], []))
+
+    def lookupAddress(self, name):
+        self.lookups.append(('A', name))
+        return defer.succeed(([RRHeader(name, dns.A, dns.IN, 600, dns.Record_A('10.0.0.1'))], [], []))
 
 
+class DnsCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        logging.getLogger('mx_calc').setLevel(logging.CRITICAL)
+        self.clock = task.Clock()
+        self.resolver = CountingResolver()
+        self.cache = DnsCache(self.resolver, self.clock, stale_ttl=100)
+        self.mx = MXCalculator(self.cache, self.clock)
+
+    @defer.inlineCallbacks
+    def test_entries_are_cached_during_ttl(self):
+        mxs = yield self.mx.getMX('test.domain')
+        self.assertEqual('mx.test.domain', str(mxs[0].name))
+        yield self.mx.getMX('test.domain')
+        ip = yield self.mx.getHostByName('mx.test.domain')
+        self.assertEqual('10.0.0.1', ip)
+        yield self.mx.getHostByName('mx.test.domain')
+        self.assertEqual([('MX', 'test.domain'), ('A', 'mx.test.domain')], self.resolver.lookups)
+
+        self.clock.advance(301)
+        yield self.mx.getMX('test.domain')
+        self.assertEqual(3, len(self.resolver.lookups))
+
+    @defer.inlineCallbacks
+    def test_negative_caching(self):
+        yield self.assertFailure(self.mx.getMX('unknown.domain'), DNSLookupError)
+        yield self.assertFailure(self.mx.getMX('unknown.domain'), DNSLookupError)
+        self.assertEqual(1, len(self.resolver.lookups))
+        self.clock.advance(121)  # SOA minimum
+        yield self.assertFailure(self.mx.getMX('unknown.domain'), DNSLookupError)
+        self.assertEqual(2, len(self.resolver.lookups))
+
+    @defer.inlineCallbacks
+    def test_stale_entry_is_used_on_error(self):
+        yield self.mx.getMX('test.domain')
+        self.clock.advance(350)
+        self.resolver.fail_with = DNSServerError()
+        mxs = yield self.mx.getMX('test.domain')
+        self.assertEqual('mx.test.domain', str(mxs[0].name))
+        self.clock.advance(100)  # stale entry too old
+        yield self.assertFailure(self.mx.getMX('test.domain'), DNSServerError)
+
+    @defer.inlineCallbacks
+    def test_persistence(self):
+        yield self.mx.getMX('test.domain')
+        yield self.assertFailure(self.mx.getMX('unknown.domain'), DNSLookupError)
+        path = self.mktemp()
+        self.cache.save(path)
+
+        cache = DnsCache(self.resolver, self.clock)
+        cache.load(path)
+        mxs = yield MXCalculator(cache, self.clock).getMX('test.domain')
+        self.assertEqual('mx.test.domain', str(mxs[0].name))
+        self.assertEqual(2, len(self.resolver.lookups))
+
+    @defer.inlineCallbacks
+    def test_cleanup_drops_unusable_entries(self):
+        yield self.mx.getMX('test.domain')  # ttl 300, then stale during 100s
+        yield self.assertFailure(self.mx.getMX('unknown.domain'), DNSLookupError)  # ttl 120
+        self.clock.advance(200)
+        self.cache.cleanup()
+        self.assertEqual([('MX', 'test.domain')], list(self.cache.entries))
+        self.clock.advance(201)
+        self.cache.cleanup()
+        self.assertEqual({}, self.cache.entries)
+
+    @defer.inlineCallbacks
+    def test_cache_size_is_bounded(self):
+        self.cache.max_entries = 10
+        for i in range(11):
+            yield self.mx.getMX('test%d.domain' % i)
+            self.clock.advance(1)
+        self.assertEqual(9, len(self.cache.entries))
+        # entries expiring first are evicted
+        self.assertNotIn(('MX', 'test0.domain'), self.cache.entries)
+        self.assertIn(('MX', 'test10.domain'), self.cache.entries)
+
+
+class DnsPrefetcherTestCase(unittest.TestCase):
+    def setUp(self):
+        logging.getLogger('mx_calc').setLevel(logging.CRITICAL)
+        self.clock = task.Clock()
+        self.resolver = CountingResolver()
+        self.mx = MXCalculator(DnsCache(self.resolver, self.clock), self.clock)
+
+    @defer.inlineCallbacks
+    def test_prefetch_warms_cache(self):
+        yield DnsPrefetcher(self.mx).prefetch(['a.domain', 'b.domain', 'unknown.domain'])
+        self.assertEqual(5, len(self.resolver.lookups))
+        self.assertIn(('A', 'mx.b.domain'), self.resolver.lookups)
+
+        ip = yield self.mx.getHostByName('mx.a.domain')
+        self.assertEqual('10.0.0.1', ip)
+        yield self.mx.getMX('b.domain')
+        self.assertEqual(5, len(self.resolver.lookups))
+
+    def test_concurrency_is_bounded(self):
+        pending = []
+        self.resolver.lookupMailExchange = lambda domain: pending.append(defer.Deferred()) or pending[-1]
+        prefetcher = DnsPrefetcher(self.mx, concurrency=2)
+        d = prefetcher.prefetch(['a.domain', 'b.domain', 'c.domain'])
+        self.assertEqual(2, len(pending))
+        prefetcher.prefetch(['a.domain'])  # already running
+        self.assertEqual(2, len(pending))
+        pending[0].errback(DNSServerError())
+        self.assertEqual(3, len(pending))
+        pending[1].errback(DNSServerError())
+        pending[2].errback(DNSServerError())
+        self.assertEqual(set(), prefetcher._running)
+        return d
@@ -0,0 +1,75 @@
+# Copyright 2015-2019 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+from twisted.trial.unittest import TestCase
+
+from ..rate_control import RateControl
+
+__author__ = 'ricard'
+
+
+class TestRateControl(TestCase):
+    def setUp(self):
+        logging.getLogger('rate_control').setLevel(logging.CRITICAL)
+        RateControl.clear()
+        RateControl.configure(enabled=True, max_window=10, min_backoff=60, max_backoff=200)
+
+    def tearDown(self):
+        RateControl.clear()
+        RateControl.configure(enabled=False)
+
+    def test_disabled(self):
+        RateControl.configure(enabled=False)
+        RateControl.on_deferral('example.org')
+        self.assertEqual(3, RateControl.get_limit('example.org', 3))
+
+    def test_window_grows_on_success(self):
+        self.assertEqual(2, RateControl.get_limit('example.org', 2, now=1000))
+        for i in range(4):
+            RateControl.on_success('example.org', now=1000)
+        self.assertEqual(3, RateControl.get_limit('example.org', 2, now=1000))
+        for i in range(100):
+            RateControl.on_success('example.org', now=1000)
+        self.assertEqual(10, RateControl.get_limit('example.org', 2, now=1000))
+        self.assertEqual(5, RateControl.get_limit('example.org', 2, maximum=5, now=1000))
+
+    def test_deferral_pauses_and_shrinks_window(self):
+        self.assertEqual(8, RateControl.get_limit('example.org', 8, now=1000))
+        RateControl.on_deferral('example.org', now=1000)
+        RateControl.on_deferral('example.org', now=1001)  # same congestion
+        self.assertEqual(0, RateControl.get_limit('example.org', 8, now=1059))
+        self.assertEqual(4, RateControl.get_limit('example.org', 8, now=1060))
+
+    def test_backoff_doubles_on_consecutive_deferrals(self):
+        RateControl.get_limit('example.org', 8, now=1000)
+        RateControl.on_deferral('example.org', now=1000)
+        RateControl.on_deferral('example.org', now=1060)
+        self.assertEqual(0, RateControl.get_limit('example.org', 8, now=1179))
+        self.assertEqual(2, RateControl.get_limit('example.org', 8, now=1180))
+        RateControl.on_deferral('example.org', now=1180)
+        RateControl.on_deferral('example.org', now=1380)
+        self.assertEqual(0, RateControl.get_limit('example.org', 8, now=1579))  # max_backoff
+        RateControl.on_success('example.org', now=1580)
+        RateControl.on_deferral('example.org', now=1580)
+        self.assertEqual(1, RateControl.get_limit('example.org', 8, now=1640))
+
+    def test_unknown_destinations_are_ignored(self):
+        RateControl.on_success('example.org')
+        RateControl.on_deferral(None)
+        self.assertEqual({}, RateControl._entries)
@@ -0,0 +1,362 @@
+# Copyright 2015-2019 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+
+from twisted.internet import defer, reactor, protocol
+from twisted.mail import smtp
+from twisted.protocols import basic
+from twisted.trial.unittest import TestCase
+from zope.interface import implementer
+
+from ..sendmail import SMTPRelayerFactory, SMTPConnectionPool
+
+__author__ = 'ricard'
+
+
+class FakeLazyContent(object):
+    def __init__(self, data):
+        self.data = data
+        self.deferred = None
+        self.ready = False
+
+    def prepare(self):
+        self.deferred = defer.Deferred()
+        self.deferred.addCallback(self._cb_ready)
+        return self.deferred
+
+    def _cb_ready(self, result):
+        self.ready = True
+
+    def is_available(self):
+        return self.ready
+
+    def open(self):
+        return io.BytesIO(self.data)
+
+
+class FakeContent(object):
+    def __init__(self, data):
+        self.data = data
+
+    def is_available(self):
+        return True
+
+    def open(self):
+        return io.BytesIO(self.data)
+
+
+class SMTPRelayerFactoryTestCase(TestCase):
+    def setUp(self):
+        self.factory = SMTPRelayerFactory('example.org')
+        self.factory.lookahead = 2
+        self.contents = [FakeLazyContent(b'email %d' % i) for i in range(4)]
+        for i, content in enumerate(self.contents):
+            self.factory.send_email('sender@cloud-mailing.net', ('rcpt%d@example.org' % i,), content)
+
+    def test_emails_are_prepared_only_within_lookahead(self):
+        self.assertIsNotNone(self.factory.waitNextEmail())
+        self.assertEqual([True, True, False, False], [c.deferred is not None for c in self.contents])
+
+        self.contents[0].deferred.callback(None)
+        self.assertIsNone(self.factory.waitNextEmail())
+        self.assertIs(self.contents[0], self.factory.getNextEmail()[2])
+        self.assertEqual([True, True, True, False], [c.deferred is not None for c in self.contents])
+
+    def test_wait_next_email(self):
+        d = self.factory.waitNextEmail()
+        fired = []
+        d.addCallback(fired.append)
+        self.assertFalse(fired)
+        self.contents[0].deferred.callback(None)
+        self.assertEqual([None], fired)
+
+    def test_failed_email_is_dropped(self):
+        d = self.factory.waitNextEmail()
+        fired = []
+        d.addCallback(fired.append)
+        self.contents[0].deferred.errback(ValueError("Customization error"))
+        self.assertFalse(fired)  # now waiting for the next email
+        self.assertEqual(3, self.factory.get_recipients_count())
+        self.contents[1].deferred.callback(None)
+        self.assertEqual([None], fired)
+        self.assertIs(self.contents[1], self.factory.getNextEmail()[2])
+
+
+@implementer(smtp.IMessage)
+class FakeMessage(object):
+    def __init__(self, server):
+        self.server = server
+        self.lines = []
+
+    def lineReceived(self, line):
+        self.lines.append(line)
+
+    def eomReceived(self):
+        self.server.messages.append(b'\n'.join(self.lines))
+        return defer.succeed(None)
+
+    def connectionLost(self):
+        pass
+
+
+@implementer(smtp.IMessageDelivery)
+class FakeDelivery(object):
+    def __init__(self, server):
+        self.server = server
+
+    def receivedHeader(self, helo, origin, recipients):
+        return None
+
+    def validateFrom(self, helo, origin):
+        self.server.transactions_count += 1
+        return origin
+
+    def validateTo(self, user):
+        if user.dest.local.startswith(b'bad'):
+            raise smtp.SMTPBadRcpt(user)
+        return lambda: FakeMessage(self.server)
+
+
+class FakeSMTPServerFactory(smtp.SMTPFactory):
+    def __init__(self):
+        smtp.SMTPFactory.__init__(self)
+        self.messages = []
+        self.connections_count = 0
+        self.transactions_count = 0
+
+    def buildProtocol(self, addr):
+        self.connections_count += 1
+        p = smtp.ESMTP()
+        p.delivery = FakeDelivery(self)
+        p.factory = self
+        return p
+
+
+class SMTPConnectionPoolTestCase(TestCase):
+    timeout = 10
+
+    def setUp(self):
+        self.server = FakeSMTPServerFactory()
+        self.port = reactor.listenTCP(0, self.server, interface='127.0.0.1')
+        self.pool = SMTPConnectionPool(idle_timeout=10)
+
+    def tearDown(self):
+        self.pool.close_all()
+        return self.port.stopListening()
+
+    def send_emails(self, count):
+        factory = SMTPRelayerFactory('example.org')
+        factory.connectionPool = self.pool
+        for i in range(count):
+            factory.send_email('sender@cloud-mailing.net', ('rcpt%d@example.org' % i,),
+                               FakeContent(b'Subject: test\n\nemail %d\n' % i))
+        p = self.pool.acquire('127.0.0.1', self.port.getHost().port)
+        if p:
+            factory.adopt(p)
+        else:
+            reactor.connectTCP('127.0.0.1', self.port.getHost().port, factory)
+        return factory.deferred
+
+    @defer.inlineCallbacks
+    def test_connection_is_reused(self):
+        yield self.send_emails(2)
+        yield self.send_emails(3)
+        self.assertEqual(5, len(self.server.messages))
+        self.assertEqual(1, self.server.connections_count)
+        self.assertEqual(1, len(self.pool.connections[('127.0.0.1', self.port.getHost().port, None)]))
+
+
+class RecipientsGroupingTestCase(TestCase):
+    def setUp(self):
+        self.server = FakeSMTPServerFactory()
+        self.port = reactor.listenTCP(0, self.server, interface='127.0.0.1')
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_identical_contents_are_grouped(self):
+        factory = SMTPRelayerFactory('example.org')
+        factory.maxRecipientsPerMail = 3
+        content = FakeContent(b'Subject: test\n\nsame email\n')
+        results = []
+        for email in ('rcpt0@example.org', 'bad1@example.org', 'rcpt2@example.org', 'rcpt3@example.org'):
+            factory.send_email('sender@cloud-mailing.net', (email,), content)\
+                .addCallbacks(lambda r: results.append(r[0]), lambda f: results.append(f.value.code))
+        factory.send_email('sender@cloud-mailing.net', ('rcpt4@example.org',), FakeContent(b'Subject: other\n\n'))\
+            .addCallback(lambda r: results.append(r[0]))
+        self.assertEqual(3, factory.get_recipients_count())
+
+        reactor.connectTCP('127.0.0.1', self.port.getHost().port, factory)
+        yield factory.deferred
+        self.assertEqual(3, self.server.transactions_count)
+        self.assertEqual(4, len(self.server.messages))  # one per accepted recipient
+        self.assertEqual([1, 550, 1, 1, 1], results)
+
+
+class ESMTPServerStandIn(basic.LineReceiver):
+    """
+    Minimal ESMTP server supporting PIPELINING and CHUNKING, which records the commands received by each
+    network read.
+    """
+    def connectionMade(self):
+        self.rcpts = []
+        self.message = []
+        self.in_data = False
+        self.sendLine(b"220 stand-in ESMTP")
+
+    def dataReceived(self, data):
+        self.factory.reads.append([])
+        basic.LineReceiver.dataReceived(self, data)
+
+    def lineReceived(self, line):
+        if self.in_data:
+            if line == b'.':
+                self.in_data = False
+                self.deliver()
+            else:
+                self.message.append(line[1:] if line.startswith(b'.') else line)
+            return
+        command = line.split(b' ', 1)[0].upper()
+        self.factory.reads[-1].append(command)
+        if command == b'EHLO':
+            self.sendLine(b"250-stand-in")
+            for extension in self.factory.extensions:
+                self.sendLine(b"250-" + extension)
+            self.sendLine(b"250 8BITMIME")
+        elif command == b'MAIL':
+            self.sendLine(b"250 Sender OK")
+        elif command == b'RCPT':
+            if b'<bad' in line:
+                self.sendLine(b"550 Unknown recipient")
+            else:
+                self.rcpts.append(line)
+                self.sendLine(b"250 Recipient OK")
+        elif command == b'DATA':
+            if self.rcpts:
+                self.in_data = True
+                self.sendLine(b"354 Go ahead")
+            else:
+                self.sendLine(b"554 No valid recipients")
+        elif command == b'BDAT':
+            args = line.split()
+            self.remaining = int(args[1])
+            self.last = len(args) > 2
+            self.setRawMode()
+        elif command == b'RSET':
+            self.rcpts = []
+            self.message = []
+            self.sendLine(b"250 OK")
+        elif command == b'QUIT':
+            self.sendLine(b"221 Bye")
+            self.transport.loseConnection()
+        else:
+            self.sendLine(b"500 Unknown command")
+
+    def rawDataReceived(self, data):
+        chunk, rest = data[:self.remaining], data[self.remaining:]
+        self.message.append(chunk)
+        self.remaining -= len(chunk)
+        if not self.remaining:
+            if not self.rcpts:
+                self.sendLine(b"554 No valid recipients")
+            elif self.last:
+                self.deliver(chunked=True)
+            else:
+                self.sendLine(b"250 Chunk OK")
+            self.setLineMode(rest)
+
+    def deliver(self, chunked=False):
+        if chunked:
+            data = b''.join(self.message)
+        else:
+            data = b''.join(line + b'\r\n' for line in self.message)
+        self.factory.messages.append((len(self.rcpts), data))
+        self.rcpts = []
+        self.message = []
+        self.sendLine(b"250 Message accepted")
+
+
+class ESMTPServerStandInFactory(protocol.ServerFactory):
+    protocol = ESMTPServerStandIn
+
+    def __init__(self, extensions):
+        self.extensions = extensions
+        self.reads = []
+        self.messages = []
+
+
+class PipeliningAndChunkingTestCase(TestCase):
+    def start_server(self, *extensions):
+        self.server = ESMTPServerStandInFactory(extensions)
+        self.port = reactor.listenTCP(0, self.server, interface='127.0.0.1')
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    def send_emails(self, contents, chunkingThreshold=0, chunkSize=1024 * 1024, maxRecipientsPerMail=1):
+        factory = SMTPRelayerFactory('example.org')
+        factory.chunkingThreshold = chunkingThreshold
+        factory.chunkSize = chunkSize
+        factory.maxRecipientsPerMail = maxRecipientsPerMail
+        results = []
+        for email, content in contents:
+            factory.send_email('sender@cloud-mailing.net', (email,), content)\
+                .addCallbacks(lambda r: results.append(r[0]), lambda f: results.append(f.value.addresses[0][1]))
+        reactor.connectTCP('127.0.0.1', self.port.getHost().port, factory)
+        return factory.deferred.addCallback(lambda _: results)
+
+    @defer.inlineCallbacks
+    def test_commands_are_pipelined(self):
+        self.start_server(b'PIPELINING')
+        content = FakeContent(b'Subject: test\n\n.dotted line\n')
+        results = yield self.send_emails([('rcpt0@example.org', content), ('bad1@example.org', content),
+                                          ('rcpt2@example.org', content)], maxRecipientsPerMail=3)
+        self.assertEqual([1, 550, 1], results)
+        self.assertIn([b'MAIL', b'RCPT', b'RCPT', b'RCPT', b'DATA'], self.server.reads)
+        self.assertEqual([(2, b'Subject: test\r\n\r\n.dotted line\r\n')], self.server.messages)
+
+    @defer.inlineCallbacks
+    def test_data_is_not_sent_without_valid_recipient(self):
+        self.start_server(b'PIPELINING')
+        results = yield self.send_emails([('bad0@example.org', FakeContent(b'Subject: test\n\n')),
+                                          ('rcpt1@example.org', FakeContent(b'Subject: test 2\n\n'))])
+        self.assertEqual([550, 1], results)
+        self.assertEqual(1, len(self.server.messages))
+
+    @defer.inlineCallbacks
+    def test_big_emails_are_sent_by_chunks(self):
+        self.start_server(b'PIPELINING', b'CHUNKING')
+        body = b''.join(b'.line %d\n' % i for i in range(100))
+        results = yield self.send_emails([('rcpt0@example.org', FakeContent(b'Subject: big\n\n' + body)),
+                                          ('rcpt1@example.org', FakeContent(b'Subject: small\n\n'))],
+                                         chunkingThreshold=100, chunkSize=128)
+        self.assertEqual([1, 1], results)
+        self.assertEqual([(1, (b'Subject: big\n\n' + body).replace(b'\n', b'\r\n')),
+                          (1, b'Subject: small\r\n\r\n')], self.server.messages)
+        self.assertIn([b'MAIL', b'RCPT'], self.server.reads)
+
+    @defer.inlineCallbacks
+    def test_chunking_without_pipelining(self):
+        self.start_server(b'CHUNKING')
+        body = b'x' * 300 + b'\n'
+        results = yield self.send_emails([('rcpt0@example.org', FakeContent(b'Subject: big\n\n' + body))],
+                                         chunkingThreshold=100, chunkSize=128)
+        self.assertEqual([1], results)
+        self.assertEqual([(1, (b'Subject: big\n\n' + body).replace(b'\n', b'\r\n'))], self.server.messages)
+        self.assertEqual([], [read for read in self.server.reads if len(read) > 1])
@@ -17,7 +17,9 @@
 
 from ...common.unittest_mixins import DatabaseMixin
 from ..mail_customizer import MailCustomizer
-from ..models import MailingRecipient, Mailing, DomainStats, HourlyStats
+from ..models import MailingRecipient, Mailing, DomainStats, HourlyStats, StatsCounters, LiveStats, \
+    DomainNotations, WriteBehind
+from pymongo.errors import BulkWriteError
 from twisted.trial.unittest import TestCase
 from . import factories
 import os
@@ -145,3 +147,145 @@ class TestDomainStats(DatabaseMixin, TestCase):
         self.assertGreater(DomainStats.get_domains_notation()['example.org'], 0)
         DomainStats.add_try("example.org")
         self.assertLess(DomainStats.get_domains_notation()['example.org'], 0)
+
+
+class TestStatsCounters(DatabaseMixin, TestCase):
+    def setUp(self):
+        self.connect_to_db()
+        StatsCounters.start()
+
+    def tearDown(self):
+        StatsCounters.stop()
+        self.disconnect_from_db()
+
+    def test_counters_are_aggregated_until_flush(self):
+        HourlyStats.add_sent()
+        HourlyStats.add_failed()
+        DomainStats.add_sent("example.org")
+        DomainStats.add_failed("example.org")
+        DomainStats.add_sent("example.org")
+        DomainStats.add_sent("example.org")
+        self.assertEqual(0, HourlyStats.find().count())
+        self.assertEqual(0, DomainStats.find().count())
+
+        StatsCounters.flush()
+        self.assertEqual(1, HourlyStats.find_one().sent)
+        self.assertEqual(1, HourlyStats.find_one().failed)
+        self.assertEqual(2, HourlyStats.find_one().tries)
+        self.assertEqual(0, HourlyStats.find_one().date.minute)
+        domain = DomainStats.find_one({'domain_name': 'example.org'})
+        self.assertEqual(3, domain.sent)
+        self.assertEqual(1, domain.failed)
+        self.assertEqual(4, domain.tries)
+        self.assertEqual(2, domain.consecutive_sent)
+        self.assertEqual(0, domain.consecutive_failed)
+
+    def test_merge_keeps_sequential_semantic(self):
+        pending = {}
+        StatsCounters.merge(pending, {'$inc': {'consecutive_sent': 1}, '$set': {'consecutive_failed': 0}})
+        StatsCounters.merge(pending, {'$inc': {'consecutive_failed': 1}, '$set': {'consecutive_sent': 0}})
+        StatsCounters.merge(pending, {'$inc': {'consecutive_failed': 1}, '$set': {'consecutive_sent': 0}})
+        self.assertEqual({'$inc': {}, '$set': {'consecutive_failed': 2, 'consecutive_sent': 0}}, pending)
+
+
+class FakeCollection(object):
+    def __init__(self, failed_indexes=()):
+        self.failed_indexes = failed_indexes
+        self.requests = []
+
+    def bulk_write(self, requests, ordered=True):
+        self.requests.append(requests)
+        if self.failed_indexes:
+            raise BulkWriteError({'writeErrors': [{'index': i, 'code': 2, 'errmsg': "error"}
+                                                  for i in self.failed_indexes]})
+
+
+class TestStatsCountersErrors(TestCase):
+    def setUp(self):
+        StatsCounters.start()
+        self.collection = FakeCollection(failed_indexes=[1])
+        self.patch(WriteBehind, '_get_database', staticmethod(lambda: {'domainstats': self.collection}))
+
+    def tearDown(self):
+        StatsCounters._active = False
+        StatsCounters._pending = {}
+
+    def test_only_failed_operations_are_retried(self):
+        for domain in ('example.org', 'example.com', 'example.net'):
+            StatsCounters.update('domainstats', {'domain_name': domain}, {'$inc': {'sent': 1}})
+        StatsCounters.flush()
+        failed_selector = self.collection.requests[0][1]._filter
+        self.assertEqual([('domainstats', tuple(sorted(failed_selector.items())))], list(StatsCounters._pending))
+
+        self.collection.failed_indexes = ()
+        StatsCounters.flush()
+        self.assertEqual(1, len(self.collection.requests[1]))
+        self.assertEqual(failed_selector, self.collection.requests[1][0]._filter)
+        self.assertEqual({}, StatsCounters._pending)
+
+
+class TestLiveStats(DatabaseMixin, TestCase):
+    def setUp(self):
+        self.connect_to_db()
+
+    def tearDown(self):
+        LiveStats.flush()
+        LiveStats.configure()
+        self.disconnect_from_db()
+
+    def add_log(self):
+        return LiveStats.add_log(1, 'example.org', 'sender@cloud-mailing.net', 'rcpt@example.org', 'FINISHED',
+                                 250, '2.0.0', 'OK', '127.0.0.1')
+
+    def test_logs_are_written_by_batches(self):
+        LiveStats.configure(batch_size=3)
+        for i in range(4):
+            self.add_log()
+        # logs are only buffered, even when a batch is full
+        self.assertEqual(0, self.db_sync.live_stats.count())
+        LiveStats.flush()
+        self.assertEqual(4, self.db_sync.live_stats.count())
+        self.assertEqual(0, self.db_sync.live_stats2.count())
+
+    def test_disabled_logs(self):
+        LiveStats.configure(enabled=False, batch_size=1)
+        self.add_log()
+        LiveStats.flush()
+        self.assertEqual(0, self.db_sync.live_stats.count())
+
+    def test_sampled_logs(self):
+        LiveStats.configure(sampling_rate=0, batch_size=1)
+        self.add_log()
+        LiveStats.flush()
+        self.assertEqual(0, self.db_sync.live_stats.count())
+
+
+class TestDomainNotations(DatabaseMixin, TestCase):
+    def setUp(self):
+        self.connect_to_db()
+
+    def tearDown(self):
+        DomainNotations.clear()
+        StatsCounters.stop()
+        self.disconnect_from_db()
+
+    def test_notations_are_loaded_from_db(self):
+        DomainStats.add_sent("example.org")
+        DomainStats.add_try("example.com")
+        DomainNotations.load(["example.org", "example.com", "unknown.org"])
+        notations = DomainStats.get_domains_notation()
+        self.assertAlmostEqual(notations['example.org'], DomainNotations.get("example.org"), delta=0.1)
+        self.assertAlmostEqual(notations['example.com'], DomainNotations.get("example.com"), delta=0.1)
+        self.assertEqual(0, DomainNotations.get("unknown.org"))
+
+    def test_notations_are_updated_in_process(self):
+        StatsCounters.start()
+        DomainNotations.load(["example.org"])
+        DomainStats.add_sent("example.org")
+        DomainStats.add_sent("example.org")
+        self.assertGreater(DomainNotations.get("example.org"), 0)
+        DomainStats.add_try("example.org")
+        self.assertLess(DomainNotations.get("example.org"), 0)
+        StatsCounters.flush()
+        self.assertAlmostEqual(DomainStats.get_domains_notation()['example.org'], DomainNotations.get("example.org"),
+                               delta=0.1)
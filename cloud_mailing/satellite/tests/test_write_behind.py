@@ -0,0 +1,77 @@
+# Copyright 2015-2019 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from twisted.trial.unittest import TestCase
+
+from ...common import settings
+from ...common.unittest_mixins import DatabaseMixin
+from ..models import MailingRecipient, RECIPIENT_STATUS, WriteBehind
+from . import factories
+
+__author__ = 'ricard'
+
+
+class TestWriteBehind(DatabaseMixin, TestCase):
+    def setUp(self):
+        self.connect_to_db()
+        self.journal_path = os.path.join(settings.MAIL_TEMP, 'test_write_behind.journal')
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    def tearDown(self):
+        WriteBehind.stop()
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.disconnect_from_db()
+
+    def test_writes_are_immediate_if_not_started(self):
+        recipient = factories.RecipientFactory()
+        recipient.set_send_mail_in_progress()
+        self.assertEqual(RECIPIENT_STATUS.IN_PROGRESS, MailingRecipient.grab(recipient.id).send_status)
+
+    def test_updates_are_coalesced_until_flush(self):
+        recipient = factories.RecipientFactory()
+        WriteBehind.start(self.journal_path)
+        recipient.set_send_mail_in_progress()
+        recipient.update_send_status(RECIPIENT_STATUS.FINISHED, smtp_message="OK")
+        recipient.mark_as_finished()
+
+        self.assertEqual(RECIPIENT_STATUS.READY, MailingRecipient.grab(recipient.id).send_status)
+        self.assertEqual(1, len(WriteBehind._updates))
+
+        WriteBehind.flush()
+        db_recipient = MailingRecipient.grab(recipient.id)
+        self.assertEqual(RECIPIENT_STATUS.FINISHED, db_recipient.send_status)
+        self.assertEqual(1, db_recipient.try_count)
+        self.assertTrue(db_recipient.finished)
+        self.assertFalse(db_recipient.in_progress)
+        self.assertEqual(0, os.path.getsize(self.journal_path))
+
+    def test_journal_is_replayed_at_startup(self):
+        recipient = factories.RecipientFactory()
+        WriteBehind.start(self.journal_path)
+        recipient.set_send_mail_in_progress()
+        # simulates a crash
+        WriteBehind._journal.close()
+        WriteBehind._journal = None
+        WriteBehind._updates = {}
+        self.assertEqual(RECIPIENT_STATUS.READY, MailingRecipient.grab(recipient.id).send_status)
+
+        WriteBehind.start(self.journal_path)
+        self.assertEqual(RECIPIENT_STATUS.IN_PROGRESS, MailingRecipient.grab(recipient.id).send_status)
@@ -0,0 +1,107 @@
+# Copyright 2015-2019 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Micro-benchmark of per-message DKIM + Feedback Loop signing cost.
+
+Compares the former way (one `dkim.sign()` call for DKIM then a second parsing and signing for the Feedback-ID
+header) with the L{DkimSigner}.
+
+Usage: python bench_dkim.py [messages_count] [key_size] [private_key_file]
+
+The private key is generated with `cryptography` if it is installed, otherwise it has to be given as a PEM file.
+"""
+
+import sys
+import timeit
+
+import dkim
+try:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+except ImportError:
+    rsa = None
+
+import import_cm_path
+from cloud_mailing.common.encoding import force_bytes
+from cloud_mailing.satellite.dkim_signer import DkimSigner
+from cloud_mailing.satellite.models import Mailing
+
+
+def make_private_key(key_size):
+    if rsa is None:
+        sys.exit("cryptography is not installed, please give a private key file.")
+    key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+    return key.private_bytes(encoding=serialization.Encoding.PEM,
+                             format=serialization.PrivateFormat.TraditionalOpenSSL,
+                             encryption_algorithm=serialization.NoEncryption()).decode()
+
+
+def make_message(size=20000):
+    body = "\n".join(["This is the line %d of a not so short mailing content." % i for i in range(size // 56)])
+    return "From: Sender <sender@unittest.cloud-mailing.net>\n" \
+           "To: recipient@example.com\n" \
+           "Subject: Benchmark\n" \
+           "Date: Mon, 14 Oct 2019 10:00:00 +0200\n" \
+           "Message-ID: <1234@unittest.cloud-mailing.net>\n" \
+           "MIME-Version: 1.0\n" \
+           "Content-Type: text/plain; charset=\"utf-8\"\n" \
+           "Content-Transfer-Encoding: 7bit\n" \
+           "\n" + body + "\n"
+
+
+def legacy_sign(mailing, flattened_message):
+    """DKIM and FBL signatures as done before DkimSigner"""
+    dkim_settings = mailing['dkim']
+    sig = dkim.sign(flattened_message.encode(), dkim_settings['selector'].encode(), dkim_settings['domain'].encode(),
+                    dkim_settings['privkey'].encode(),
+                    canonicalize=(b'relaxed', b'simple'))
+    flattened_message = sig.replace(b'\r\n', b'\n').decode() + flattened_message
+
+    fbl_settings = mailing['feedback_loop']
+    dkim_settings = fbl_settings['dkim']
+    fbl_header = 'Feedback-ID: %s:%s:%s:%s\n' % (mailing.id, mailing.domain_name, mailing.type,
+                                                 fbl_settings['sender_id'])
+    flattened_message = fbl_header + flattened_message
+    d = dkim.DKIM(flattened_message.encode())
+    sig = d.sign(dkim_settings['selector'].encode(), dkim_settings['domain'].encode(), dkim_settings['privkey'].encode(),
+                 canonicalize=(b'relaxed', b'simple'),
+                 include_headers=list(map(force_bytes, d.default_sign_headers())) + [b'Feedback-ID'])
+    return sig.replace(b'\r\n', b'\n').decode() + flattened_message
+
+
+def main(count=200, key_size=2048, key_file=None):
+    if key_file:
+        with open(key_file, 'rt') as f:
+            privkey = f.read()
+    else:
+        privkey = make_private_key(key_size)
+    dkim_settings = {'selector': 'mail', 'domain': 'unittest.cloud-mailing.net', 'privkey': privkey}
+    mailing = Mailing(_id=1, type='standard', domain_name='unittest.cloud-mailing.net', dkim=dkim_settings,
+                      feedback_loop={'dkim': dkim_settings, 'sender_id': 'CloudMailing'})
+    message = make_message()
+
+    before = timeit.timeit(lambda: legacy_sign(mailing, message), number=count)
+    after = timeit.timeit(lambda: DkimSigner(mailing).sign(message), number=count)
+    print("RSA-%d, %d messages of %d bytes, DKIM + Feedback-ID signatures" % (key_size, count, len(message)))
+    print("  before: %.2f ms/message" % (before * 1000 / count))
+    print("  after:  %.2f ms/message (x%.1f)" % (after * 1000 / count, before / after))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*[int(arg) for arg in args[:2]] + args[2:3])
@@ -0,0 +1,53 @@
+# Copyright 2015-2019 Cedric RICARD
+#
+# This file is part of CloudMailing.
+#
+# CloudMailing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CloudMailing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CloudMailing.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Runs `explain()` on the hot queries of the satellite and reports full collection scans (COLLSCAN).
+
+Usage: python explain_satellite_queries.py [--create-indexes]
+
+Exit code is 1 if at least one query needs a COLLSCAN.
+"""
+
+import sys
+
+from mogo import connect
+
+import import_cm_path
+from cloud_mailing.common import settings
+from cloud_mailing.satellite.db_initialization import explain_hot_queries, update_indexes
+from cloud_mailing.satellite.mailing_sender import MailingSender
+
+
+def main(create_indexes=False):
+    db_conn = connect(settings.SATELLITE_DATABASE, uri=settings.SATELLITE_DATABASE_URI)
+    db = db_conn[settings.SATELLITE_DATABASE]
+    if create_indexes:
+        update_indexes(db)
+    collscan_count = 0
+    for name, stages, index_names in explain_hot_queries(db, MailingSender.make_queue_filter()):
+        if 'COLLSCAN' in stages:
+            collscan_count += 1
+            status = "COLLSCAN"
+        else:
+            status = "index %s" % ", ".join(index_names)
+        print("%-20s %-40s %s" % (name, " <- ".join(stages), status))
+    return 1 if collscan_count else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main('--create-indexes' in sys.argv[1:]))